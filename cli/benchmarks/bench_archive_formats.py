@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+OnionShare | https://onionshare.org/
+
+Copyright (C) 2014-2022 Micah Lee, et al. <micah@micahflee.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+Benchmark the streaming archive formats on a tree of lots of small files.
+
+Usage:
+    python benchmarks/bench_archive_formats.py [--files 100000] [--file-size 2048]
+        [PATH]
+
+If PATH is not given, a synthetic tree of small text files, like source code or
+logs, is generated in a temporary directory. The tree is scanned once, and then
+it's streamed as a deflated zip file, the way streaming shares used to be sent,
+and as tar, tar.gz and tar.zst. For each it prints how long it took and how big
+the archive is.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+import zipfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from onionshare_cli.common import Common  # noqa: E402
+from onionshare_cli.file_scan import FileScan  # noqa: E402
+from onionshare_cli.web.archive_stream import (  # noqa: E402
+    TarStream,
+    ZipStream,
+    available_archive_formats,
+)
+
+
+def build_tree(dirname, files, file_size):
+    """
+    Write files of around file_size bytes of text, 1000 to a directory
+    """
+    rng = random.Random(0)
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    words = [
+        "".join(rng.choice(letters) for _ in range(rng.randint(2, 10))).encode()
+        for _ in range(2000)
+    ]
+    for i in range(files):
+        subdir = os.path.join(dirname, f"dir{i // 1000:04d}")
+        if i % 1000 == 0:
+            os.makedirs(subdir)
+        size = rng.randint(file_size // 2, file_size * 3 // 2)
+        data = b" ".join(rng.choice(words) for _ in range(size // 6))
+        with open(os.path.join(subdir, f"file{i:07d}.txt"), "wb") as f:
+            f.write(data[:size])
+
+
+def new_stream(common, archive_format):
+    if archive_format == "zip":
+        return ZipStream(common, compress_type=zipfile.ZIP_DEFLATED)
+    return TarStream(common, compression=archive_format.partition(".")[2] or None)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=100000)
+    parser.add_argument("--file-size", type=int, default=2048)
+    parser.add_argument("path", nargs="?")
+    args = parser.parse_args()
+
+    common = Common()
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.path
+        if not path:
+            path = os.path.join(tmp, "tree")
+            print(f"Building a tree of {args.files} files...")
+            build_tree(path, args.files, args.file_size)
+
+        files = list(FileScan([path]).files())
+        total_size = sum(st.st_size for _, _, st in files)
+        print(f"{len(files)} files, {total_size / 1024 / 1024:.1f}MB")
+
+        for archive_format in available_archive_formats():
+            archive = new_stream(common, archive_format)
+            archive.add_files(files)
+            start = time.perf_counter()
+            size = sum(len(chunk) for chunk in archive.generate())
+            elapsed = time.perf_counter() - start
+            print(
+                f"{archive_format:<8} {elapsed:7.2f}s "
+                f"{total_size / elapsed / 1024 / 1024:8.1f} MB/s "
+                f"size {size / 1024 / 1024:8.1f}MB ratio={size / total_size:.3f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
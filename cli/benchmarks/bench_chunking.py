@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+OnionShare | https://onionshare.org/
+
+Copyright (C) 2014-2022 Micah Lee, et al. <micah@micahflee.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Benchmark fixed and adaptive chunk sizes for downloads sent a chunk at a time.
+
+Usage:
+    python benchmarks/bench_chunking.py [--size-mb 256] [--seconds 2]
+
+Reads a temporary file of size_mb, in fixed 100kb chunks and in chunks sized by
+an AdaptiveChunker, and hands each chunk to an emulated link that takes
+len(chunk) / speed seconds to send it. Slow links only send as much as they can
+in the given number of seconds. For each link speed it prints the throughput,
+how many chunks it took and the biggest chunk, which is how much memory the
+transfer needed at once.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from onionshare_cli.web.transfers import AdaptiveChunker  # noqa: E402
+
+
+class FixedChunker(object):
+    def __init__(self, size):
+        self.size = size
+        self.peak_size = size
+
+    def next_size(self):
+        return self.size
+
+
+def send(filename, total_bytes, chunker, speed):
+    """
+    Send total_bytes of the file over a link of speed bytes per second, or as
+    fast as possible if speed is None
+    """
+    sent = 0
+    chunks = 0
+    start = time.perf_counter()
+    with open(filename, "rb") as f:
+        while sent < total_bytes:
+            chunk = f.read(min(chunker.next_size(), total_bytes - sent))
+            if not chunk:
+                break
+            sent += len(chunk)
+            chunks += 1
+            if speed is not None:
+                time.sleep(len(chunk) / speed)
+    return sent, chunks, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size-mb", type=int, default=256)
+    parser.add_argument("--seconds", type=float, default=2)
+    args = parser.parse_args()
+
+    size = args.size_mb * 1024 * 1024
+    speeds = [
+        ("tor 256kb/s", 256 * 1024),
+        ("1mb/s", 1024 * 1024),
+        ("10mb/s", 10 * 1024 * 1024),
+        ("100mb/s", 100 * 1024 * 1024),
+        ("local", None),
+    ]
+
+    with tempfile.NamedTemporaryFile() as f:
+        block = os.urandom(1024 * 1024)
+        for _ in range(args.size_mb):
+            f.write(block)
+        f.flush()
+
+        for name, speed in speeds:
+            total_bytes = size
+            if speed is not None:
+                total_bytes = min(size, int(speed * args.seconds))
+
+            for kind, chunker in (
+                ("fixed", FixedChunker(102400)),
+                ("adaptive", AdaptiveChunker(102400)),
+            ):
+                sent, chunks, elapsed = send(f.name, total_bytes, chunker, speed)
+                print(
+                    f"{name:<12} {kind:<9} {sent / elapsed / 1024 / 1024:8.1f} MB/s "
+                    f"{chunks:7d} chunks  peak {chunker.peak_size // 1024:5d} kb"
+                )
+
+
+if __name__ == "__main__":
+    main()
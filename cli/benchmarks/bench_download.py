@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+OnionShare | https://onionshare.org/
+
+Copyright (C) 2014-2022 Micah Lee, et al. <micah@micahflee.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Benchmark how much CPU the web server uses to serve a share download.
+
+Usage:
+    python benchmarks/bench_download.py [--size-mb 1024] [--downloads 3]
+
+A single file of random data is shared over a local waitress server and
+downloaded with urllib. The CPU time of the whole process, server and client,
+is reported per GB served.
+"""
+import argparse
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from onionshare_cli.common import Common  # noqa: E402
+from onionshare_cli.mode_settings import ModeSettings  # noqa: E402
+from onionshare_cli.settings import Settings  # noqa: E402
+from onionshare_cli.web import Web  # noqa: E402
+
+
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size-mb", type=int, default=1024)
+    parser.add_argument("--downloads", type=int, default=3)
+    args = parser.parse_args()
+
+    common = Common()
+    common.settings = Settings(common)
+    mode_settings = ModeSettings(common)
+    mode_settings.set("share", "autostop_sharing", False)
+    mode_settings.set("general", "public", True)
+    web = Web(common, False, mode_settings, "share")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, "random.bin")
+        with open(filename, "wb") as f:
+            for _ in range(args.size_mb):
+                f.write(os.urandom(1024 * 1024))
+        web.share_mode.set_file_info([filename])
+
+        port = common.get_available_port(17600, 17650)
+        t = threading.Thread(target=web.start, args=(port,), daemon=True)
+        t.start()
+        time.sleep(1)
+
+        # Don't measure printing the progress
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+
+        total_bytes = 0
+        start_cpu = cpu_time()
+        start_time = time.perf_counter()
+        for _ in range(args.downloads):
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/download") as r:
+                while True:
+                    chunk = r.read(1 << 20)
+                    if not chunk:
+                        break
+                    total_bytes += len(chunk)
+        elapsed = time.perf_counter() - start_time
+        cpu = cpu_time() - start_cpu
+
+        sys.stdout.close()
+        sys.stdout = stdout
+
+        web.stop(port)
+
+    gb = total_bytes / (1 << 30)
+    print(
+        f"served {gb:.2f}GB in {elapsed:.2f}s ({gb / elapsed * 1024:.0f} MB/s), "
+        f"{cpu / gb:.2f} CPU seconds per GB"
+    )
+
+
+if __name__ == "__main__":
+    main()
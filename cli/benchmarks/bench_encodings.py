@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+OnionShare | https://onionshare.org/
+
+Copyright (C) 2014-2022 Micah Lee, et al. <micah@micahflee.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Benchmark the bytes on the wire of a static website in each content-encoding.
+
+Usage:
+    python benchmarks/bench_encodings.py [--site DIR] [--kbps 250]
+
+Compresses every file of the site that website mode would compress, the same
+way website mode does, and prints the total bytes sent in each content-encoding,
+how long compressing took, and how long sending it would take over a link of
+kbps kilobytes per second, which is about what Tor manages. The default site is
+OnionShare's own static files and templates.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from onionshare_cli.common import Common  # noqa: E402
+from onionshare_cli.web.compression import (  # noqa: E402
+    ENCODING_LEVELS,
+    available_encodings,
+    should_compress,
+)
+from onionshare_cli.web.send_base_mode import SendBaseModeWeb  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--site",
+        default=os.path.join(
+            os.path.dirname(os.path.abspath(__file__)),
+            "..",
+            "onionshare_cli",
+            "resources",
+        ),
+    )
+    parser.add_argument("--kbps", type=int, default=250)
+    args = parser.parse_args()
+
+    filenames = []
+    for root, _, files in os.walk(args.site):
+        for filename in files:
+            filenames.append(os.path.join(root, filename))
+    total_size = sum(os.path.getsize(filename) for filename in filenames)
+    compressible = [filename for filename in filenames if should_compress(filename)]
+
+    # compress_variant() doesn't use anything that __init__() sets up
+    web = SendBaseModeWeb.__new__(SendBaseModeWeb)
+    web.common = Common()
+
+    print(f"{len(filenames)} files, {len(compressible)} of them compressible")
+    print(
+        f"{'encoding':<10} {'level':>5} {'bytes':>10} {'ratio':>6} "
+        f"{'compress':>9} {'send':>7}"
+    )
+    rows = [("identity", "", total_size, 0.0)]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for encoding in available_encodings():
+            size = total_size
+            start = time.perf_counter()
+            for i, filename in enumerate(compressible):
+                output_filename = os.path.join(tmp_dir, f"{i}.{encoding}")
+                web.compress_variant(filename, output_filename, encoding)
+
+                # Only smaller copies get sent
+                size -= max(
+                    0, os.path.getsize(filename) - os.path.getsize(output_filename)
+                )
+            rows.append(
+                (encoding, ENCODING_LEVELS[encoding], size, time.perf_counter() - start)
+            )
+
+    for encoding, level, size, elapsed in rows:
+        print(
+            f"{encoding:<10} {level:>5} {size:>10} {size / total_size:6.3f} "
+            f"{elapsed:8.2f}s {size / 1024 / args.kbps:6.2f}s"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+OnionShare | https://onionshare.org/
+
+Copyright (C) 2014-2022 Micah Lee, et al. <micah@micahflee.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Benchmark the memory and build time of the index of a share's files.
+
+Usage:
+    python benchmarks/bench_path_index.py [--files 1000000] [--per-dir 1000]
+        [--tree DIR]
+
+Builds a synthetic tree of empty files, or reuses the one in DIR if it's already
+there, and indexes it three ways: a dict of full paths built with os.walk, the
+way shares used to, and a PathIndex built up front and lazily. For each it prints
+how long building took, how much memory the index holds on to, and how long
+looking up random paths takes.
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from onionshare_cli.web.path_index import PathIndex  # noqa: E402
+
+
+def make_tree(root, files, per_dir):
+    for i in range(0, files, per_dir):
+        dirname = os.path.join(root, f"dir{i // per_dir // 100:04d}", f"sub{i:08d}")
+        os.makedirs(dirname)
+        for j in range(min(per_dir, files - i)):
+            os.close(os.open(os.path.join(dirname, f"file{j:06d}.txt"), os.O_CREAT))
+
+
+def build_dict(root):
+    """
+    How shares used to build their file list
+    """
+    basename = os.path.basename(root)
+    files = {}
+    for dirpath, _, nested_filenames in os.walk(root, followlinks=False):
+        normalized_root = os.path.join(
+            basename, dirpath[len(root) :].lstrip("/")
+        ).rstrip("/")
+        files[normalized_root] = dirpath
+        for nested_filename in nested_filenames:
+            full_path = os.path.join(dirpath, nested_filename)
+            if os.path.islink(full_path):
+                continue
+            files[os.path.join(normalized_root, nested_filename)] = full_path
+    return files
+
+
+def build_index(root, lazy):
+    index = PathIndex(lazy=lazy)
+    index.add_dir(os.path.basename(root), root)
+    return index
+
+
+def measure(build):
+    start = time.perf_counter()
+    index = build()
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    index = build()
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return index, elapsed, size
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=1000000)
+    parser.add_argument("--per-dir", type=int, default=1000)
+    parser.add_argument("--tree", default=None)
+    parser.add_argument("--lookups", type=int, default=100000)
+    args = parser.parse_args()
+
+    tmp_dir = None
+    if args.tree:
+        root = args.tree
+    else:
+        tmp_dir = tempfile.mkdtemp()
+        root = os.path.join(tmp_dir, "share")
+    if not os.path.exists(root):
+        print(f"Making {args.files} files in {root}")
+        os.makedirs(root)
+        make_tree(root, args.files, args.per_dir)
+
+    try:
+        old, elapsed, size = measure(lambda: build_dict(root))
+        paths = random.sample(list(old), min(args.lookups, len(old)))
+        print(f"{len(old)} paths")
+        results = [("dict", old, elapsed, size)]
+        for name, lazy in (("PathIndex", False), ("lazy", True)):
+            index, elapsed, size = measure(lambda: build_index(root, lazy))
+            results.append((name, index, elapsed, size))
+
+        for name, index, elapsed, size in results:
+            start = time.perf_counter()
+            for path in paths:
+                index[path]
+            lookups = time.perf_counter() - start
+            print(
+                f"{name:<10} build {elapsed:7.2f}s  memory {size / 1024 / 1024:7.1f}mb"
+                f"  lookups {lookups * 1e6 / len(paths):5.1f}us"
+            )
+    finally:
+        if tmp_dir:
+            shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+OnionShare | https://onionshare.org/
+
+Copyright (C) 2014-2022 Micah Lee, et al. <micah@micahflee.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Benchmark the cost of reporting progress in the loop that sends a download.
+
+Usage:
+    python benchmarks/bench_progress.py [--size-mb 1024] [--chunk-kb 100]
+
+Reads size_mb of data from memory a chunk at a time, three ways: without any
+progress reporting, reporting every chunk the way downloads used to (an event
+dict on a queue.Queue, and a progress line on stdout), and through a Transfer
+that reports at most Transfer.progress_rate times per second, the way they do
+now. Progress lines go to /dev/null.
+"""
+import argparse
+import io
+import os
+import queue
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from onionshare_cli.common import Common  # noqa: E402
+from onionshare_cli.web.events import (  # noqa: E402
+    REQUEST_PROGRESS,
+    Event,
+    EventBus,
+    EventQueue,
+    ProgressPrinter,
+)
+from onionshare_cli.web.transfers import TransferRegistry  # noqa: E402
+
+
+class Settings(object):
+    def get(self, *args):
+        return False
+
+
+def read_chunks(data, chunk_size, report):
+    f = io.BytesIO(data)
+    sent = 0
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+        sent += len(chunk)
+        report(sent)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size-mb", type=int, default=1024)
+    parser.add_argument("--chunk-kb", type=int, default=100)
+    args = parser.parse_args()
+
+    common = Common()
+    data = b"\0" * (args.size_mb * 1024 * 1024)
+    chunk_size = args.chunk_kb * 1024
+    chunks = len(data) // chunk_size
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+
+    def baseline(sent):
+        pass
+
+    # What downloads used to do for every chunk
+    old_q = queue.Queue()
+
+    def every_chunk(sent):
+        percent = (1.0 * sent / len(data)) * 100
+        sys.stdout.write(
+            "\r{0}{1:s}, {2:.2f}%          ".format(
+                "", common.human_readable_filesize(sent), percent
+            )
+        )
+        sys.stdout.flush()
+        old_q.put(
+            {
+                "type": REQUEST_PROGRESS,
+                "path": "/download",
+                "data": {"id": 0, "bytes": sent, "total_bytes": len(data)},
+            }
+        )
+
+    # What they do now
+    bus = EventBus()
+    new_q = bus.subscribe(EventQueue())
+    bus.subscribe(ProgressPrinter(common, Settings(), "share"))
+    transfer = TransferRegistry(queue.Queue()).start("/download", len(data))
+
+    def throttled(sent):
+        if transfer.update(sent):
+            bus.publish(
+                Event(
+                    REQUEST_PROGRESS,
+                    "/download",
+                    {"id": 0, "bytes": sent, "total_bytes": len(data)},
+                )
+            )
+
+    results = []
+    for name, report in (
+        ("no progress", baseline),
+        ("every chunk", every_chunk),
+        ("throttled", throttled),
+    ):
+        start = time.perf_counter()
+        read_chunks(data, chunk_size, report)
+        elapsed = time.perf_counter() - start
+        results.append((name, elapsed))
+
+    sys.stdout.close()
+    sys.stdout = stdout
+
+    for name, elapsed in results:
+        print(
+            f"{name:<12} {elapsed * 1e9 / chunks:8.0f} ns/chunk "
+            f"{len(data) / elapsed / 1024 / 1024:8.0f} MB/s"
+        )
+    print(f"events queued: every chunk={old_q.qsize()}, throttled={new_q.qsize()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+OnionShare | https://onionshare.org/
+
+Copyright (C) 2014-2022 Micah Lee, et al. <micah@micahflee.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Benchmark ZipWriter with different numbers of compression workers.
+
+Usage:
+    python benchmarks/bench_zip_writer.py [--size-mb 2048] [--workers 1,2,4,8] [PATH]
+
+If PATH is not given, a synthetic tree of half text and half random data is
+generated in a temporary directory.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import zipfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from onionshare_cli.common import Common  # noqa: E402
+from onionshare_cli.web.share_mode import ZipWriter  # noqa: E402
+
+
+def build_tree(dirname, size_mb):
+    """
+    Write size_mb of files: compressible text files and incompressible random files
+    """
+    words = b"onionshare shares files securely and anonymously over tor "
+    file_size = 64 * 1024 * 1024
+    count = max(1, size_mb * 1024 * 1024 // file_size)
+    for i in range(count):
+        subdir = os.path.join(dirname, f"dir{i % 8}")
+        os.makedirs(subdir, exist_ok=True)
+        with open(os.path.join(subdir, f"file{i}"), "wb") as f:
+            written = 0
+            while written < file_size:
+                if i % 2 == 0:
+                    chunk = words * (1024 * 1024 // len(words))
+                else:
+                    chunk = os.urandom(1024 * 1024)
+                f.write(chunk)
+                written += len(chunk)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size-mb", type=int, default=2048)
+    parser.add_argument(
+        "--workers", default=f"1,{os.cpu_count() or 1}", help="comma separated"
+    )
+    parser.add_argument("path", nargs="?")
+    args = parser.parse_args()
+
+    common = Common()
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.path
+        if not path:
+            path = os.path.join(tmp, "tree")
+            print(f"Building a {args.size_mb}MB test tree...")
+            build_tree(path, args.size_mb)
+
+        for workers in [int(w) for w in args.workers.split(",")]:
+            zip_filename = os.path.join(tmp, f"bench_{workers}.zip")
+            start = time.perf_counter()
+            zw = ZipWriter(common, zip_filename=zip_filename, workers=workers)
+            if os.path.isdir(path):
+                completed = zw.add_dir(path)
+            else:
+                completed = zw.add_file(path)
+            zw.close()
+            elapsed = time.perf_counter() - start
+            if not completed:
+                print(f"workers={workers:<3} canceled")
+                continue
+
+            with zipfile.ZipFile(zip_filename) as z:
+                compressed = sum(info.compress_size for info in z.infolist())
+            print(
+                f"workers={workers:<3} {zw._size / elapsed / 1024 / 1024:8.1f} MB/s "
+                f"{elapsed:7.2f}s ratio={compressed / max(zw._size, 1):.3f}"
+            )
+            os.remove(zip_filename)
+
+
+if __name__ == "__main__":
+    main()
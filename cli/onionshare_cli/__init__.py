@@ -127,6 +127,27 @@ def main(cwd=None):
         default=False,
         help="Log file download activity to stdout",
     )
+    parser.add_argument(
+        "--streaming-archive",
+        action="store_true",
+        dest="streaming_archive",
+        default=False,
+        help="Share files: Build the zip file while it is being downloaded, and only compress a single file once it is requested with gzip, instead of compressing everything before sharing",
+    )
+    parser.add_argument(
+        "--no-archive-compression",
+        action="store_true",
+        dest="no_archive_compression",
+        default=False,
+        help="Share files: Store files in the zip file without compressing them (streamed zip files can then be resumed)",
+    )
+    parser.add_argument(
+        "--archive-format",
+        choices=["zip", "tar", "tar.gz", "tar.zst"],
+        dest="archive_format",
+        default="zip",
+        help="Share files: The format of the archive that gets downloaded. tar.gz and tar.zst compress all of the files together, which makes much smaller archives than zip for lots of small files, and tar files are always built while they are being downloaded (default is zip)",
+    )
     parser.add_argument(
         "--qr",
         action="store_true",
@@ -213,6 +234,9 @@ def main(cwd=None):
     disable_csp = bool(args.disable_csp)
     custom_csp = args.custom_csp
     log_filenames = bool(args.log_filenames)
+    streaming_archive = bool(args.streaming_archive)
+    archive_compression = not bool(args.no_archive_compression)
+    archive_format = args.archive_format
     verbose = bool(args.verbose)
 
     # Verbose mode?
@@ -252,6 +276,9 @@ def main(cwd=None):
         if mode == "share":
             mode_settings.set("share", "autostop_sharing", autostop_sharing)
             mode_settings.set("share", "log_filenames", log_filenames)
+            mode_settings.set("share", "streaming_archive", streaming_archive)
+            mode_settings.set("share", "archive_compression", archive_compression)
+            mode_settings.set("share", "archive_format", archive_format)
         if mode == "receive":
             if data_dir:
                 mode_settings.set("receive", "data_dir", data_dir)
@@ -437,7 +464,13 @@ def main(cwd=None):
 
     if mode == "share":
         # Prepare files to share
-        print("Compressing files.")
+        if (
+            mode_settings.get("share", "streaming_archive")
+            or mode_settings.get("share", "archive_format") != "zip"
+        ):
+            print("Preparing files.")
+        else:
+            print("Compressing files.")
         try:
             web.share_mode.set_file_info(filenames)
         except OSError as e:
@@ -517,19 +550,12 @@ def main(cwd=None):
                 if not app.autostop_timer_thread.is_alive():
                     if mode == "share":
                         # If there were no attempts to download the share, or all downloads are done, we can stop
-                        if (
-                            not web.share_mode.download_in_progress
-                            or web.share_mode.cur_history_id == 0
-                            or web.done
-                        ):
+                        if not web.share_mode.transfers.in_progress():
                             print("Stopped because auto-stop timer ran out")
                             web.stop(app.port)
                             break
                     elif mode == "receive":
-                        if (
-                            web.receive_mode.cur_history_id == 0
-                            or not web.receive_mode.uploads_in_progress
-                        ):
+                        if not web.receive_mode.transfers.in_progress():
                             print("Stopped because auto-stop timer ran out")
                             web.stop(app.port)
                             break
@@ -34,6 +34,7 @@ import re
 import colorama
 from colorama import Fore, Back, Style
 
+from .file_scan import FileScan
 from .settings import Settings
 
 
@@ -446,6 +447,15 @@ class Common:
         os.makedirs(persistent_dir, 0o700, True)
         return persistent_dir
 
+    def build_archive_cache_dir(self):
+        """
+        Returns the path to the folder that holds the cached zip archives of
+        persistent shares
+        """
+        archive_cache_dir = os.path.join(self.build_data_dir(), "archive_cache")
+        os.makedirs(archive_cache_dir, 0o700, True)
+        return archive_cache_dir
+
     def build_tor_dir(self):
         """
         Returns path to the tor data directory
@@ -595,13 +605,7 @@ class Common:
         """
         Calculates the total size, in bytes, of all of the files in a directory.
         """
-        total_size = 0
-        for dirpath, dirnames, filenames in os.walk(start_path):
-            for f in filenames:
-                fp = os.path.join(dirpath, f)
-                if not os.path.islink(fp):
-                    total_size += os.path.getsize(fp)
-        return total_size
+        return FileScan([start_path]).size
 
 
 class AutoStopTimer(threading.Thread):
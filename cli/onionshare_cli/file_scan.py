@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+OnionShare | https://onionshare.org/
+
+Copyright (C) 2014-2022 Micah Lee, et al. <micah@micahflee.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import stat
+
+
+class FileScan(object):
+    """
+    A snapshot of the metadata of some files and directories, with everything in
+    them, made in a single pass of os.scandir(). DirEntry.stat() costs at most one
+    stat() for each file, and none at all on Windows, where it comes with the
+    directory listing. Sizing the files, zipping them up and showing how big they
+    are all use the same snapshot, instead of walking the directories again.
+
+    Symlinks are left out, and so is everything that is_contained() says is
+    outside of the share. It gets asked about each of filenames, and once about
+    each directory, since the files in a directory that aren't symlinks are
+    wherever the directory is.
+    """
+
+    def __init__(self, filenames, is_contained=None):
+        self.filenames = list(filenames)
+        self.is_contained = is_contained
+
+        # Each of filenames that's a file or a directory, as a dict with its
+        # filename, basename, whether it's a directory, the total size of its files,
+        # and its files as (filename, arcname, st) tuples, in the order they go in
+        # an archive
+        self.roots = []
+        self.size = 0
+
+        for filename in self.filenames:
+            root = self._scan(filename)
+            if root is not None:
+                self.roots.append(root)
+                self.size += root["size"]
+
+    def files(self):
+        """
+        Yield (filename, arcname, st) for all of the files
+        """
+        for root in self.roots:
+            yield from root["files"]
+
+    def _scan(self, filename):
+        try:
+            st = os.lstat(filename)
+        except OSError:
+            return None
+
+        root = {
+            "filename": filename,
+            "basename": os.path.basename(filename.rstrip("/")),
+            "is_dir": stat.S_ISDIR(st.st_mode),
+            "size": 0,
+            "files": [],
+        }
+        if stat.S_ISREG(st.st_mode):
+            if self.is_contained is not None and not self.is_contained(filename):
+                return None
+            root["files"].append((filename, root["basename"], st))
+            root["size"] = st.st_size
+            return root
+        if not root["is_dir"]:
+            # Symlinks and anything else that isn't a file or a directory
+            return None
+
+        # Files come before the directories next to them, both sorted by name
+        dir_to_strip = os.path.dirname(filename.rstrip("/")) + "/"
+        stack = [filename]
+        while stack:
+            dirpath = stack.pop()
+            if self.is_contained is not None and not self.is_contained(dirpath):
+                continue
+
+            files = []
+            dirs = []
+            try:
+                with os.scandir(dirpath) as it:
+                    for entry in it:
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                dirs.append(entry.path)
+                            elif entry.is_file(follow_symlinks=False):
+                                st = entry.stat(follow_symlinks=False)
+                                files.append((entry.path, st))
+                        except OSError:
+                            # It's gone already
+                            continue
+            except OSError:
+                # Skip directories that can't be read, like os.walk() does
+                continue
+
+            files.sort(key=lambda file: file[0])
+            for full_filename, st in files:
+                root["files"].append(
+                    (full_filename, full_filename[len(dir_to_strip) :], st)
+                )
+                root["size"] += st.st_size
+            stack.extend(sorted(dirs, reverse=True))
+        return root
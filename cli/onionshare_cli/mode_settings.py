@@ -57,6 +57,9 @@ class ModeSettings:
                 "autostop_sharing": True,
                 "filenames": [],
                 "log_filenames": False,
+                "streaming_archive": False,
+                "archive_compression": True,
+                "archive_format": "zip",
             },
             "receive": {
                 "data_dir": self.build_default_receive_data_dir(),
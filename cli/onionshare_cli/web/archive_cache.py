@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+"""
+OnionShare | https://onionshare.org/
+
+Copyright (C) 2014-2022 Micah Lee, et al. <micah@micahflee.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import hashlib
+import json
+import os
+import time
+
+
+class ArchiveCache(object):
+    """
+    An on-disk cache of the zip archive of a persistent share, so that restarting
+    the share doesn't mean compressing everything all over again.
+
+    Each member of the archive is keyed by the path, size, mtime and inode of the
+    file it came from. If none of the files changed the whole archive, and its
+    ETag, gets reused. Otherwise the compressed data of the files that didn't
+    change gets copied from the old archive, and only the rest gets compressed.
+    """
+
+    # When the cache gets bigger than this, the least recently used archives of
+    # other shares get deleted
+    budget = 4 << 30  # 4gb
+
+    def __init__(self, common, settings_filename, budget=None):
+        self.common = common
+        self.cache_dir = self.common.build_archive_cache_dir()
+        if budget is not None:
+            self.budget = budget
+
+        # Each persistent share gets its own archive, named after its settings file
+        self.settings_filename = os.path.abspath(settings_filename)
+        self.key = hashlib.sha256(self.settings_filename.encode("utf-8")).hexdigest()[
+            :32
+        ]
+        self.manifest_filename = os.path.join(self.cache_dir, f"{self.key}.json")
+
+        self.manifest = self._load_manifest(self.manifest_filename)
+        if self.manifest and not os.path.exists(self.archive_filename()):
+            self.manifest = None
+
+        # Members of the cached archive, by the file they came from
+        self.members = {}
+        if self.manifest:
+            for member in self.manifest["members"]:
+                self.members[self._member_key(member)] = member
+
+        self.archive_file = None
+
+    @staticmethod
+    def file_key(filename, st):
+        """
+        The cache key for a file, given the result of os.stat()
+        """
+        return (os.path.abspath(filename), st.st_size, st.st_mtime_ns, st.st_ino)
+
+    @staticmethod
+    def _member_key(member):
+        return (member["filename"], member["size"], member["mtime_ns"], member["inode"])
+
+    def _load_manifest(self, manifest_filename):
+        try:
+            with open(manifest_filename, "r") as f:
+                return json.load(f)
+        except Exception:
+            return None
+
+    def _options_match(self, compress_type, compresslevel):
+        return (
+            self.manifest is not None
+            and self.manifest["compress_type"] == compress_type
+            and self.manifest["compresslevel"] == compresslevel
+        )
+
+    def archive_filename(self):
+        """
+        The filename of the cached archive
+        """
+        return os.path.join(self.cache_dir, self.manifest["archive"])
+
+    def new_archive_filename(self):
+        """
+        A filename in the cache to write a new archive to. The old one stays where
+        it is until the new one is saved, so its members can be copied.
+        """
+        return os.path.join(
+            self.cache_dir, f"{self.key}_{self.common.random_string(4, 6)}.zip"
+        )
+
+    def get_archive(self, members, compress_type, compresslevel):
+        """
+        If the cached archive has exactly these (filename, arcname, st) members,
+        and none of the files changed, return the cache manifest. Otherwise return
+        None.
+        """
+        if not self._options_match(compress_type, compresslevel):
+            return None
+        if len(members) != len(self.manifest["members"]):
+            return None
+
+        for (filename, arcname, st), member in zip(members, self.manifest["members"]):
+            if arcname != member["arcname"]:
+                return None
+            if self.file_key(filename, st) != self._member_key(member):
+                return None
+
+        try:
+            if os.path.getsize(self.archive_filename()) != self.manifest["size"]:
+                return None
+        except OSError:
+            return None
+
+        self.common.log("ArchiveCache", "get_archive", f"reusing {self.key}")
+        self.manifest["last_used"] = time.time()
+        self._save_manifest()
+        return self.manifest
+
+    def lookup(self, filename, st, compress_type, compresslevel):
+        """
+        Return the cached member for a file, if the file hasn't changed since it
+        was added to the cached archive.
+        """
+        if not self._options_match(compress_type, compresslevel):
+            return None
+        return self.members.get(self.file_key(filename, st))
+
+    def read_raw(self, member, chunk_size):
+        """
+        Read the compressed data of a member of the cached archive, a chunk at a time.
+        """
+        if self.archive_file is None:
+            self.archive_file = open(self.archive_filename(), "rb")
+
+        self.archive_file.seek(member["data_offset"])
+        remaining = member["compress_size"]
+        while remaining > 0:
+            chunk = self.archive_file.read(min(chunk_size, remaining))
+            if not chunk:
+                raise IOError(f"Cached archive {self.archive_filename()} is truncated")
+            remaining -= len(chunk)
+            yield chunk
+
+    def save(self, zip_writer, size, etag):
+        """
+        Make the archive that zip_writer just finished writing the cached archive,
+        and delete the old one.
+        """
+        old_archive_filename = None
+        if self.manifest:
+            old_archive_filename = self.archive_filename()
+        self._close_archive_file()
+
+        self.manifest = {
+            "settings_filename": self.settings_filename,
+            "archive": os.path.basename(zip_writer.zip_filename),
+            "compress_type": zip_writer.compress_type,
+            "compresslevel": zip_writer.compresslevel,
+            "size": size,
+            "total_size": zip_writer._size,
+            "etag": etag,
+            "last_used": time.time(),
+            "members": zip_writer.members,
+        }
+        self.members = {}
+        for member in self.manifest["members"]:
+            self.members[self._member_key(member)] = member
+        self._save_manifest()
+
+        if old_archive_filename and old_archive_filename != self.archive_filename():
+            self._remove(old_archive_filename)
+
+        self.common.log(
+            "ArchiveCache",
+            "save",
+            f"saved {self.key}, reused {zip_writer.reused_files} files",
+        )
+
+    def discard(self, zip_filename):
+        """
+        Delete an archive that didn't get finished
+        """
+        self._close_archive_file()
+        self._remove(zip_filename)
+
+    def _save_manifest(self):
+        tmp_filename = f"{self.manifest_filename}.tmp"
+        with open(tmp_filename, "w") as f:
+            json.dump(self.manifest, f)
+        os.replace(tmp_filename, self.manifest_filename)
+
+    def _close_archive_file(self):
+        if self.archive_file is not None:
+            self.archive_file.close()
+            self.archive_file = None
+
+    def _remove(self, filename):
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+
+    def cleanup(self):
+        """
+        Close the cached archive, and delete old archives: ones left behind by
+        shares that were interrupted, ones of persistent shares that don't exist
+        anymore, and the least recently used ones if the cache is over budget. The
+        archive of this share never gets evicted.
+        """
+        self.common.log("ArchiveCache", "cleanup")
+        self._close_archive_file()
+
+        manifests = []
+        referenced = set()
+        for filename in os.listdir(self.cache_dir):
+            if not filename.endswith(".json"):
+                continue
+            manifest_filename = os.path.join(self.cache_dir, filename)
+            manifest = self._load_manifest(manifest_filename)
+            if manifest is None:
+                self._remove(manifest_filename)
+                continue
+            archive_filename = os.path.join(self.cache_dir, manifest["archive"])
+            if manifest_filename != self.manifest_filename and not os.path.exists(
+                manifest["settings_filename"]
+            ):
+                # The persistent share was deleted
+                self._remove(archive_filename)
+                self._remove(manifest_filename)
+                continue
+            referenced.add(manifest["archive"])
+            manifests.append((manifest, manifest_filename, archive_filename))
+
+        # Archives of this share that aren't in the manifest were never finished
+        for filename in os.listdir(self.cache_dir):
+            if (
+                filename.startswith(f"{self.key}_")
+                and filename.endswith(".zip")
+                and filename not in referenced
+            ):
+                self._remove(os.path.join(self.cache_dir, filename))
+
+        # Evict the least recently used archives until the cache fits the budget
+        total_size = sum(manifest["size"] for manifest, _, _ in manifests)
+        manifests.sort(key=lambda m: m[0]["last_used"])
+        for manifest, manifest_filename, archive_filename in manifests:
+            if total_size <= self.budget:
+                break
+            if manifest_filename == self.manifest_filename:
+                continue
+            self.common.log("ArchiveCache", "cleanup", f"evicting {archive_filename}")
+            self._remove(archive_filename)
+            self._remove(manifest_filename)
+            total_size -= manifest["size"]
@@ -0,0 +1,850 @@
+# -*- coding: utf-8 -*-
+"""
+OnionShare | https://onionshare.org/
+
+Copyright (C) 2014-2022 Micah Lee, et al. <micah@micahflee.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import binascii
+import bisect
+import hashlib
+import json
+import os
+import stat
+import struct
+import tarfile
+import threading
+import time
+import zipfile
+import zlib
+
+from ..file_scan import FileScan
+from .compression import should_compress, zstd
+
+# Zip record layouts, see APPNOTE.TXT sections 4.3.7 - 4.3.16
+LOCAL_FILE_HEADER = struct.Struct("<4sHHHHHLLLHH")
+LOCAL_FILE_HEADER_SIGNATURE = b"PK\x03\x04"
+DATA_DESCRIPTOR = struct.Struct("<4sLLL")
+DATA_DESCRIPTOR_ZIP64 = struct.Struct("<4sLQQ")
+DATA_DESCRIPTOR_SIGNATURE = b"PK\x07\x08"
+CENTRAL_DIRECTORY_HEADER = struct.Struct("<4sHHHHHHLLLHHHHHLL")
+CENTRAL_DIRECTORY_SIGNATURE = b"PK\x01\x02"
+END_OF_CENTRAL_DIRECTORY = struct.Struct("<4sHHHHLLH")
+END_OF_CENTRAL_DIRECTORY_SIGNATURE = b"PK\x05\x06"
+ZIP64_END_OF_CENTRAL_DIRECTORY = struct.Struct("<4sQHHLLQQQQ")
+ZIP64_END_OF_CENTRAL_DIRECTORY_SIGNATURE = b"PK\x06\x06"
+ZIP64_END_OF_CENTRAL_DIRECTORY_LOCATOR = struct.Struct("<4sLQL")
+ZIP64_END_OF_CENTRAL_DIRECTORY_LOCATOR_SIGNATURE = b"PK\x06\x07"
+
+ZIP_VERSION = 20
+ZIP64_VERSION = 45
+ZIP_CREATE_SYSTEM_UNIX = 3
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP_FILECOUNT_LIMIT = 0xFFFF
+
+FLAG_DATA_DESCRIPTOR = 0x08
+FLAG_UTF8 = 0x800
+
+# The formats archives can be streamed in, and their content types
+ARCHIVE_FORMATS = {
+    "zip": "application/zip",
+    "tar": "application/x-tar",
+    "tar.gz": "application/gzip",
+    "tar.zst": "application/zstd",
+}
+
+# The kinds of segments an uncompressed zip stream is laid out in
+SEGMENT_HEADER = 0
+SEGMENT_DATA = 1
+SEGMENT_DESCRIPTOR = 2
+SEGMENT_CENTRAL_DIRECTORY = 3
+SEGMENT_END = 4
+
+
+def dos_date_time(mtime):
+    """
+    Convert a unix timestamp into the (date, time) pair that zip headers use.
+    Zip can't represent anything before 1980, so clamp to that.
+    """
+    t = time.localtime(mtime)
+    if t.tm_year < 1980:
+        return (0 << 9) | (1 << 5) | 1, 0
+    dosdate = (t.tm_year - 1980) << 9 | t.tm_mon << 5 | t.tm_mday
+    dostime = t.tm_hour << 11 | t.tm_min << 5 | (t.tm_sec // 2)
+    return dosdate, dostime
+
+
+def local_file_header(member, flags, zip64, compress_type):
+    """
+    The local file header of a zip member whose CRC and sizes go in a data
+    descriptor after its data
+    """
+    name = member["arcname"].encode("utf-8")
+    if zip64:
+        # The real sizes go in the data descriptor
+        extra = struct.pack("<HHQQ", 1, 16, 0, 0)
+        size = ZIP64_LIMIT
+        version = ZIP64_VERSION
+    else:
+        extra = b""
+        size = 0
+        version = ZIP_VERSION
+
+    dosdate, dostime = dos_date_time(member["mtime"])
+    return (
+        LOCAL_FILE_HEADER.pack(
+            LOCAL_FILE_HEADER_SIGNATURE,
+            version,
+            flags,
+            compress_type,
+            dostime,
+            dosdate,
+            0,
+            size,
+            size,
+            len(name),
+            len(extra),
+        )
+        + name
+        + extra
+    )
+
+
+def data_descriptor(crc, compress_size, file_size, zip64):
+    """
+    The data descriptor that follows the data of a zip member
+    """
+    if zip64:
+        return DATA_DESCRIPTOR_ZIP64.pack(
+            DATA_DESCRIPTOR_SIGNATURE, crc, compress_size, file_size
+        )
+    return DATA_DESCRIPTOR.pack(
+        DATA_DESCRIPTOR_SIGNATURE, crc, compress_size, file_size
+    )
+
+
+def central_directory_header(entry):
+    """
+    The central directory header of a zip member, once its data is written
+    """
+    member = entry["member"]
+    name = member["arcname"].encode("utf-8")
+
+    # Only the fields that don't fit go into the Zip64 extra field, in this order
+    extra_fields = []
+    file_size = entry["file_size"]
+    compress_size = entry["compress_size"]
+    header_offset = entry["header_offset"]
+    if file_size >= ZIP64_LIMIT:
+        extra_fields.append(file_size)
+        file_size = ZIP64_LIMIT
+    if compress_size >= ZIP64_LIMIT:
+        extra_fields.append(compress_size)
+        compress_size = ZIP64_LIMIT
+    if header_offset >= ZIP64_LIMIT:
+        extra_fields.append(header_offset)
+        header_offset = ZIP64_LIMIT
+
+    if extra_fields or entry["zip64"]:
+        version = ZIP64_VERSION
+    else:
+        version = ZIP_VERSION
+
+    if extra_fields:
+        extra = struct.pack(
+            "<HH" + "Q" * len(extra_fields),
+            1,
+            8 * len(extra_fields),
+            *extra_fields,
+        )
+    else:
+        extra = b""
+
+    dosdate, dostime = dos_date_time(member["mtime"])
+    return (
+        CENTRAL_DIRECTORY_HEADER.pack(
+            CENTRAL_DIRECTORY_SIGNATURE,
+            ZIP_CREATE_SYSTEM_UNIX << 8 | version,
+            version,
+            entry["flags"],
+            entry["compress_type"],
+            dostime,
+            dosdate,
+            entry["crc"],
+            compress_size,
+            file_size,
+            len(name),
+            len(extra),
+            0,
+            0,
+            0,
+            (member["mode"] & 0xFFFF) << 16,
+            header_offset,
+        )
+        + name
+        + extra
+    )
+
+
+def end_of_central_directory(count, cd_offset, cd_size):
+    """
+    The end of central directory record, with Zip64 records if they're needed
+    """
+    data = b""
+    if (
+        count >= ZIP_FILECOUNT_LIMIT
+        or cd_offset >= ZIP64_LIMIT
+        or cd_size >= ZIP64_LIMIT
+    ):
+        zip64_offset = cd_offset + cd_size
+        data += ZIP64_END_OF_CENTRAL_DIRECTORY.pack(
+            ZIP64_END_OF_CENTRAL_DIRECTORY_SIGNATURE,
+            ZIP64_END_OF_CENTRAL_DIRECTORY.size - 12,
+            ZIP_CREATE_SYSTEM_UNIX << 8 | ZIP64_VERSION,
+            ZIP64_VERSION,
+            0,
+            0,
+            count,
+            count,
+            cd_size,
+            cd_offset,
+        )
+        data += ZIP64_END_OF_CENTRAL_DIRECTORY_LOCATOR.pack(
+            ZIP64_END_OF_CENTRAL_DIRECTORY_LOCATOR_SIGNATURE, 0, zip64_offset, 1
+        )
+
+    data += END_OF_CENTRAL_DIRECTORY.pack(
+        END_OF_CENTRAL_DIRECTORY_SIGNATURE,
+        0,
+        0,
+        min(count, ZIP_FILECOUNT_LIMIT),
+        min(count, ZIP_FILECOUNT_LIMIT),
+        min(cd_size, ZIP64_LIMIT),
+        min(cd_offset, ZIP64_LIMIT),
+        0,
+    )
+    return data
+
+
+def member_flags(member):
+    """
+    The general purpose flags of a zip member
+    """
+    flags = FLAG_DATA_DESCRIPTOR
+    if not member["arcname"].isascii():
+        flags |= FLAG_UTF8
+    return flags
+
+
+def available_archive_formats():
+    """
+    The archive formats that can be used
+    """
+    return [
+        archive_format
+        for archive_format in ARCHIVE_FORMATS
+        if archive_format != "tar.zst" or zstd is not None
+    ]
+
+
+class ArchiveStream(object):
+    """
+    The files that go in an archive that's generated on the fly while it's being
+    downloaded, rather than being written to disk first.
+    """
+
+    def __init__(self, common, web=None, chunk_size=102400):
+        self.common = common
+        self.web = web
+        self.chunk_size = chunk_size
+
+        # Members are added in order, and streamed in that same order
+        self.members = []
+        self.total_size = 0
+
+    def add_file(self, filename):
+        """
+        Add a file to the archive stream.
+        """
+        self.add_files(self._scan([filename]).files())
+
+    def add_dir(self, filename):
+        """
+        Add a directory, and all of its children, to the archive stream.
+        """
+        self.add_files(self._scan([filename]).files())
+
+    def add_files(self, files):
+        """
+        Add (filename, arcname, st) tuples from a FileScan to the archive stream.
+        """
+        for filename, arcname, st in files:
+            self.members.append(
+                {
+                    "filename": filename,
+                    "arcname": arcname.replace(os.sep, "/"),
+                    "size": st.st_size,
+                    "mtime": st.st_mtime,
+                    "mtime_ns": st.st_mtime_ns,
+                    "inode": st.st_ino,
+                    "mode": st.st_mode,
+                }
+            )
+            self.total_size += st.st_size
+
+    def _scan(self, filenames):
+        # Only add files that are within the selected roots (symlink safety check)
+        if self.web:
+            return FileScan(filenames, self.web.share_mode._is_path_contained)
+        return FileScan(filenames)
+
+
+class ZipStream(ArchiveStream):
+    """
+    ZipStream accepts files and directories just like ZipWriter, but instead of
+    compressing them into a zip file on disk, it generates the zip archive on the
+    fly while it's being downloaded. Every member uses a data descriptor, so the
+    CRC and sizes are written after the file data, and Zip64 records are used
+    whenever the sizes or offsets need them.
+
+    If the files are stored without compression, the whole archive can be laid out
+    from file metadata alone, which means its size and ETag are known up front and
+    any byte range of it can be read with open().
+    """
+
+    content_type = ARCHIVE_FORMATS["zip"]
+
+    def __init__(
+        self,
+        common,
+        web=None,
+        compress_type=zipfile.ZIP_DEFLATED,
+        compresslevel=6,
+        chunk_size=102400,
+    ):
+        super(ZipStream, self).__init__(common, web, chunk_size)
+        self.compress_type = compress_type
+        self.compresslevel = compresslevel
+
+        # There is no file on disk, but the download still needs a filename
+        self.zip_filename = f"onionshare_{self.common.random_string(4, 6)}.zip"
+
+        # These get filled in by build_layout(), for uncompressed zip streams
+        self.entries = None
+        self.segments = None
+        self.segment_offsets = None
+        self.end_record = None
+        self.size = None
+        self.etag = None
+
+        # CRCs of members, computed the first time each member gets read, or by
+        # compute_crcs() in the background. The central directory needs all of
+        # them, so until crcs_done is set, reading the end of the archive means
+        # reading every file.
+        self.crcs = {}
+        self.crcs_done = threading.Event()
+        self.canceled = False
+
+    @property
+    def supports_ranges(self):
+        """
+        Only uncompressed zip streams have a size that is known ahead of time.
+        """
+        return self.compress_type == zipfile.ZIP_STORED
+
+    def _member_compress_type(self, member):
+        # Don't waste time compressing files that won't get any smaller
+        if self.compress_type == zipfile.ZIP_DEFLATED and should_compress(
+            member["filename"]
+        ):
+            return zipfile.ZIP_DEFLATED
+        return zipfile.ZIP_STORED
+
+    def _member_zip64(self, member, compress_type):
+        if compress_type == zipfile.ZIP_STORED:
+            return member["size"] >= ZIP64_LIMIT
+        # Same heuristic as zipfile: deflate could grow incompressible data slightly
+        return member["size"] * 1.05 > ZIP64_LIMIT
+
+    def build_layout(self):
+        """
+        Work out where every header, file and data descriptor of an uncompressed
+        zip stream goes, and compute the size and ETag of the archive. Only file
+        metadata is used, nothing gets read.
+        """
+        offset = 0
+        self.entries = []
+        self.segments = []
+        for index, member in enumerate(self.members):
+            flags = member_flags(member)
+            zip64 = self._member_zip64(member, zipfile.ZIP_STORED)
+            header = local_file_header(member, flags, zip64, zipfile.ZIP_STORED)
+            entry = {
+                "member": member,
+                "flags": flags,
+                "compress_type": zipfile.ZIP_STORED,
+                "zip64": zip64,
+                "crc": 0,
+                "file_size": member["size"],
+                "compress_size": member["size"],
+                "header_offset": offset,
+                "header": header,
+            }
+            if member["size"] == 0:
+                self.crcs[index] = 0
+            self.entries.append(entry)
+
+            self.segments.append((offset, len(header), SEGMENT_HEADER, index))
+            offset += len(header)
+            self.segments.append((offset, member["size"], SEGMENT_DATA, index))
+            offset += member["size"]
+            descriptor_size = (
+                DATA_DESCRIPTOR_ZIP64.size if zip64 else DATA_DESCRIPTOR.size
+            )
+            self.segments.append((offset, descriptor_size, SEGMENT_DESCRIPTOR, index))
+            offset += descriptor_size
+
+        # The length of central directory headers doesn't depend on the CRCs
+        cd_offset = offset
+        cd_size = sum(len(central_directory_header(entry)) for entry in self.entries)
+        self.segments.append((cd_offset, cd_size, SEGMENT_CENTRAL_DIRECTORY, None))
+        offset += cd_size
+
+        self.end_record = end_of_central_directory(
+            len(self.entries), cd_offset, cd_size
+        )
+        self.segments.append((offset, len(self.end_record), SEGMENT_END, None))
+        offset += len(self.end_record)
+
+        self.segment_offsets = [segment[0] for segment in self.segments]
+        self.size = offset
+
+        # The archive is fully determined by this metadata, so hash that. Like the
+        # ETags of individual files, the inode and mtime in nanoseconds tell apart
+        # files that were replaced by ones of the same size in the same second.
+        hasher = hashlib.sha256()
+        for member in self.members:
+            hasher.update(
+                json.dumps(
+                    [
+                        member["arcname"],
+                        member["size"],
+                        member["mtime_ns"],
+                        member["inode"],
+                        member["mode"],
+                    ]
+                ).encode("utf-8")
+            )
+        hash_value = binascii.hexlify(hasher.digest()).decode("utf-8")
+        self.etag = '"sha256:{}"'.format(hash_value)
+
+    def member_crc(self, index):
+        """
+        Return the CRC of a member, reading the file if it hasn't been read yet.
+        """
+        if index not in self.crcs:
+            member = self.members[index]
+            crc = 0
+            bytes_left = member["size"]
+            with open(member["filename"], "rb") as f:
+                while bytes_left > 0:
+                    chunk = f.read(min(1 << 20, bytes_left))
+                    if not chunk:
+                        raise IOError(
+                            f"{member['filename']} changed while it was being shared"
+                        )
+                    crc = zlib.crc32(chunk, crc)
+                    bytes_left -= len(chunk)
+            self.crcs[index] = crc
+        return self.crcs[index]
+
+    def start_crcs(self):
+        """
+        Start computing the CRCs of all of the members in a background thread
+        """
+        thread = threading.Thread(target=self.compute_crcs, daemon=True)
+        thread.start()
+        return thread
+
+    def compute_crcs(self):
+        """
+        Compute the CRCs of all of the members that haven't been read yet, and set
+        crcs_done once they're all known
+        """
+        for index in range(len(self.members)):
+            if self.canceled:
+                return
+            try:
+                self.member_crc(index)
+            except OSError as e:
+                self.common.log("ZipStream", "compute_crcs", f"failed: {e}")
+                return
+        self.crcs_done.set()
+
+    def cancel(self):
+        """
+        Stop computing CRCs in the background, when something else gets shared
+        """
+        self.canceled = True
+
+    def central_directory(self):
+        """
+        Return the central directory of an uncompressed zip stream.
+        """
+        cd = []
+        for index, entry in enumerate(self.entries):
+            entry["crc"] = self.member_crc(index)
+            cd.append(central_directory_header(entry))
+        return b"".join(cd)
+
+    def open(self):
+        """
+        Open an uncompressed zip stream as a read-only, seekable file object.
+        """
+        if self.size is None:
+            self.build_layout()
+        return ZipStreamReader(self)
+
+    def generate(self, processed_size_callback=None, chunker=None):
+        """
+        Generate the zip archive, yielding it a chunk at a time. If
+        processed_size_callback is passed in, it gets called with the number of
+        bytes of the original files that have been streamed so far. If chunker is
+        passed in, its next_size() decides how much of a file to read at a time,
+        rather than chunk_size.
+        """
+        offset = 0
+        processed_size = 0
+        entries = []
+
+        for member in self.members:
+            flags = member_flags(member)
+            compress_type = self._member_compress_type(member)
+            zip64 = self._member_zip64(member, compress_type)
+
+            header = local_file_header(member, flags, zip64, compress_type)
+            header_offset = offset
+            offset += len(header)
+            yield header
+
+            if compress_type == zipfile.ZIP_DEFLATED:
+                compressor = zlib.compressobj(
+                    self.compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS
+                )
+            else:
+                compressor = None
+
+            crc = 0
+            file_size = 0
+            compress_size = 0
+            with open(member["filename"], "rb") as f:
+                while True:
+                    if chunker is not None:
+                        chunk = f.read(chunker.next_size())
+                    else:
+                        chunk = f.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    crc = zlib.crc32(chunk, crc)
+                    file_size += len(chunk)
+                    processed_size += len(chunk)
+                    if compressor:
+                        chunk = compressor.compress(chunk)
+                    if chunk:
+                        compress_size += len(chunk)
+                        offset += len(chunk)
+                        yield chunk
+                    if processed_size_callback is not None:
+                        processed_size_callback(processed_size)
+
+            if compressor:
+                chunk = compressor.flush()
+                compress_size += len(chunk)
+                offset += len(chunk)
+                if chunk:
+                    yield chunk
+
+            descriptor = data_descriptor(crc, compress_size, file_size, zip64)
+            offset += len(descriptor)
+            yield descriptor
+
+            entries.append(
+                {
+                    "member": member,
+                    "flags": flags,
+                    "compress_type": compress_type,
+                    "zip64": zip64,
+                    "crc": crc,
+                    "file_size": file_size,
+                    "compress_size": compress_size,
+                    "header_offset": header_offset,
+                }
+            )
+
+        cd_offset = offset
+        cd = b""
+        for entry in entries:
+            cd += central_directory_header(entry)
+            if len(cd) >= self.chunk_size:
+                offset += len(cd)
+                yield cd
+                cd = b""
+        if cd:
+            offset += len(cd)
+            yield cd
+
+        yield end_of_central_directory(
+            len(entries), cd_offset, offset - cd_offset
+        )
+
+        if processed_size_callback is not None:
+            processed_size_callback(processed_size)
+
+
+class ZipStreamReader(object):
+    """
+    A read-only file object over an uncompressed ZipStream. Seeking is cheap, so
+    any byte range of the archive can be served, for example when resuming a
+    download, without generating everything that comes before it.
+    """
+
+    def __init__(self, zip_stream):
+        self.zip_stream = zip_stream
+        self.pos = 0
+        self.closed = False
+
+        # The member file that's currently open
+        self.fp = None
+        self.fp_index = None
+
+        # Keep track of the CRC of the member being read from start to finish, up to
+        # the furthest offset into it that has been read without skipping anything
+        self.crc_index = None
+        self.crc_pos = 0
+        self.crc = 0
+
+        self.cd = None
+
+    def seekable(self):
+        return True
+
+    def readable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_SET:
+            self.pos = offset
+        elif whence == os.SEEK_CUR:
+            self.pos += offset
+        elif whence == os.SEEK_END:
+            self.pos = self.zip_stream.size + offset
+        return self.pos
+
+    def read(self, size=-1):
+        bytes_left = self.zip_stream.size - self.pos
+        if size is None or size < 0 or size > bytes_left:
+            size = max(bytes_left, 0)
+
+        chunks = []
+        while size > 0:
+            i = bisect.bisect_right(self.zip_stream.segment_offsets, self.pos) - 1
+            offset, length, kind, index = self.zip_stream.segments[i]
+            within = self.pos - offset
+            n = min(size, length - within)
+            chunks.append(self._read_segment(kind, index, within, n))
+            self.pos += n
+            size -= n
+
+        return b"".join(chunks)
+
+    def _read_segment(self, kind, index, within, n):
+        if kind == SEGMENT_HEADER:
+            return self.zip_stream.entries[index]["header"][within : within + n]
+
+        if kind == SEGMENT_DATA:
+            return self._read_data(index, within, n)
+
+        if kind == SEGMENT_DESCRIPTOR:
+            entry = self.zip_stream.entries[index]
+            descriptor = data_descriptor(
+                self.zip_stream.member_crc(index),
+                entry["compress_size"],
+                entry["file_size"],
+                entry["zip64"],
+            )
+            return descriptor[within : within + n]
+
+        if kind == SEGMENT_CENTRAL_DIRECTORY:
+            if self.cd is None:
+                self.cd = self.zip_stream.central_directory()
+            return self.cd[within : within + n]
+
+        return self.zip_stream.end_record[within : within + n]
+
+    def _read_data(self, index, within, n):
+        member = self.zip_stream.members[index]
+        if self.fp_index != index:
+            if self.fp:
+                self.fp.close()
+            self.fp = open(member["filename"], "rb")
+            self.fp_index = index
+        if self.fp.tell() != within:
+            self.fp.seek(within)
+
+        data = self.fp.read(n)
+        if len(data) != n:
+            raise IOError(f"{member['filename']} changed while it was being shared")
+
+        # If this member is being read from the beginning, compute its CRC on the way.
+        # waitress reads ahead and then seeks back to what it actually sent, so
+        # bytes that were already counted can get read again.
+        if within == 0 and self.crc_index != index:
+            self.crc_index = index
+            self.crc_pos = 0
+            self.crc = 0
+        if self.crc_index == index and within <= self.crc_pos < within + n:
+            self.crc = zlib.crc32(data[self.crc_pos - within :], self.crc)
+            self.crc_pos = within + n
+            if self.crc_pos == member["size"]:
+                self.zip_stream.crcs[index] = self.crc
+
+        return data
+
+    def close(self):
+        if self.fp:
+            self.fp.close()
+            self.fp = None
+        self.closed = True
+
+
+class TarStream(ArchiveStream):
+    """
+    Generates a tar archive on the fly while it's being downloaded. Tar has no
+    central directory and no checksums of the file data, so each file is just a
+    header followed by its data, padded to a whole block. Names and sizes that
+    don't fit in a plain tar header use pax headers.
+
+    If compression is "gz" or "zst", the whole archive is compressed as one
+    stream, rather than each file on its own like in a zip archive. With lots of
+    small files, that makes the archive a lot smaller, since similar files get
+    compressed together and there are no per-file headers left uncompressed.
+    Unlike an uncompressed ZipStream, it's never known how big it is ahead of
+    time, so it can't be resumed.
+
+    Only names, sizes, permissions and mtimes go in the archive. The owner of the
+    files isn't anyone else's business, so it's left out.
+    """
+
+    supports_ranges = False
+
+    # zstd's default level is already about as good as gzip's, and much faster
+    compresslevels = {"gz": 6, "zst": 3}
+
+    def __init__(self, common, web=None, compression=None, chunk_size=102400):
+        super(TarStream, self).__init__(common, web, chunk_size)
+        self.compression = compression
+
+        archive_format = "tar"
+        if compression:
+            archive_format += "." + compression
+        self.content_type = ARCHIVE_FORMATS[archive_format]
+
+        # There is no file on disk, but the download still needs a filename
+        self.tar_filename = (
+            f"onionshare_{self.common.random_string(4, 6)}.{archive_format}"
+        )
+
+    def _header(self, member):
+        tarinfo = tarfile.TarInfo(member["arcname"])
+        tarinfo.size = member["size"]
+        # A float mtime would need a pax header for every file
+        tarinfo.mtime = int(member["mtime"])
+        tarinfo.mode = stat.S_IMODE(member["mode"])
+        return tarinfo.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+
+    def _compressor(self):
+        level = self.compresslevels[self.compression]
+        if self.compression == "gz":
+            return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return zstd.ZstdCompressor(level=level)
+
+    def generate(self, processed_size_callback=None, chunker=None):
+        """
+        Generate the tar archive, yielding it a chunk at a time. It takes the same
+        arguments as ZipStream.generate().
+        """
+        chunks = self._generate_tar(processed_size_callback, chunker)
+        if not self.compression:
+            yield from chunks
+            return
+
+        compressor = self._compressor()
+        try:
+            for chunk in chunks:
+                chunk = compressor.compress(chunk)
+                if chunk:
+                    yield chunk
+            yield compressor.flush()
+        finally:
+            chunks.close()
+
+    def _generate_tar(self, processed_size_callback, chunker):
+        offset = 0
+        processed_size = 0
+
+        for member in self.members:
+            header = self._header(member)
+            offset += len(header)
+            yield header
+
+            # The size is already in the header, so exactly that much gets sent
+            bytes_left = member["size"]
+            with open(member["filename"], "rb") as f:
+                while bytes_left > 0:
+                    if chunker is not None:
+                        size = chunker.next_size()
+                    else:
+                        size = self.chunk_size
+                    chunk = f.read(min(size, bytes_left))
+                    if not chunk:
+                        raise IOError(
+                            f"{member['filename']} changed while it was being shared"
+                        )
+                    bytes_left -= len(chunk)
+                    processed_size += len(chunk)
+                    offset += len(chunk)
+                    yield chunk
+                    if processed_size_callback is not None:
+                        processed_size_callback(processed_size)
+
+            remainder = member["size"] % tarfile.BLOCKSIZE
+            if remainder:
+                offset += tarfile.BLOCKSIZE - remainder
+                yield tarfile.NUL * (tarfile.BLOCKSIZE - remainder)
+
+        # The end of the archive is two empty blocks, padded to a whole record
+        end = tarfile.NUL * (2 * tarfile.BLOCKSIZE)
+        offset += len(end)
+        remainder = offset % tarfile.RECORDSIZE
+        if remainder:
+            end += tarfile.NUL * (tarfile.RECORDSIZE - remainder)
+        yield end
+
+        if processed_size_callback is not None:
+            processed_size_callback(processed_size)
@@ -22,6 +22,8 @@ import unicodedata
 from flask import request, render_template, make_response, jsonify, session
 from flask_socketio import emit, ConnectionRefusedError
 
+from .transfers import TransferRegistry
+
 
 class ChatModeWeb:
     """
@@ -38,7 +40,7 @@ class ChatModeWeb:
         self.connected_users = []
 
         # This tracks the history id
-        self.cur_history_id = 0
+        self.transfers = TransferRegistry(self.web.stop_q, self.web.events)
 
         # Whether or not we can send REQUEST_INDIVIDUAL_FILE_STARTED
         # and maybe other events when requests come in to this mode
@@ -94,8 +96,7 @@ class ChatModeWeb:
 
         @self.web.app.route("/", methods=["GET"], provide_automatic_options=False)
         def index():
-            history_id = self.cur_history_id
-            self.cur_history_id += 1
+            history_id = self.transfers.new_history_id()
             session["name"] = (
                 session.get("name")
                 if session.get("name")
@@ -120,7 +121,7 @@ class ChatModeWeb:
             provide_automatic_options=False,
         )
         def update_session_username():
-            history_id = self.cur_history_id
+            history_id = self.transfers.history_count
             data = request.get_json()
             username = data.get("username", session.get("name")).strip()
             if self.validate_username(username):
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""
+OnionShare | https://onionshare.org/
+
+Copyright (C) 2014-2022 Micah Lee, et al. <micah@micahflee.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import mimetypes
+import os
+import sys
+import zlib
+
+# brotli and zstd come with flask-compress, but don't count on them
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    if sys.version_info >= (3, 14):
+        from compression import zstd
+    else:
+        from backports import zstd
+except ImportError:
+    zstd = None
+
+# Files of these types are already compressed, so compressing them again just
+# burns CPU without making them any smaller
+COMPRESSED_MIMETYPES = {
+    "application/epub+zip",
+    "application/gzip",
+    "application/java-archive",
+    "application/pdf",
+    "application/vnd.android.package-archive",
+    "application/vnd.ms-cab-compressed",
+    "application/vnd.oasis.opendocument.presentation",
+    "application/vnd.oasis.opendocument.spreadsheet",
+    "application/vnd.oasis.opendocument.text",
+    "application/vnd.openxmlformats-officedocument.presentationml.presentation",
+    "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    "application/vnd.rar",
+    "application/x-7z-compressed",
+    "application/x-bzip",
+    "application/x-bzip2",
+    "application/x-compress",
+    "application/x-gzip",
+    "application/x-lzip",
+    "application/x-lzma",
+    "application/x-rar-compressed",
+    "application/x-xz",
+    "application/zip",
+    "application/zstd",
+}
+
+# Images, audio and video are compressed, except for these raw formats
+UNCOMPRESSED_MEDIA_MIMETYPES = {
+    "audio/wav",
+    "audio/x-aiff",
+    "audio/x-wav",
+    "image/bmp",
+    "image/svg+xml",
+    "image/tiff",
+    "image/x-icon",
+    "image/x-ms-bmp",
+    "image/x-portable-anymap",
+    "image/x-portable-bitmap",
+    "image/x-portable-graymap",
+    "image/x-portable-pixmap",
+    "image/x-xbitmap",
+    "image/x-xpixmap",
+}
+
+# Compressed or encrypted formats that mimetypes doesn't know about
+COMPRESSED_EXTENSIONS = {
+    ".age",
+    ".apk",
+    ".avif",
+    ".br",
+    ".dmg",
+    ".flac",
+    ".gpg",
+    ".heic",
+    ".jxl",
+    ".lz4",
+    ".mkv",
+    ".opus",
+    ".pgp",
+    ".rar",
+    ".tgz",
+    ".txz",
+    ".webm",
+    ".webp",
+    ".xz",
+    ".zst",
+}
+
+# How much of the start of the file to trial compress, when the type doesn't say
+SAMPLE_SIZE = 1 << 16  # 64kB
+
+# If the sample doesn't shrink to at least this fraction of its size, don't bother
+RATIO_THRESHOLD = 0.9
+
+
+def is_compressed_type(filename):
+    """
+    Returns True if the filename says the file is already compressed, False if it
+    says the file is text or otherwise compressible, and None if it doesn't say.
+    """
+    extension = os.path.splitext(filename)[1].lower()
+    if extension in COMPRESSED_EXTENSIONS:
+        return True
+
+    (content_type, encoding) = mimetypes.guess_type(filename, strict=False)
+    if encoding is not None:
+        # For example .tar.gz, .svgz
+        return True
+    if content_type is None:
+        return None
+    if content_type in COMPRESSED_MIMETYPES:
+        return True
+    if content_type.startswith(("image/", "audio/", "video/")):
+        return content_type not in UNCOMPRESSED_MEDIA_MIMETYPES
+    if content_type.startswith("text/") or content_type.endswith(("+xml", "+json")):
+        return False
+    return None
+
+
+def sample_ratio(filename, sample_size=SAMPLE_SIZE):
+    """
+    Trial compress the start of the file with the fastest compression level, and
+    return how much it shrank as the fraction compressed size / original size.
+    """
+    with open(filename, "rb") as f:
+        sample = f.read(sample_size)
+    if not sample:
+        return 1.0
+    compressed = zlib.compress(sample, 1)
+    return len(compressed) / len(sample)
+
+
+def should_compress(filename):
+    """
+    Decide whether it's worth compressing a file, first by looking at its type and
+    then, if that isn't conclusive, by trial compressing a sample of it.
+    """
+    compressed_type = is_compressed_type(filename)
+    if compressed_type is not None:
+        return not compressed_type
+
+    try:
+        return sample_ratio(filename) < RATIO_THRESHOLD
+    except OSError:
+        # Let the code that actually reads the file deal with the error
+        return True
+
+
+# Content-encodings for individual files, from most to least preferred when a
+# browser accepts them equally. brotli and zstd make text noticeably smaller than
+# gzip does, and over Tor every byte counts.
+ENCODINGS = ["br", "zstd", "gzip"]
+
+# The levels are high because each file only gets compressed once, but small files
+# get compressed while the request waits. zstd's levels above 9 get much slower
+# for very little gain, and at 9 it's still quicker than gzip at 6.
+ENCODING_LEVELS = {"br": 9, "zstd": 9, "gzip": 6}
+
+
+def available_encodings():
+    """
+    The content-encodings that can be used, in order of preference
+    """
+    encodings = []
+    for encoding in ENCODINGS:
+        if encoding == "br" and brotli is None:
+            continue
+        if encoding == "zstd" and zstd is None:
+            continue
+        encodings.append(encoding)
+    return encodings
+
+
+def negotiate_encoding(accept_encoding, encodings):
+    """
+    Choose the content-encoding to send, given the Accept-Encoding header and the
+    encodings that are available in order of preference. Returns None to send the
+    file as it is.
+    """
+    qualities = {}
+    for part in (accept_encoding or "").lower().split(","):
+        coding, _, params = part.partition(";")
+        coding = coding.strip()
+        if not coding:
+            continue
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        qualities[coding] = quality
+
+    best = None
+    best_quality = 0.0
+    for encoding in encodings:
+        quality = qualities.get(encoding, qualities.get("*", 0.0))
+        if quality > best_quality:
+            best = encoding
+            best_quality = quality
+    return best
+
+
+def compressor(encoding):
+    """
+    Make a streaming compressor for a content-encoding other than gzip. It has the
+    same compress(data) and flush() methods as a zlib compressor.
+    """
+    level = ENCODING_LEVELS[encoding]
+    if encoding == "br":
+        return BrotliCompressor(level)
+    if encoding == "zstd":
+        return zstd.ZstdCompressor(level=level)
+    raise ValueError(f"Unknown encoding {encoding}")
+
+
+class BrotliCompressor(object):
+    def __init__(self, quality):
+        self.compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data):
+        return self.compressor.process(data)
+
+    def flush(self):
+        return self.compressor.finish()
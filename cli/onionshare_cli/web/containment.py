@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+OnionShare | https://onionshare.org/
+
+Copyright (C) 2014-2022 Micah Lee, et al. <micah@micahflee.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import stat
+
+
+class ContainmentCache(object):
+    """
+    Checks whether paths are inside of the selected root directories once symlinks
+    are resolved, so symlinks can't be used to share files from outside of them.
+
+    Resolving a path with os.path.realpath() takes a syscall for each part of it.
+    A file that isn't a symlink is contained if its directory is, so only
+    directories get resolved, once each, and the result is remembered along with
+    the device and inode that the directory's path leads to. If a directory, or
+    one above it, gets replaced by a symlink to somewhere else, its path leads to a
+    different inode, and it gets resolved again.
+    """
+
+    def __init__(self, roots):
+        """
+        roots are the canonical paths of the selected root directories. If there
+        are none, everything is contained.
+        """
+        self.roots = roots
+
+        # Directories that have been resolved, as (st_dev, st_ino, contained)
+        self.dirs = {}
+
+    def is_contained(self, path):
+        """
+        Whether a file or directory is inside of the selected roots
+        """
+        if not self.roots:
+            return True
+
+        try:
+            st = os.lstat(path)
+        except OSError:
+            return self._resolve(path)
+        if stat.S_ISLNK(st.st_mode):
+            return self._resolve(path)
+        if stat.S_ISDIR(st.st_mode):
+            return self.is_dir_contained(path)
+        return self.is_dir_contained(os.path.dirname(path))
+
+    def is_dir_contained(self, dirname):
+        """
+        Whether a directory, and so every file in it that isn't a symlink, is
+        inside of the selected roots
+        """
+        if not self.roots:
+            return True
+
+        try:
+            st = os.stat(dirname)
+        except OSError:
+            return False
+        entry = self.dirs.get(dirname)
+        if entry is None or entry[:2] != (st.st_dev, st.st_ino):
+            entry = (st.st_dev, st.st_ino, self._resolve(dirname))
+            self.dirs[dirname] = entry
+        return entry[2]
+
+    def _resolve(self, path):
+        resolved_path = os.path.realpath(path)
+        for root in self.roots:
+            if resolved_path.startswith(root + os.sep) or resolved_path == root:
+                return True
+        return False
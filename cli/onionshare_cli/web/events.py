@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+"""
+OnionShare | https://onionshare.org/
+
+Copyright (C) 2014-2022 Micah Lee, et al. <micah@micahflee.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import collections
+import queue
+import sys
+import threading
+from urllib.parse import unquote
+
+# Event types
+REQUEST_LOAD = 0
+REQUEST_STARTED = 1
+REQUEST_PROGRESS = 2
+REQUEST_CANCELED = 3
+REQUEST_UPLOAD_INCLUDES_MESSAGE = 4
+REQUEST_UPLOAD_FILE_RENAMED = 5
+REQUEST_UPLOAD_SET_DIR = 6
+REQUEST_UPLOAD_FINISHED = 7
+REQUEST_UPLOAD_CANCELED = 8
+REQUEST_INDIVIDUAL_FILE_STARTED = 9
+REQUEST_INDIVIDUAL_FILE_PROGRESS = 10
+REQUEST_INDIVIDUAL_FILE_CANCELED = 11
+REQUEST_ERROR_DATA_DIR_CANNOT_CREATE = 12
+REQUEST_OTHER = 13
+REQUEST_TRANSFER_FINISHED = 14
+
+# Progress events of the same transfer replace each other, since only the
+# latest one matters
+PROGRESS_TYPES = {REQUEST_PROGRESS, REQUEST_INDIVIDUAL_FILE_PROGRESS}
+
+
+class Event(object):
+    """
+    Something that happened in the web server. It can also be read like a dict,
+    event["type"], event["path"] and event["data"].
+    """
+
+    __slots__ = ("type", "path", "data")
+
+    def __init__(self, type, path=None, data=None):
+        self.type = type
+        self.path = path
+        self.data = data
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __repr__(self):
+        return f"Event({self.type!r}, {self.path!r}, {self.data!r})"
+
+
+class EventBus(object):
+    """
+    Passes each event on to the consumers that are subscribed to it, in the thread
+    that published it. A consumer is anything with a put(event) method. If there
+    aren't any consumers, events don't get stored anywhere.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.consumers = []
+
+    def subscribe(self, consumer):
+        with self.lock:
+            self.consumers = self.consumers + [consumer]
+        return consumer
+
+    def unsubscribe(self, consumer):
+        with self.lock:
+            self.consumers = [c for c in self.consumers if c is not consumer]
+
+    def publish(self, event):
+        # Subscribing replaces the list, so it can be read without the lock
+        for consumer in self.consumers:
+            consumer.put(event)
+
+
+class EventQueue(object):
+    """
+    A bounded queue of events, for consumers like the GUI that read them in their
+    own time. If a progress event of a transfer is still waiting to be read, a new
+    one replaces it. If the queue is full anyway, the oldest event is dropped.
+
+    Like queue.Queue, get(False) raises queue.Empty when there are no events.
+    """
+
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.events = collections.deque()
+
+        # Progress events in the queue, by (type, history id)
+        self.pending_progress = {}
+
+        # How many events were dropped because the queue was full
+        self.dropped = 0
+
+    def _progress_key(self, event):
+        if event.type in PROGRESS_TYPES and event.data and "id" in event.data:
+            return (event.type, event.data["id"])
+        return None
+
+    def put(self, event):
+        with self.lock:
+            key = self._progress_key(event)
+            if key is not None:
+                pending = self.pending_progress.get(key)
+                if pending is not None:
+                    pending.path = event.path
+                    pending.data = event.data
+                    return
+                event = Event(event.type, event.path, event.data)
+                self.pending_progress[key] = event
+
+            if len(self.events) >= self.maxsize:
+                self._forget(self.events.popleft())
+                self.dropped += 1
+
+            self.events.append(event)
+            self.not_empty.notify()
+
+    def get(self, block=True, timeout=None):
+        with self.lock:
+            if block and not self.events:
+                self.not_empty.wait_for(lambda: self.events, timeout)
+            if not self.events:
+                raise queue.Empty
+            event = self.events.popleft()
+            self._forget(event)
+            return event
+
+    def _forget(self, event):
+        key = self._progress_key(event)
+        if key is not None and self.pending_progress.get(key) is event:
+            del self.pending_progress[key]
+
+    def qsize(self):
+        with self.lock:
+            return len(self.events)
+
+    def empty(self):
+        return self.qsize() == 0
+
+
+class ProgressPrinter(object):
+    """
+    Prints the progress of downloads to stdout, for share and website mode.
+    """
+
+    def __init__(self, common, settings, mode):
+        self.common = common
+        self.settings = settings
+        self.mode = mode
+
+    def put(self, event):
+        if event.type in PROGRESS_TYPES:
+            if "bytes" not in event.data:
+                # Upload progress is printed by receive mode itself
+                return
+            total_bytes = event.data.get("total_bytes", event.data.get("filesize"))
+            self.print_progress(event.path, event.data["bytes"], total_bytes)
+            if event.data["bytes"] == total_bytes:
+                sys.stdout.write("\n")
+        elif event.type in (REQUEST_CANCELED, REQUEST_INDIVIDUAL_FILE_CANCELED):
+            sys.stdout.write("\n")
+
+    def print_progress(self, path, downloaded_bytes, total_bytes):
+        if total_bytes:
+            percent = (1.0 * downloaded_bytes / total_bytes) * 100
+        else:
+            percent = 100.0
+
+        if self.settings.get(self.mode, "log_filenames"):
+            # Decode and sanitize the path to remove newlines
+            decoded_path = unquote(path)
+            decoded_path = decoded_path.replace("\r", "").replace("\n", "")
+            filename_str = f"{decoded_path} - "
+        else:
+            filename_str = ""
+
+        sys.stdout.write(
+            "\r{0}{1:s}, {2:.2f}%          ".format(
+                filename_str,
+                self.common.human_readable_filesize(downloaded_bytes),
+                percent,
+            )
+        )
+        sys.stdout.flush()
+
+
+class EventMetrics(object):
+    """
+    Counts events and bytes sent, without keeping the events themselves. Progress
+    is measured from the start of the file, so a range request that starts in the
+    middle counts the bytes before it too.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = collections.Counter()
+        self.bytes_sent = 0
+
+        # The progress of transfers in progress, by (type, history id)
+        self.progress = {}
+
+    def put(self, event):
+        with self.lock:
+            self.counts[event.type] += 1
+
+            if event.type in PROGRESS_TYPES and "bytes" in event.data:
+                key = (event.type, event.data["id"])
+                total_bytes = event.data.get("total_bytes", event.data.get("filesize"))
+                sent = event.data["bytes"] - self.progress.get(key, 0)
+                self.bytes_sent += max(0, sent)
+                if event.data["bytes"] == total_bytes:
+                    self.progress.pop(key, None)
+                else:
+                    self.progress[key] = event.data["bytes"]
+
+            elif event.type == REQUEST_CANCELED:
+                self.progress.pop((REQUEST_PROGRESS, event.data["id"]), None)
+            elif event.type == REQUEST_INDIVIDUAL_FILE_CANCELED:
+                self.progress.pop(
+                    (REQUEST_INDIVIDUAL_FILE_PROGRESS, event.data["id"]), None
+                )
+            elif event.type == REQUEST_TRANSFER_FINISHED:
+                # Ranges and partial downloads never reach their total, so forget
+                # them once they're over
+                for progress_type in PROGRESS_TYPES:
+                    self.progress.pop((progress_type, event.data["id"]), None)
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+OnionShare | https://onionshare.org/
+
+Copyright (C) 2014-2022 Micah Lee, et al. <micah@micahflee.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import hashlib
+import os
+import queue
+import threading
+
+
+class HashCache(object):
+    """
+    The SHA-256 hashes of the files being shared, so people can check the files
+    they downloaded. Hashing a big share takes a while, so files get hashed by
+    background threads the first time they're asked for, and until then they don't
+    have a hash. Hashes are kept until the file's size, mtime or inode changes.
+    """
+
+    # The number of threads hashing files
+    workers = 2
+
+    # Files are read this many bytes at a time
+    chunk_size = 1024 * 1024  # 1mb
+
+    def __init__(self, common, workers=None):
+        self.common = common
+        if workers is not None:
+            self.workers = workers
+
+        self.lock = threading.Lock()
+
+        # The hex SHA-256 of each file, along with the key of the file it was made
+        # from, as (key, sha256)
+        self.hashes = {}
+
+        # Files that are waiting to get hashed
+        self.pending = set()
+
+        # Clearing the cache starts a new generation, so the background threads
+        # forget about files of the old one
+        self.generation = 0
+        self.queue = queue.Queue()
+        self.threads = []
+
+    @staticmethod
+    def file_key(st):
+        return (st.st_size, st.st_mtime_ns, st.st_ino)
+
+    def get(self, filename, st):
+        """
+        The hex SHA-256 of a file, given the result of os.stat(), or None if it
+        hasn't been hashed yet. Files that haven't get hashed in the background.
+        """
+        key = self.file_key(st)
+        with self.lock:
+            cached = self.hashes.get(filename)
+            if cached is not None and cached[0] == key:
+                return cached[1]
+            if filename not in self.pending:
+                self.pending.add(filename)
+                self.queue.put((self.generation, filename))
+                if len(self.threads) < self.workers:
+                    thread = threading.Thread(target=self._worker, daemon=True)
+                    thread.start()
+                    self.threads.append(thread)
+        return None
+
+    def clear(self):
+        """
+        Forget all of the hashes, when the files being shared change
+        """
+        with self.lock:
+            self.generation += 1
+            self.hashes = {}
+            self.pending = set()
+
+    def _worker(self):
+        while True:
+            generation, filename = self.queue.get()
+            try:
+                self._hash(generation, filename)
+            finally:
+                self.queue.task_done()
+
+    def _hash(self, generation, filename):
+        with self.lock:
+            if generation != self.generation:
+                return
+
+        hasher = hashlib.sha256()
+        try:
+            with open(filename, "rb") as f:
+                key = self.file_key(os.fstat(f.fileno()))
+                while True:
+                    chunk = f.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    hasher.update(chunk)
+                changed = self.file_key(os.fstat(f.fileno())) != key
+        except OSError as e:
+            self.common.log("HashCache", "_hash", f"failed to hash: {e}")
+            changed = True
+
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.pending.discard(filename)
+            if not changed:
+                self.hashes[filename] = (key, hasher.hexdigest())
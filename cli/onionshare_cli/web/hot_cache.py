@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+OnionShare | https://onionshare.org/
+
+Copyright (C) 2014-2022 Micah Lee, et al. <micah@micahflee.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import collections
+import io
+import mimetypes
+import os
+import threading
+
+
+class HotFileCache(object):
+    """
+    Keeps small files in memory, along with their compressed variants, ETag and
+    MIME type, so the stylesheets, scripts and icons that every page of a website
+    asks for don't have to be read from disk each time. A file is read again when
+    its size, mtime or inode changes, and when the files take up more than budget
+    bytes, the least recently used ones are dropped.
+    """
+
+    budget = 32 * 1024 * 1024  # 32mb
+
+    # Only files up to this size are kept in memory
+    max_size = 256 * 1024  # 256kb
+
+    def __init__(self, variant_cache, file_etag, budget=None):
+        """
+        Compressed variants come from variant_cache, and file_etag(st) makes the
+        ETag of a file that's sent as it is.
+        """
+        self.variant_cache = variant_cache
+        self.file_etag = file_etag
+        if budget is not None:
+            self.budget = budget
+
+        self.lock = threading.Lock()
+
+        # Each entry is a dict with the key of the file, its data, ETag and
+        # content type, and its variants by encoding: (data, etag), or None if
+        # it's not worth compressing. The most recently used ones are at the end.
+        self.entries = collections.OrderedDict()
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def file_key(st):
+        return (st.st_size, st.st_mtime_ns, st.st_ino)
+
+    def get(self, filename, st):
+        """
+        Get the entry of a file, given the result of os.stat(), reading it into
+        memory if it isn't already. Returns None if the file is too big to keep.
+        """
+        if st.st_size > self.max_size:
+            return None
+
+        key = self.file_key(st)
+        with self.lock:
+            entry = self.entries.get(filename)
+            if entry is not None and entry["key"] == key:
+                self.entries.move_to_end(filename)
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+        try:
+            with open(filename, "rb") as f:
+                data = f.read()
+                if self.file_key(os.fstat(f.fileno())) != key:
+                    # It changed since it was stat'ed, so send it from disk
+                    return None
+        except OSError:
+            return None
+
+        (content_type, _) = mimetypes.guess_type(filename, strict=False)
+        entry = {
+            "key": key,
+            "data": data,
+            "etag": self.file_etag(st),
+            "content_type": content_type,
+            "variants": {},
+            "size": len(data),
+        }
+        with self.lock:
+            self._remove(filename)
+            self.entries[filename] = entry
+            self.size += entry["size"]
+            self._evict()
+        return entry
+
+    def open(self, entry):
+        """
+        Open the data of a file as it is
+        """
+        return io.BytesIO(entry["data"])
+
+    def open_variant(self, filename, st, entry, encoding):
+        """
+        Open the variant of a file compressed with encoding. Returns the tuple
+        (fp, variant_filesize, variant_etag) like VariantCache.open(), or None if
+        it's not worth compressing.
+        """
+        with self.lock:
+            if encoding in entry["variants"]:
+                variant = entry["variants"][encoding]
+                if variant is None:
+                    return None
+                data, etag = variant
+                return io.BytesIO(data), len(data), etag
+
+        variant_info = self.variant_cache.open(filename, st, encoding)
+        if variant_info is None:
+            variant = None
+        else:
+            fp, _, etag = variant_info
+            with fp:
+                variant = (fp.read(), etag)
+
+        with self.lock:
+            if self.entries.get(filename) is entry:
+                entry["variants"][encoding] = variant
+                if variant is not None:
+                    entry["size"] += len(variant[0])
+                    self.size += len(variant[0])
+                    self._evict()
+
+        if variant is None:
+            return None
+        return io.BytesIO(variant[0]), len(variant[0]), variant[1]
+
+    def _remove(self, filename):
+        """
+        Call with the lock held
+        """
+        entry = self.entries.pop(filename, None)
+        if entry is not None:
+            self.size -= entry["size"]
+
+    def _evict(self):
+        """
+        Drop the least recently used files until they fit in the budget. Call with
+        the lock held.
+        """
+        while self.size > self.budget and self.entries:
+            filename = next(iter(self.entries))
+            self._remove(filename)
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+OnionShare | https://onionshare.org/
+
+Copyright (C) 2014-2022 Micah Lee, et al. <micah@micahflee.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import collections
+import threading
+import time
+
+
+class ListingCache(object):
+    """
+    Keeps the files and directories of directory listings, and optionally the
+    rendered pages, so browsing a big folder doesn't mean listing and stat'ing
+    everything in it on every visit. A listing gets made again when the mtime of
+    its directory changes, which happens whenever something in it is added,
+    removed or renamed. When the listings take up more than budget bytes, the
+    least recently used ones are dropped.
+
+    Sizes of files that changed without anything being added, removed or renamed
+    can be out of date, since that doesn't change the directory's mtime.
+    """
+
+    budget = 64 * 1024 * 1024  # 64mb
+
+    # Roughly how many bytes each file or directory in a listing takes
+    item_size = 300
+
+    # Directories that changed less than this many seconds before they were
+    # listed could change again without their mtime changing, so their listings
+    # aren't kept
+    racy_seconds = 2
+
+    def __init__(self, budget=None):
+        if budget is not None:
+            self.budget = budget
+
+        self.lock = threading.Lock()
+
+        # Each entry is a dict with the key of the directory, its files and
+        # directories, and the rendered page, or None. They're keyed by the
+        # directory's filesystem path and its path in URLs, and the most recently
+        # used ones are at the end.
+        self.entries = collections.OrderedDict()
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def dir_key(st):
+        return (st.st_mtime_ns, st.st_ino, st.st_size)
+
+    def get(self, filesystem_path, path, st):
+        """
+        Get the listing of a directory, given the result of os.stat(), or None if
+        it has to be made again
+        """
+        with self.lock:
+            entry = self.entries.get((filesystem_path, path))
+            if entry is not None and entry["key"] == self.dir_key(st):
+                self.entries.move_to_end((filesystem_path, path))
+                self.hits += 1
+                return entry
+            self.misses += 1
+            return None
+
+    def put(self, filesystem_path, path, st, files, dirs):
+        """
+        Keep the listing of a directory, given the result of os.stat() from before
+        it was listed. Returns the entry.
+        """
+        entry = {
+            "cache_key": (filesystem_path, path),
+            "key": self.dir_key(st),
+            "files": files,
+            "dirs": dirs,
+            "html": None,
+            "size": self.item_size * (len(files) + len(dirs)),
+        }
+        with self.lock:
+            self._remove((filesystem_path, path))
+            if time.time() - st.st_mtime < self.racy_seconds:
+                return entry
+            self.entries[(filesystem_path, path)] = entry
+            self.size += entry["size"]
+            self._evict()
+        return entry
+
+    def set_html(self, entry, html):
+        """
+        Keep the rendered page of a listing
+        """
+        with self.lock:
+            if entry["html"] is None and self.entries.get(entry["cache_key"]) is entry:
+                entry["html"] = html
+                entry["size"] += len(html)
+                self.size += len(html)
+                self._evict()
+
+    def clear(self):
+        """
+        Forget all of the listings, when the files being shared change
+        """
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def _remove(self, cache_key):
+        """
+        Call with the lock held
+        """
+        entry = self.entries.pop(cache_key, None)
+        if entry is not None:
+            self.size -= entry["size"]
+
+    def _evict(self):
+        """
+        Drop the least recently used listings until they fit in the budget. Call
+        with the lock held.
+        """
+        while self.size > self.budget and self.entries:
+            self._remove(next(iter(self.entries)))
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+OnionShare | https://onionshare.org/
+
+Copyright (C) 2014-2022 Micah Lee, et al. <micah@micahflee.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import array
+import bisect
+import collections.abc
+import os
+import threading
+
+
+class PathIndex(collections.abc.Mapping):
+    """
+    Maps the paths of the files and directories of a share, as they appear in
+    URLs like "folder/file.txt", to where they are on disk. It's read like a dict.
+
+    Rather than keeping two full path strings for every file, it keeps a tree.
+    Each file and directory is a node, numbered in the order it was found, with
+    the number of its parent directory. Each directory keeps the names of its
+    children in a sorted tuple, and they're numbered consecutively in that order,
+    so looking a path up is a binary search for each part of it, and a node's name
+    is found through its parent.
+
+    Symlinks are left out. is_contained() gets asked once about each directory,
+    and the ones that it says are outside of the share look empty. If lazy is
+    True, a directory is only scanned the first time something inside of it is
+    looked up.
+    """
+
+    def __init__(self, is_contained=None, lazy=False):
+        self.is_contained = is_contained
+        self.lazy = lazy
+
+        self.parents = array.array("i")
+        self.is_dir = bytearray()
+
+        # The top level nodes by their name in URLs, and their filesystem paths
+        self.roots = {}
+        self.root_paths = {}
+
+        # The children of the directories that have been scanned, as a tuple of
+        # sorted names and the node of the first one
+        self.children = {}
+
+        # Scanning is the only thing that changes the index after it's built, and
+        # with lazy indexes that happens in the threads handling requests
+        self.lock = threading.Lock()
+
+    def add_file(self, name, filesystem_path):
+        """
+        Add a file at the top level of the share
+        """
+        node = self._add_node(-1, False)
+        self.roots[name] = node
+        self.root_paths[node] = filesystem_path
+
+    def add_dir(self, name, filesystem_path):
+        """
+        Add a directory at the top level of the share, with everything in it
+        """
+        node = self._add_node(-1, True)
+        self.roots[name] = node
+        self.root_paths[node] = filesystem_path
+        if not self.lazy:
+            stack = [node]
+            while stack:
+                names, first = self._children(stack.pop())
+                for child in range(first, first + len(names)):
+                    if self.is_dir[child]:
+                        stack.append(child)
+
+    def lookup(self, path):
+        """
+        Return the node of a path, or None if it's not in the share
+        """
+        parts = path.split("/")
+        node = self.roots.get(parts[0])
+        for part in parts[1:]:
+            if node is None or not self.is_dir[node]:
+                return None
+            names, first = self._children(node)
+            i = bisect.bisect_left(names, part)
+            if i == len(names) or names[i] != part:
+                return None
+            node = first + i
+        return node
+
+    def filesystem_path(self, node):
+        """
+        Where a node is on disk
+        """
+        parts = []
+        while self.parents[node] != -1:
+            parent = self.parents[node]
+            names, first = self.children[parent]
+            parts.append(names[node - first])
+            node = parent
+        parts.append(self.root_paths[node])
+        return os.path.join(*reversed(parts))
+
+    def walk(self):
+        """
+        Yield (path, filesystem_path) for everything in the share, sorted by name
+        within each directory. Lazy indexes get scanned completely.
+        """
+        stack = sorted(self.roots.items(), reverse=True)
+        while stack:
+            path, node = stack.pop()
+            yield path, self.filesystem_path(node)
+            if self.is_dir[node]:
+                names, first = self._children(node)
+                for i in reversed(range(len(names))):
+                    stack.append((f"{path}/{names[i]}", first + i))
+
+    def values(self):
+        return (filesystem_path for _, filesystem_path in self.walk())
+
+    def items(self):
+        return self.walk()
+
+    def __getitem__(self, path):
+        node = self.lookup(path)
+        if node is None:
+            raise KeyError(path)
+        return self.filesystem_path(node)
+
+    def __contains__(self, path):
+        return isinstance(path, str) and self.lookup(path) is not None
+
+    def __iter__(self):
+        return (path for path, _ in self.walk())
+
+    def __len__(self):
+        return sum(1 for _ in self.walk())
+
+    def _add_node(self, parent, is_dir):
+        node = len(self.parents)
+        self.parents.append(parent)
+        self.is_dir.append(is_dir)
+        return node
+
+    def _children(self, node):
+        children = self.children.get(node)
+        if children is not None:
+            return children
+
+        filesystem_path = self.filesystem_path(node)
+        entries = []
+        if self.is_contained is None or self.is_contained(filesystem_path):
+            try:
+                with os.scandir(filesystem_path) as it:
+                    for entry in it:
+                        try:
+                            if entry.is_symlink():
+                                continue
+                            is_dir = entry.is_dir(follow_symlinks=False)
+                        except OSError:
+                            continue
+                        entries.append((entry.name, is_dir))
+            except OSError:
+                # Treat directories that can't be read as empty
+                pass
+        entries.sort()
+
+        with self.lock:
+            children = self.children.get(node)
+            if children is None:
+                first = len(self.parents)
+                for _, is_dir in entries:
+                    self._add_node(node, is_dir)
+                children = (tuple(name for name, _ in entries), first)
+                self.children[node] = children
+        return children
@@ -27,6 +27,8 @@ from datetime import datetime
 from flask import Request, request, render_template, make_response, flash, redirect
 from werkzeug.utils import secure_filename
 
+from .transfers import TransferRegistry
+
 # Receive mode uses a special flask requests object, ReceiveModeRequest, in
 # order to keep track of upload progress. Here's what happens when someone
 # uploads files:
@@ -36,7 +38,7 @@ from werkzeug.utils import secure_filename
 #   - creates empty self.progress = dict, which will map uploaded files to their upload progress
 # - ReceiveModeRequest._get_file_stream
 #   - called for each file that gets upload
-#   - the first time, send REQUEST_STARTED to GUI, and append to self.web.receive_mode.uploads_in_progress
+#   - the first time, send REQUEST_STARTED to GUI, and start a transfer in self.web.receive_mode.transfers
 #   - updates self.progress[self.filename] for the current file
 #   - uses custom ReceiveModeFile to save file to disk
 #   - ReceiveModeRequest.file_write_func called on each write
@@ -45,7 +47,7 @@ from werkzeug.utils import secure_filename
 #     - self.progress[filename]["complete"] = True
 #  - ReceiveModeRequest.close
 #     - send either REQUEST_UPLOAD_CANCELED or REQUEST_UPLOAD_FINISHED to GUI
-#     - remove from self.web.receive_mode.uploads_in_progress
+#     - finish the transfer
 
 
 class ReceiveModeWeb:
@@ -60,10 +62,9 @@ class ReceiveModeWeb:
         self.web = web
 
         self.can_upload = True
-        self.uploads_in_progress = []
 
-        # This tracks the history id
-        self.cur_history_id = 0
+        # This tracks the history ids and the uploads in progress
+        self.transfers = TransferRegistry(self.web.stop_q, self.web.events)
 
         # Whether or not we can send REQUEST_INDIVIDUAL_FILE_STARTED
         # and maybe other events when requests come in to this mode
@@ -78,8 +79,7 @@ class ReceiveModeWeb:
 
         @self.web.app.route("/", methods=["GET"], provide_automatic_options=False)
         def index():
-            history_id = self.cur_history_id
-            self.cur_history_id += 1
+            history_id = self.transfers.new_history_id()
             self.web.add_request(
                 self.web.REQUEST_INDIVIDUAL_FILE_STARTED,
                 request.path,
@@ -402,13 +402,13 @@ class ReceiveModeRequest(Request):
 
             # A dictionary that maps filenames to the bytes uploaded so far
             self.progress = {}
+            self.uploaded_bytes = 0
 
             # Prevent new uploads if we've said so (timer expired)
             if self.web.receive_mode.can_upload:
 
                 # Create an history_id, attach it to the request
-                self.history_id = self.web.receive_mode.cur_history_id
-                self.web.receive_mode.cur_history_id += 1
+                self.history_id = self.web.receive_mode.transfers.new_history_id()
 
                 # Figure out the content length
                 try:
@@ -534,7 +534,9 @@ class ReceiveModeRequest(Request):
                     "content_length": self.content_length,
                 },
             )
-            self.web.receive_mode.uploads_in_progress.append(self.history_id)
+            self.transfer = self.web.receive_mode.transfers.start(
+                self.path, self.content_length, history_id=self.history_id
+            )
 
             self.told_gui_about_request = True
 
@@ -593,10 +595,11 @@ class ReceiveModeRequest(Request):
             if self.told_gui_about_request:
                 history_id = self.history_id
 
-                if not self.web.stop_q.empty() or (
+                canceled = self.transfer.is_canceled() or (
                     self.filename in self.progress
                     and not self.progress[self.filename]["complete"]
-                ):
+                )
+                if canceled:
                     # Inform the GUI that the upload has canceled
                     self.web.common.log(
                         "ReceiveModeRequest",
@@ -620,7 +623,7 @@ class ReceiveModeRequest(Request):
                         self.path,
                         {"id": history_id},
                     )
-                self.web.receive_mode.uploads_in_progress.remove(history_id)
+                self.transfer.finish(not canceled)
 
             # If no files were written to self.receive_mode_dir, delete it
             # Also delete if file uploads were rejected due to disable_files setting
@@ -653,26 +656,38 @@ class ReceiveModeRequest(Request):
 
         if self.upload_request:
             self.progress[filename]["uploaded_bytes"] += length
+            self.uploaded_bytes += length
 
             if self.previous_file != filename:
                 self.previous_file = filename
 
-            size_str = self.web.common.human_readable_filesize(
-                self.progress[filename]["uploaded_bytes"]
-            )
+            # Report the progress a few times a second at most
+            if self.told_gui_about_request and self.transfer.update(
+                self.uploaded_bytes
+            ):
+                self.report_progress(filename)
 
-            if self.web.common.verbose:
-                print(f"=> {size_str} {filename}")
-            else:
-                print(f"\r=> {size_str} {filename}          ", end="")
+    def report_progress(self, filename):
+        """
+        Display the upload progress in the CLI, and send it to the GUI
+        """
+        size_str = self.web.common.human_readable_filesize(
+            self.progress[filename]["uploaded_bytes"]
+        )
 
-            # Update the GUI on the upload progress
-            if self.told_gui_about_request:
-                self.web.add_request(
-                    self.web.REQUEST_PROGRESS,
-                    self.path,
-                    {"id": self.history_id, "progress": self.progress},
-                )
+        if self.web.common.verbose:
+            print(f"=> {size_str} {filename}")
+        else:
+            print(f"\r=> {size_str} {filename}          ", end="")
+
+        # Update the GUI on the upload progress. It gets a copy, since this
+        # thread keeps changing self.progress while the GUI reads it
+        progress = {name: dict(p) for name, p in self.progress.items()}
+        self.web.add_request(
+            self.web.REQUEST_PROGRESS,
+            self.path,
+            {"id": self.history_id, "progress": progress},
+        )
 
     def file_close_func(self, filename, upload_error=False):
         """
@@ -680,6 +695,11 @@ class ReceiveModeRequest(Request):
         """
         self.progress[filename]["complete"] = True
 
+        # Always report when a file is done
+        if self.upload_request and self.told_gui_about_request and not self.closed:
+            self.transfer.mark_reported()
+            self.report_progress(filename)
+
         # If the file tells us there was an upload error, let the request know as well
         if upload_error:
             self.upload_error = True
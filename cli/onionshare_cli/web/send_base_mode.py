@@ -18,14 +18,144 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import binascii
+import bisect
+import hashlib
 import os
-import sys
 import tempfile
 import mimetypes
 import gzip
-from flask import Response, request
+from datetime import datetime, timezone
+from flask import Response, request, abort, make_response
 from unidecode import unidecode
-from urllib.parse import quote, unquote
+from urllib.parse import quote
+from werkzeug.http import http_date, parse_date, parse_etags, unquote_etag
+
+from ..file_scan import FileScan
+from .containment import ContainmentCache
+from .compression import available_encodings, compressor, negotiate_encoding
+from .listing_cache import ListingCache
+from .path_index import PathIndex
+from .variant_cache import VariantCache
+from .transfers import (
+    ChunkIterator,
+    MultipartRangesFile,
+    ProgressFile,
+    TransferRegistry,
+)
+
+
+def format_etag(hasher):
+    """
+    Turn a SHA-256 hasher into an ETag
+    """
+    hash_value = binascii.hexlify(hasher.digest()).decode("utf-8")
+    return '"sha256:{}"'.format(hash_value)
+
+
+def parse_range_header(range_header: str, target_size: int) -> list:
+    end_index = target_size - 1
+    if range_header is None:
+        return [(0, end_index)]
+
+    bytes_ = "bytes="
+    if not range_header.startswith(bytes_):
+        abort(416)
+
+    ranges = []
+    for range_ in range_header[len(bytes_) :].split(","):
+        split = range_.split("-")
+        if len(split) == 1:
+            try:
+                start = int(split[0])
+                end = end_index
+            except ValueError:
+                abort(416)
+        elif len(split) == 2:
+            start, end = split[0], split[1]
+            if not start:
+                # parse ranges of the form "bytes=-100" (i.e., last 100 bytes)
+                end = end_index
+                try:
+                    start = max(0, end - int(split[1]) + 1)
+                except ValueError:
+                    abort(416)
+            else:
+                # parse ranges of the form "bytes=100-200"
+                try:
+                    start = int(start)
+                    if not end:
+                        end = target_size
+                    else:
+                        end = int(end)
+                except ValueError:
+                    abort(416)
+
+                if end < start:
+                    abort(416)
+
+                end = min(end, end_index)
+        else:
+            abort(416)
+
+        # Skip ranges that start after the end of the file
+        if start > end_index:
+            continue
+
+        ranges.append((start, end))
+
+    if not ranges:
+        abort(416)
+
+    # merge the ranges
+    merged = []
+    ranges = sorted(ranges, key=lambda x: x[0])
+    for range_ in ranges:
+        # initial case
+        if not merged:
+            merged.append(range_)
+        else:
+            # merge ranges that are adjacent or overlapping
+            if range_[0] <= merged[-1][1] + 1:
+                merged[-1] = (merged[-1][0], max(range_[1], merged[-1][1]))
+            else:
+                merged.append(range_)
+
+    return merged
+
+
+class HashingWriter(object):
+    """
+    A write-only file object that passes everything written to it on to another
+    file, and computes the SHA-256 ETag of it along the way. It can't seek, so
+    zipfile and gzip only ever append to it.
+    """
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.name = getattr(fp, "name", None)
+        self.hasher = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.hasher.update(data)
+        self.size += len(data)
+        return self.fp.write(data)
+
+    def tell(self):
+        return self.size
+
+    def seekable(self):
+        return False
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        raise OSError("HashingWriter can't seek")
+
+    def flush(self):
+        self.fp.flush()
+
+    def etag(self):
+        return format_etag(self.hasher)
 
 
 class SendBaseModeWeb:
@@ -33,6 +163,24 @@ class SendBaseModeWeb:
     All of the web logic shared between share and website mode (modes where the user sends files)
     """
 
+    # Files are read this many bytes at a time, when the WSGI server doesn't send
+    # them by itself
+    chunk_size = 102400  # 100kb
+
+    # The most ranges to send in a multipart/byteranges response
+    max_ranges = 100
+
+    # Whether to only scan the directories of a share when they're first visited,
+    # instead of all of them up front
+    lazy_file_index = False
+
+    # Whether to keep the rendered pages of directory listings, and not just what's
+    # in them
+    cache_listing_html = False
+
+    # The most files and directories to show on one page of a directory listing
+    listing_page_size = 1000
+
     def __init__(self, common, web):
         super(SendBaseModeWeb, self).__init__()
         self.common = common
@@ -42,17 +190,40 @@ class SendBaseModeWeb:
         self.is_zipped = False
         self.download_filename = None
         self.download_filesize = None
+
+        # The filename that downloaders see, which isn't always the name of
+        # download_filename on disk
+        self.download_name = None
         self.zip_writer = None
 
         # Create a temporary dir to store gzip files in
         self.gzip_tmp_dir = tempfile.TemporaryDirectory(dir=self.common.build_tmp_dir())
-        self.gzip_counter = 0
 
-        # If autostop_sharing, only allow one download at a time
-        self.download_in_progress = False
+        # The compressed copies of individual files, in the content-encodings that
+        # can be sent
+        self.encodings = available_encodings()
+        self.variant_cache = VariantCache(
+            self.common, self.gzip_tmp_dir.name, self.compress_variant
+        )
+
+        # Modes that keep small files in memory set this in init()
+        self.hot_cache = None
+
+        # A snapshot of the metadata of the files to share, from scan_files()
+        self.file_scan = None
+
+        # Which directories are inside of the selected roots, once symlinks are
+        # resolved
+        self.containment = None
+
+        # What's in the directories that have been visited
+        self.listing_cache = ListingCache()
 
-        # This tracks the history id
-        self.cur_history_id = 0
+        # Share mode hashes the files for its manifest in init()
+        self.hash_cache = None
+
+        # This tracks the history ids and the transfers in progress
+        self.transfers = TransferRegistry(self.web.stop_q, self.web.events)
 
         # Whether or not we can send REQUEST_INDIVIDUAL_FILE_STARTED
         # and maybe other events when requests come in to this mode
@@ -70,30 +241,62 @@ class SendBaseModeWeb:
 
         return path
 
-    def set_file_info(self, filenames, processed_size_callback=None):
+    def prepare_filenames(self, filenames):
         """
-        Build a data structure that describes the list of files
+        Find the selected root directories, and return the files and directories
+        that get shared
         """
         # Store canonical paths of selected root directories for containment checking
         self.selected_roots = []
         for filename in filenames:
             if os.path.isdir(filename):
                 self.selected_roots.append(os.path.realpath(filename))
+        if self.containment is None or self.containment.roots != self.selected_roots:
+            self.containment = ContainmentCache(self.selected_roots)
 
         # If there's just one folder, replace filenames with a list of files inside that folder
         if len(filenames) == 1 and os.path.isdir(filenames[0]):
             filenames = [
                 os.path.join(filenames[0], x) for x in os.listdir(filenames[0])
             ]
+        return filenames
+
+    def scan_files(self, filenames):
+        """
+        Take a snapshot of the metadata of the files to share, before sharing them.
+        The next call to set_file_info() with the same filenames uses it, instead of
+        scanning them all over again.
+        """
+        self.file_scan = FileScan(
+            self.prepare_filenames(filenames), self._is_path_contained
+        )
+        return self.file_scan
+
+    def get_file_scan(self, filenames):
+        """
+        The snapshot of filenames that scan_files() took, or a new one. Snapshots
+        only get used once, so each share starts with fresh metadata.
+        """
+        file_scan, self.file_scan = self.file_scan, None
+        if file_scan is None or file_scan.filenames != list(filenames):
+            file_scan = FileScan(filenames, self._is_path_contained)
+        return file_scan
+
+    def set_file_info(self, filenames, processed_size_callback=None):
+        """
+        Build a data structure that describes the list of files
+        """
+        filenames = self.prepare_filenames(filenames)
 
         # Re-initialize
-        self.files = {}  # Dictionary mapping file paths to filenames on disk
+        self.files = PathIndex(self._is_path_contained, self.lazy_file_index)
         self.root_files = (
             {}
         )  # This is only the root files and dirs, as opposed to all of them
-        self.cur_history_id = 0
+        self.transfers.reset_history()
         self.file_info = {"files": [], "dirs": []}
-        self.gzip_individual_files = {}
+        self.variant_cache.clear()
+        self.listing_cache.clear()
         self.init()
 
         # Windows paths use backslashes, but website paths use forward slashes. We have to
@@ -116,38 +319,13 @@ class SendBaseModeWeb:
                 # Verify the file is within selected roots (for symlink safety)
                 if not self._is_path_contained(filename):
                     continue
-                self.files[self.fix_windows_paths(basename)] = filename
+                self.files.add_file(self.fix_windows_paths(basename), filename)
                 self.root_files[self.fix_windows_paths(basename)] = filename
 
-            # If it's a directory, add it recursively
+            # If it's a directory, add it with everything in it
             elif os.path.isdir(filename):
                 self.root_files[self.fix_windows_paths(basename)] = filename
-
-                for root, _, nested_filenames in os.walk(filename, followlinks=False):
-                    # Normalize the root path. So if the directory name is "/home/user/Documents/some_folder",
-                    # and it has a nested folder foobar, the root is "/home/user/Documents/some_folder/foobar".
-                    # The normalized_root should be "some_folder/foobar"
-                    normalized_root = os.path.join(
-                        basename, root[len(filename) :].lstrip(slash)
-                    ).rstrip(slash)
-
-                    # Add the dir itself
-                    self.files[self.fix_windows_paths(normalized_root)] = root
-
-                    # Add the files in this dir
-                    for nested_filename in nested_filenames:
-                        full_path = os.path.join(root, nested_filename)
-                        # Skip symlinks
-                        if os.path.islink(full_path):
-                            continue
-                        # Verify the file is within selected roots
-                        if not self._is_path_contained(full_path):
-                            continue
-                        self.files[
-                            self.fix_windows_paths(
-                                os.path.join(normalized_root, nested_filename)
-                            )
-                        ] = full_path
+                self.files.add_dir(self.fix_windows_paths(basename), filename)
 
         self.set_file_info_custom(filenames, processed_size_callback)
 
@@ -157,14 +335,7 @@ class SendBaseModeWeb:
         Uses realpath to resolve symlinks and ensure containment.
         Returns False if the path is outside the selected roots (potential symlink escape).
         """
-        if not self.selected_roots:
-            return True
-
-        resolved_path = os.path.realpath(path)
-        for root in self.selected_roots:
-            if resolved_path.startswith(root + os.sep) or resolved_path == root:
-                return True
-        return False
+        return self.containment.is_contained(path)
 
     def directory_listing(
         self, filenames, path="", filesystem_path=None, add_trailing_slash=False
@@ -173,8 +344,7 @@ class SendBaseModeWeb:
         Display the front page of a share or index.html-less website, listing the files/directories.
         """
         # Tell the GUI about the directory listing
-        history_id = self.cur_history_id
-        self.cur_history_id += 1
+        history_id = self.transfers.new_history_id()
         self.web.add_request(
             self.web.REQUEST_INDIVIDUAL_FILE_STARTED,
             f"/{path}",
@@ -189,18 +359,92 @@ class SendBaseModeWeb:
             breadcrumbs.append((parts[i], f"/{'/'.join(parts[0 : i + 1])}"))
         breadcrumbs_leaf = breadcrumbs.pop()[0]
 
-        # If filesystem_path is None, this is the root directory listing
-        files, dirs = self.build_directory_listing(
-            path, filenames, filesystem_path, add_trailing_slash
-        )
+        # Big directories are split into pages, and each page starts after the
+        # last thing on the one before it
+        after = request.args.get("after")
+
+        # If filenames is None, everything in filesystem_path gets listed, and the
+        # listing is kept for the next visit. If filesystem_path is None, this is
+        # the root directory listing.
+        listing = None
+        if filenames is None:
+            st = os.stat(filesystem_path)
+            listing = self.listing_cache.get(filesystem_path, path, st)
+        if listing is None:
+            files, dirs = self.build_directory_listing(
+                path, filenames, filesystem_path, add_trailing_slash
+            )
+            if filenames is None:
+                listing = self.listing_cache.put(
+                    filesystem_path, path, st, files, dirs
+                )
+        elif listing["html"] is not None and after is None:
+            return make_response(listing["html"])
+        else:
+            files, dirs = listing["files"], listing["dirs"]
 
-        # Mark the request as done so we know we can close the share if in auto-stop mode.
-        self.web.done = True
+        files, dirs, next_after = self.listing_page(files, dirs, after)
+        if next_after is None:
+            next_page = None
+        else:
+            next_page = f"?after={quote(next_after)}"
 
-        # Render and return the response.
-        return self.directory_listing_template(
-            path, files, dirs, breadcrumbs, breadcrumbs_leaf
+        # Render and stream the response. Only the first page gets kept, since
+        # that's the one most visits are for.
+        chunks = self.directory_listing_template(
+            path, files, dirs, breadcrumbs, breadcrumbs_leaf, next_page
         )
+        if listing is not None and self.cache_listing_html and after is None:
+            chunks = self._keep_listing_html(listing, chunks)
+        return Response(chunks, mimetype="text/html")
+
+    def listing_page(self, files, dirs, after):
+        """
+        Return the files and dirs of the page of a listing that starts after the
+        cursor after, and the cursor of the next page, or None if it's the last one.
+        Directories come first, and then files, each sorted by name. Cursors look
+        like "dir:name" or "file:name", so pages stay in order even if things get
+        added or removed in between them.
+        """
+        start_dir = 0
+        start_file = 0
+        if after:
+            kind, _, name = after.partition(":")
+            if kind == "dir":
+                start_dir = bisect.bisect_right(
+                    dirs, name, key=lambda info: info["basename"]
+                )
+            elif kind == "file":
+                start_dir = len(dirs)
+                start_file = bisect.bisect_right(
+                    files, name, key=lambda info: info["basename"]
+                )
+
+        page_dirs = dirs[start_dir : start_dir + self.listing_page_size]
+        page_files = files[
+            start_file : start_file + self.listing_page_size - len(page_dirs)
+        ]
+
+        if start_file + len(page_files) == len(files) and (
+            start_dir + len(page_dirs) == len(dirs)
+        ):
+            next_after = None
+        elif page_files:
+            next_after = f"file:{page_files[-1]['basename']}"
+        else:
+            next_after = f"dir:{page_dirs[-1]['basename']}"
+        return page_files, page_dirs, next_after
+
+    def _keep_listing_html(self, listing, chunks):
+        """
+        Pass the chunks of a rendered listing through, and keep the whole page once
+        it has been rendered
+        """
+        html = []
+        for chunk in chunks:
+            html.append(chunk)
+            yield chunk
+        self.listing_cache.set_html(listing, "".join(html).encode("utf-8"))
 
     def build_directory_listing(
         self, path, filenames, filesystem_path, add_trailing_slash=False
@@ -208,18 +452,7 @@ class SendBaseModeWeb:
         files = []
         dirs = []
 
-        for filename in filenames:
-            if filesystem_path:
-                this_filesystem_path = os.path.join(filesystem_path, filename)
-            else:
-                this_filesystem_path = self.files[filename]
-
-            # Skip symlinks in directory listings
-            if os.path.islink(this_filesystem_path):
-                continue
-
-            is_dir = os.path.isdir(this_filesystem_path)
-
+        for filename, is_dir, size in self.list_directory(filenames, filesystem_path):
             if is_dir:
                 if add_trailing_slash:
                     dirs.append(
@@ -236,7 +469,6 @@ class SendBaseModeWeb:
                         }
                     )
             else:
-                size = os.path.getsize(this_filesystem_path)
                 size_human = self.common.human_readable_filesize(size)
                 files.append(
                     {
@@ -248,149 +480,378 @@ class SendBaseModeWeb:
 
         return files, dirs
 
+    def list_directory(self, filenames, filesystem_path):
+        """
+        Yield (filename, is_dir, size) for each of filenames, leaving out symlinks.
+        If filenames is None, do it for everything in filesystem_path, sorted by
+        name, with a single scandir() instead of a stat() for each of them.
+        """
+        if filenames is None:
+            with os.scandir(filesystem_path) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+            for entry in entries:
+                try:
+                    # Skip symlinks in directory listings
+                    if entry.is_symlink():
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        yield entry.name, True, None
+                    else:
+                        st = entry.stat(follow_symlinks=False)
+                        yield entry.name, False, st.st_size
+                except OSError:
+                    # It's gone already
+                    continue
+            return
+
+        for filename in filenames:
+            if filesystem_path:
+                this_filesystem_path = os.path.join(filesystem_path, filename)
+            else:
+                this_filesystem_path = self.files[filename]
+
+            # Skip symlinks in directory listings
+            if os.path.islink(this_filesystem_path):
+                continue
+
+            if os.path.isdir(this_filesystem_path):
+                yield filename, True, None
+            else:
+                yield filename, False, os.path.getsize(this_filesystem_path)
+
     def stream_individual_file(self, filesystem_path):
         """
         Return a flask response that's streaming the download of an individual file, and gzip
-        compressing it if the browser supports it.
+        compressing it if the browser supports it. Supports range requests, and
+        conditional requests so browsers can reuse files they already have.
         """
         # Verify the path is contained within selected roots (symlink safety check)
         if not self._is_path_contained(filesystem_path):
-            history_id = self.cur_history_id
-            self.cur_history_id += 1
+            history_id = self.transfers.new_history_id()
             return self.web.error404(history_id)
 
-        use_gzip = self.should_use_gzip()
-
-        # gzip compress the individual file, if it hasn't already been compressed
-        if use_gzip:
-            if filesystem_path not in self.gzip_individual_files:
-                gzip_filename = os.path.join(
-                    self.gzip_tmp_dir.name, str(self.gzip_counter)
+        st = os.stat(filesystem_path)
+        last_modified = datetime.fromtimestamp(st.st_mtime, tz=timezone.utc)
+
+        # Small files that are asked for a lot get sent from memory
+        hot_file = None
+        if self.hot_cache is not None:
+            hot_file = self.hot_cache.get(filesystem_path, st)
+
+        # Send a compressed copy of the file in the best encoding the browser
+        # accepts, if there is one. If it's not worth compressing, or it's still
+        # being compressed, serve it as is
+        variant_info = None
+        encoding = self.choose_encoding()
+        if encoding is not None:
+            if hot_file is not None:
+                variant_info = self.hot_cache.open_variant(
+                    filesystem_path, st, hot_file, encoding
                 )
-                self.gzip_counter += 1
-                self._gzip_compress(filesystem_path, gzip_filename, 6, None)
-                self.gzip_individual_files[filesystem_path] = gzip_filename
-
-            file_to_download = self.gzip_individual_files[filesystem_path]
-            filesize = os.path.getsize(self.gzip_individual_files[filesystem_path])
-        else:
-            file_to_download = filesystem_path
-            filesize = os.path.getsize(filesystem_path)
+            else:
+                variant_info = self.variant_cache.open(filesystem_path, st, encoding)
+
+        if variant_info is not None:
+            fp, filesize, etag = variant_info
+            ranges, status_code = self.get_range_and_status_code(
+                filesize, etag, last_modified
+            )
+            if len(ranges) > 1:
+                # Content-Encoding would apply to the whole multipart body rather
+                # than to the parts, so send ranges of the original file instead
+                fp.close()
+                variant_info = None
+
+        if variant_info is None:
+            fp = None
+            filesize = st.st_size
+            etag = self.file_etag(st)
+            ranges, status_code = self.get_range_and_status_code(
+                filesize, etag, last_modified
+            )
 
         path = request.path
+        basename = os.path.basename(filesystem_path)
+        if hot_file is not None:
+            content_type = hot_file["content_type"]
+        else:
+            (content_type, _) = mimetypes.guess_type(basename, strict=False)
+
+        if status_code == 304:
+            # The browser already has this file
+            if fp is not None:
+                fp.close()
+            history_id = self.transfers.new_history_id()
+            self.web.add_request(
+                self.web.REQUEST_INDIVIDUAL_FILE_STARTED,
+                path,
+                {"id": history_id, "method": request.method, "status_code": 304},
+            )
+            r = Response(status=304)
+            r.headers.set("ETag", etag)
+            r.headers.set("Last-Modified", http_date(last_modified))
+            r.headers.set("Vary", "Accept-Encoding")
+            return r
+
+        if fp is None:
+            if hot_file is not None:
+                fp = self.hot_cache.open(hot_file)
+            else:
+                fp = open(filesystem_path, "rb")
+        fp, start, length, body_content_type = self.open_ranges(
+            fp, ranges, filesize, content_type
+        )
 
         # Tell GUI the individual file started
-        history_id = self.cur_history_id
-        self.cur_history_id += 1
-
+        transfer = self.transfers.start(path, length)
+        history_id = transfer.history_id
         self.web.add_request(
             self.web.REQUEST_INDIVIDUAL_FILE_STARTED,
             path,
-            {"id": history_id, "filesize": filesize},
+            {"id": history_id, "filesize": length},
         )
 
-        def generate():
-            chunk_size = 102400  # 100kb
-
-            fp = open(file_to_download, "rb")
-            self.web.done = False
-            while not self.web.done:
-                chunk = fp.read(chunk_size)
-                if chunk == b"":
-                    self.web.done = True
-                else:
-                    try:
-                        yield chunk
-
-                        # Tell GUI the progress
-                        downloaded_bytes = fp.tell()
-                        percent = (1.0 * downloaded_bytes / filesize) * 100
-                        if (
-                            not self.web.is_gui
-                            or self.common.platform == "Linux"
-                            or self.common.platform == "BSD"
-                        ):
-                            if self.web.settings.get(self.web.mode, "log_filenames"):
-                                # Decode and sanitize the path to remove newlines
-                                decoded_path = unquote(path)
-                                decoded_path = decoded_path.replace("\r", "").replace(
-                                    "\n", ""
-                                )
-                                filename_str = f"{decoded_path} - "
-                            else:
-                                filename_str = ""
-
-                            sys.stdout.write(
-                                "\r{0}{1:s}, {2:.2f}%          ".format(
-                                    filename_str,
-                                    self.common.human_readable_filesize(
-                                        downloaded_bytes
-                                    ),
-                                    percent,
-                                )
-                            )
-                            sys.stdout.flush()
-
-                        self.web.add_request(
-                            self.web.REQUEST_INDIVIDUAL_FILE_PROGRESS,
-                            path,
-                            {
-                                "id": history_id,
-                                "bytes": downloaded_bytes,
-                                "filesize": filesize,
-                            },
-                        )
-                        self.web.done = False
-                    except Exception:
-                        # Looks like the download was canceled
-                        self.web.done = True
-
-                        # Tell the GUI the individual file was canceled
-                        self.web.add_request(
-                            self.web.REQUEST_INDIVIDUAL_FILE_CANCELED,
-                            path,
-                            {"id": history_id},
-                        )
-
-            fp.close()
-
-            sys.stdout.write("\n")
+        def progress_callback(downloaded_bytes):
+            # Tell GUI the progress, a few times a second at most
+            if not transfer.update(downloaded_bytes):
+                return
+            self.web.add_request(
+                self.web.REQUEST_INDIVIDUAL_FILE_PROGRESS,
+                path,
+                {
+                    "id": history_id,
+                    "bytes": downloaded_bytes,
+                    "filesize": length,
+                },
+            )
+
+        def done_callback(complete):
+            transfer.finish(complete)
+            if not complete:
+                # Tell the GUI the individual file was canceled
+                self.web.add_request(
+                    self.web.REQUEST_INDIVIDUAL_FILE_CANCELED,
+                    path,
+                    {"id": history_id},
+                )
 
-        basename = os.path.basename(filesystem_path)
+        progress_file = ProgressFile(
+            fp,
+            start,
+            length,
+            progress_callback,
+            done_callback,
+            transfer.is_canceled,
+        )
 
-        r = Response(generate())
-        if use_gzip:
-            r.headers.set("Content-Encoding", "gzip")
-        r.headers.set("Content-Length", filesize)
+        r = Response(
+            self.wrap_progress_file(progress_file, transfer), direct_passthrough=True
+        )
+        if variant_info is not None:
+            r.headers.set("Content-Encoding", encoding)
+        r.headers.set("Content-Length", length)
         filename_dict = {
             "filename": unidecode(basename),
             "filename*": "UTF-8''%s" % quote(basename),
         }
         r.headers.set("Content-Disposition", "inline", **filename_dict)
-        (content_type, _) = mimetypes.guess_type(basename, strict=False)
-        if content_type is not None:
-            r.headers.set("Content-Type", content_type)
+        if body_content_type is not None:
+            r.headers.set("Content-Type", body_content_type)
+        r.headers.set("Accept-Ranges", "bytes")
+        r.headers.set("ETag", etag)
+        r.headers.set("Last-Modified", http_date(last_modified))
+        r.headers.set("Vary", "Accept-Encoding")
+        if status_code == 206 and len(ranges) == 1:
+            r.headers.set(
+                "Content-Range",
+                "bytes {}-{}/{}".format(ranges[0][0], ranges[0][1], filesize),
+            )
+        r.status_code = status_code
         return r
 
+    def wrap_progress_file(self, progress_file, transfer):
+        """
+        Let the WSGI server send the file itself, if it can. waitress reads as much
+        at a time as the socket will take, so it already adapts to the link. Other
+        servers get the file a chunk at a time, sized by the transfer's chunker.
+        """
+        file_wrapper = request.environ.get("wsgi.file_wrapper")
+        if file_wrapper is not None:
+            return file_wrapper(progress_file, self.chunk_size)
+        return ChunkIterator(progress_file, transfer.chunker(self.chunk_size))
+
+    def open_ranges(self, fp, ranges, filesize, content_type):
+        """
+        Get ready to send the ranges of the open file fp. A single range is sent as
+        it is, and several ranges are sent as a multipart/byteranges body. Returns
+        the tuple (fp, start, length, content_type) of what to send.
+        """
+        if len(ranges) == 1:
+            start = ranges[0][0]
+            length = ranges[0][1] - ranges[0][0] + 1
+            return fp, start, length, content_type
+
+        boundary = self.common.random_string(16)
+        fp = MultipartRangesFile(
+            fp,
+            ranges,
+            filesize,
+            content_type or "application/octet-stream",
+            boundary,
+        )
+        return fp, 0, fp.length, f"multipart/byteranges; boundary={boundary}"
+
+    @classmethod
+    def get_range_and_status_code(cls, dl_size, etag, last_modified):
+        use_default_range = True
+        status_code = 200
+        range_header = request.headers.get("Range")
+
+        # range requests are only allowed for get
+        if request.method == "GET":
+            ranges = parse_range_header(range_header, dl_size)
+            if not (
+                len(ranges) == 1 and ranges[0][0] == 0 and ranges[0][1] == dl_size - 1
+            ):
+                use_default_range = False
+                status_code = 206
+
+            # Lots of tiny ranges would make the response much bigger than the
+            # file, so send the whole file instead
+            if len(ranges) > cls.max_ranges:
+                use_default_range = True
+                status_code = 200
+
+            if range_header:
+                if_range = request.headers.get("If-Range")
+                if if_range and if_range != etag:
+                    use_default_range = True
+                    status_code = 200
+
+        if use_default_range:
+            ranges = [(0, dl_size - 1)]
+
+        etag_header = request.headers.get("ETag")
+        if etag_header is not None and etag_header != etag:
+            abort(412)
+
+        if_unmod = request.headers.get("If-Unmodified-Since")
+        if if_unmod:
+            if_date = parse_date(if_unmod)
+            if if_date and not if_date.tzinfo:
+                if_date = if_date.replace(
+                    tzinfo=timezone.utc
+                )  # Compatible with Flask < 2.0.0
+            if if_date and if_date > last_modified:
+                abort(412)
+            elif range_header is None:
+                status_code = 304
+
+        # If the client already has this version of the file, don't send it again
+        if request.method == "GET" and cls.is_not_modified(etag, last_modified):
+            ranges = [(0, dl_size - 1)]
+            status_code = 304
+
+        return ranges, status_code
+
+    @staticmethod
+    def is_not_modified(etag, last_modified):
+        """
+        Check the If-None-Match and If-Modified-Since headers. If-Modified-Since is
+        ignored if there's an If-None-Match.
+        """
+        if_none_match = request.headers.get("If-None-Match")
+        if if_none_match is not None:
+            return parse_etags(if_none_match).contains_weak(unquote_etag(etag)[0])
+
+        if_mod = request.headers.get("If-Modified-Since")
+        if if_mod:
+            if_date = parse_date(if_mod)
+            if if_date and not if_date.tzinfo:
+                if_date = if_date.replace(tzinfo=timezone.utc)
+            # HTTP dates don't have fractions of seconds
+            return (
+                if_date is not None and last_modified.replace(microsecond=0) <= if_date
+            )
+
+        return False
+
     def should_use_gzip(self):
         """
         Should we use gzip for this browser?
         """
         return (not self.is_zipped) and (
-            "gzip" in request.headers.get("Accept-Encoding", "").lower()
+            negotiate_encoding(request.headers.get("Accept-Encoding"), ["gzip"])
+            == "gzip"
         )
 
+    def choose_encoding(self):
+        """
+        The content-encoding to compress an individual file with for this browser,
+        or None to send it as it is
+        """
+        if self.is_zipped:
+            return None
+        return negotiate_encoding(
+            request.headers.get("Accept-Encoding"), self.encodings
+        )
+
+    def file_etag(self, st):
+        """
+        The ETag of an individual file that's sent as it is, given the result of
+        os.stat(). It's made from the size, mtime and inode of the file, so the
+        file doesn't have to be read to know it.
+        """
+        return '"{:x}-{:x}-{:x}"'.format(st.st_size, st.st_mtime_ns, st.st_ino)
+
+    def compress_variant(self, input_filename, output_filename, encoding):
+        """
+        Compress an individual file for the variant cache, and return the ETag of
+        the compressed copy
+        """
+        if encoding == "gzip":
+            _, etag = self._gzip_compress(input_filename, output_filename, 6)
+            return etag
+
+        blocksize = 1 << 20  # 1mb
+        c = compressor(encoding)
+        with open(input_filename, "rb") as input_file, open(
+            output_filename, "wb"
+        ) as raw_output_file:
+            output_file = HashingWriter(raw_output_file)
+            while True:
+                block = input_file.read(blocksize)
+                if len(block) == 0:
+                    break
+                output_file.write(c.compress(block))
+            output_file.write(c.flush())
+
+        return output_file.etag()
+
     def _gzip_compress(
         self, input_filename, output_filename, level, processed_size_callback=None
     ):
         """
         Compress a file with gzip, without loading the whole thing into memory
         Thanks: https://stackoverflow.com/questions/27035296/python-how-to-gzip-a-large-text-file-without-memoryerror
+
+        The ETags of both the original file and the gzip file are computed while
+        compressing, so neither of them has to be read again. Returns them as a
+        tuple (input_etag, output_etag).
         """
         bytes_processed = 0
-        blocksize = 1 << 16  # 64kB
-        with open(input_filename, "rb") as input_file:
-            output_file = gzip.open(output_filename, "wb", level)
+        blocksize = 1 << 20  # 1mb
+        input_hasher = hashlib.sha256()
+        with open(input_filename, "rb") as input_file, open(
+            output_filename, "wb"
+        ) as raw_output_file:
+            output_hasher = HashingWriter(raw_output_file)
+            output_file = gzip.GzipFile(
+                filename=os.path.basename(output_filename),
+                mode="wb",
+                compresslevel=level,
+                fileobj=output_hasher,
+            )
             while True:
                 if processed_size_callback is not None:
                     processed_size_callback(bytes_processed)
@@ -398,11 +859,14 @@ class SendBaseModeWeb:
                 block = input_file.read(blocksize)
                 if len(block) == 0:
                     break
+                input_hasher.update(block)
                 output_file.write(block)
-                bytes_processed += blocksize
+                bytes_processed += len(block)
 
             output_file.close()
 
+        return format_etag(input_hasher), output_hasher.etag()
+
     def init(self):
         """
         Inherited class will implement this
@@ -417,8 +881,8 @@ class SendBaseModeWeb:
 
     def directory_listing_template(self):
         """
-        Inherited class will implement this. It should call render_template and return
-        the response.
+        Inherited class will implement this. It should call stream_template and return
+        the stream.
         """
         pass
 
@@ -18,98 +18,54 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-import binascii
+import collections
+import concurrent.futures
 import hashlib
+import json
 import os
-import sys
+import posixpath
+import stat
 import tempfile
+import threading
 import zipfile
+import zlib
 import mimetypes
 from datetime import datetime, timezone
-from flask import Response, request, render_template, make_response, abort
+from flask import Response, request, render_template, stream_template
 from unidecode import unidecode
-from werkzeug.http import parse_date, http_date
-from urllib.parse import quote, unquote
-
-from .send_base_mode import SendBaseModeWeb
+from werkzeug.http import http_date
+from urllib.parse import quote
+
+from ..file_scan import FileScan
+from .send_base_mode import SendBaseModeWeb, HashingWriter, format_etag
+from .transfers import ProgressFile
+from .archive_cache import ArchiveCache
+from .archive_stream import (
+    ZIP64_LIMIT,
+    TarStream,
+    ZipStream,
+    available_archive_formats,
+    central_directory_header,
+    data_descriptor,
+    end_of_central_directory,
+    local_file_header,
+    member_flags,
+)
+from .compression import should_compress
+from .hash_cache import HashCache
 
 
 def make_etag(data):
     hasher = hashlib.sha256()
 
     while True:
-        read_bytes = data.read(4096)
+        read_bytes = data.read(1 << 20)  # 1mb
         if read_bytes:
             hasher.update(read_bytes)
         else:
             break
 
-    hash_value = binascii.hexlify(hasher.digest()).decode("utf-8")
-    return '"sha256:{}"'.format(hash_value)
-
-
-def parse_range_header(range_header: str, target_size: int) -> list:
-    end_index = target_size - 1
-    if range_header is None:
-        return [(0, end_index)]
-
-    bytes_ = "bytes="
-    if not range_header.startswith(bytes_):
-        abort(416)
-
-    ranges = []
-    for range_ in range_header[len(bytes_) :].split(","):
-        split = range_.split("-")
-        if len(split) == 1:
-            try:
-                start = int(split[0])
-                end = end_index
-            except ValueError:
-                abort(416)
-        elif len(split) == 2:
-            start, end = split[0], split[1]
-            if not start:
-                # parse ranges of the form "bytes=-100" (i.e., last 100 bytes)
-                end = end_index
-                try:
-                    start = end - int(split[1]) + 1
-                except ValueError:
-                    abort(416)
-            else:
-                # parse ranges of the form "bytes=100-200"
-                try:
-                    start = int(start)
-                    if not end:
-                        end = target_size
-                    else:
-                        end = int(end)
-                except ValueError:
-                    abort(416)
-
-                if end < start:
-                    abort(416)
-
-                end = min(end, end_index)
-        else:
-            abort(416)
-
-        ranges.append((start, end))
-
-    # merge the ranges
-    merged = []
-    ranges = sorted(ranges, key=lambda x: x[0])
-    for range_ in ranges:
-        # initial case
-        if not merged:
-            merged.append(range_)
-        else:
-            # merge ranges that are adjacent or overlapping
-            if range_[0] <= merged[-1][1] + 1:
-                merged[-1] = (merged[-1][0], max(range_[1], merged[-1][1]))
-            else:
-                merged.append(range_)
-
-    return merged
+    return format_etag(hasher)
 
 
 class ShareModeWeb(SendBaseModeWeb):
@@ -117,6 +73,9 @@ class ShareModeWeb(SendBaseModeWeb):
     All of the web logic for share mode
     """
 
+    # Most of a big share never gets browsed, since it's downloaded as a zip file
+    lazy_file_index = True
+
     def init(self):
         self.common.log("ShareModeWeb", "init")
 
@@ -129,6 +88,35 @@ class ShareModeWeb(SendBaseModeWeb):
         self.gzip_etag = None
         self.last_modified = datetime.now(tz=timezone.utc)
 
+        # If this is set, the zip or tar file is generated while it's being
+        # downloaded. The last share's zip stream could still be reading files.
+        if getattr(self, "zip_stream", None) is not None:
+            self.zip_stream.cancel()
+        self.zip_stream = None
+
+        # Single files only get a gzip variant if it's worth compressing them
+        self.gzip_filename = None
+
+        # With a streaming archive, a single file only gets compressed the first
+        # time a client asks for gzip, in the background
+        self.gzip_lock = threading.Lock()
+        self.gzip_pending = False
+        self.gzip_thread = None
+
+        # The size of the download compared to the size of the shared files, if
+        # they were compressed
+        self.compression_ratio = None
+
+        # Persistent shares cache their zip file between restarts
+        self.archive_cache = None
+
+        # The SHA-256 hashes of the files, for the manifest. This runs again for
+        # each new share, which keeps the hashing threads but not the hashes.
+        if self.hash_cache is None:
+            self.hash_cache = HashCache(self.common)
+        else:
+            self.hash_cache.clear()
+
     def define_routes(self):
         """
         The web app routes for sharing files
@@ -150,17 +138,12 @@ class ShareModeWeb(SendBaseModeWeb):
             # currently a download
             deny_download = (
                 self.web.settings.get("share", "autostop_sharing")
-                and self.download_in_progress
+                and self.transfers.exclusive_in_progress()
             )
             if deny_download:
                 return render_template("denied.html")
 
             # If download is allowed to continue, serve download page
-            if self.should_use_gzip():
-                self.filesize = self.gzip_filesize
-            else:
-                self.filesize = self.download_filesize
-
             return self.render_logic(path)
 
         @self.web.app.route(
@@ -174,7 +157,7 @@ class ShareModeWeb(SendBaseModeWeb):
             # currently a download
             deny_download = (
                 self.web.settings.get("share", "autostop_sharing")
-                and self.download_in_progress
+                and self.transfers.exclusive_in_progress()
             )
             if deny_download:
                 return render_template("denied.html")
@@ -183,216 +166,277 @@ class ShareModeWeb(SendBaseModeWeb):
             # which is outside of the request context
             request_path = request.path
 
+            # If the zip file is compressed on the fly, we don't know its size ahead
+            # of time, so there's no Content-Length, ETag or range support
+            if self.zip_stream and not self.zip_stream.supports_ranges:
+                return self.download_stream(request_path)
+
             # If this is a zipped file, then serve as-is. If it's not zipped, then,
             # if the http client supports gzip compression, gzip the file first
             # and serve that
-            use_gzip = self.should_use_gzip()
+            if self.gzip_pending and self.should_use_gzip():
+                self.start_gzip()
+            use_gzip = self.should_use_gzip() and self.gzip_filename is not None
             if use_gzip:
                 file_to_download = self.gzip_filename
-                self.filesize = self.gzip_filesize
+                filesize = self.gzip_filesize
                 etag = self.gzip_etag
             else:
                 file_to_download = self.download_filename
-                self.filesize = self.download_filesize
+                filesize = self.download_filesize
                 etag = self.download_etag
 
             # for range requests
-            range_, status_code = self.get_range_and_status_code(
-                self.filesize, etag, self.last_modified
+            ranges, status_code = self.get_range_and_status_code(
+                filesize, etag, self.last_modified
             )
+            if use_gzip and len(ranges) > 1:
+                # Content-Encoding would apply to the whole multipart body rather
+                # than to the parts, so send ranges of the original file instead
+                use_gzip = False
+                file_to_download = self.download_filename
+                filesize = self.download_filesize
+                etag = self.download_etag
+                ranges, status_code = self.get_range_and_status_code(
+                    filesize, etag, self.last_modified
+                )
 
-            # Tell GUI the download started
-            history_id = self.cur_history_id
-            self.cur_history_id += 1
-            self.web.add_request(
-                self.web.REQUEST_STARTED,
-                request_path,
-                {"id": history_id, "use_gzip": use_gzip},
-            )
+            # The end of an uncompressed zip stream needs the CRC of every file.
+            # Until they've been worked out in the background, send the whole
+            # archive, which works them out along the way, rather than reading the
+            # whole share to send a small range.
+            accept_ranges = not self.zip_stream or self.zip_stream.crcs_done.is_set()
+            if status_code == 206 and not accept_ranges:
+                ranges = [(0, filesize - 1)]
+                status_code = 200
 
-            basename = os.path.basename(self.download_filename)
+            basename = self.download_name
+
+            # guess content type
+            (content_type, _) = mimetypes.guess_type(basename, strict=False)
 
             if status_code == 304:
+                # The client already has the file, so nothing gets transferred
                 r = Response()
+                length = ranges[0][1] - ranges[0][0] + 1
+                body_content_type = content_type
             else:
+                # Several ranges get sent in one multipart/byteranges response
+                fp, start, length, body_content_type = self.open_ranges(
+                    self.open_download(file_to_download),
+                    ranges,
+                    filesize,
+                    content_type,
+                )
+
+                # If autostop_sharing, only allow one download at a time
+                transfer = self.start_download(request_path, filesize)
+                if transfer is None:
+                    fp.close()
+                    return render_template("denied.html")
+
+                # Tell GUI the download started
+                self.web.add_request(
+                    self.web.REQUEST_STARTED,
+                    request_path,
+                    {"id": transfer.history_id, "use_gzip": use_gzip},
+                )
+
                 r = Response(
-                    self.generate(
-                        range_,
-                        file_to_download,
-                        request_path,
-                        history_id,
-                        self.filesize,
-                    )
+                    self.send_file(fp, start, length, transfer),
+                    direct_passthrough=True,
                 )
 
             if use_gzip:
                 r.headers.set("Content-Encoding", "gzip")
 
-            r.headers.set("Content-Length", range_[1] - range_[0] + 1)
+            r.headers.set("Content-Length", length)
             filename_dict = {
                 "filename": unidecode(basename),
                 "filename*": "UTF-8''%s" % quote(basename),
             }
             r.headers.set("Content-Disposition", "attachment", **filename_dict)
-            # guess content type
-            (content_type, _) = mimetypes.guess_type(basename, strict=False)
-            if content_type is not None:
-                r.headers.set("Content-Type", content_type)
-            r.headers.set("Accept-Ranges", "bytes")
+            if body_content_type is not None:
+                r.headers.set("Content-Type", body_content_type)
+            r.headers.set("Accept-Ranges", "bytes" if accept_ranges else "none")
             r.headers.set("ETag", etag)
             r.headers.set("Last-Modified", http_date(self.last_modified))
             # we need to set this for range requests
             r.headers.set("Vary", "Accept-Encoding")
 
-            if status_code == 206:
+            if status_code == 206 and len(ranges) == 1:
                 r.headers.set(
                     "Content-Range",
-                    "bytes {}-{}/{}".format(range_[0], range_[1], self.filesize),
+                    "bytes {}-{}/{}".format(ranges[0][0], ranges[0][1], filesize),
                 )
 
             r.status_code = status_code
 
             return r
 
-    @classmethod
-    def get_range_and_status_code(cls, dl_size, etag, last_modified):
-        use_default_range = True
-        status_code = 200
-        range_header = request.headers.get("Range")
-
-        # range requests are only allowed for get
-        if request.method == "GET":
-            ranges = parse_range_header(range_header, dl_size)
-            if not (
-                len(ranges) == 1 and ranges[0][0] == 0 and ranges[0][1] == dl_size - 1
-            ):
-                use_default_range = False
-                status_code = 206
-
-            if range_header:
-                if_range = request.headers.get("If-Range")
-                if if_range and if_range != etag:
-                    use_default_range = True
-                    status_code = 200
-
-        if use_default_range:
-            ranges = [(0, dl_size - 1)]
-
-        if len(ranges) > 1:
-            abort(416)  # We don't support multipart range requests yet
-        range_ = ranges[0]
-
-        etag_header = request.headers.get("ETag")
-        if etag_header is not None and etag_header != etag:
-            abort(412)
-
-        if_unmod = request.headers.get("If-Unmodified-Since")
-        if if_unmod:
-            if_date = parse_date(if_unmod)
-            if if_date and not if_date.tzinfo:
-                if_date = if_date.replace(
-                    tzinfo=timezone.utc
-                )  # Compatible with Flask < 2.0.0
-            if if_date and if_date > last_modified:
-                abort(412)
-            elif range_header is None:
-                status_code = 304
-
-        return range_, status_code
-
-    def generate(self, range_, file_to_download, path, history_id, filesize):
-        # The user hasn't canceled the download
-        self.client_cancel = False
-
-        # Starting a new download
-        if self.web.settings.get("share", "autostop_sharing"):
-            self.download_in_progress = True
-
-        start, end = range_
-
-        chunk_size = 102400  # 100kb
-
-        fp = open(file_to_download, "rb")
-        fp.seek(start)
-        self.web.done = False
-        canceled = False
-        bytes_left = end - start + 1
-        while not self.web.done:
-            # The user has canceled the download, so stop serving the file
-            if not self.web.stop_q.empty():
-                self.web.add_request(
-                    self.web.REQUEST_CANCELED, path, {"id": history_id}
-                )
-                break
+        @self.web.app.route(
+            "/.onionshare/archive",
+            methods=["GET", "POST"],
+            provide_automatic_options=False,
+        )
+        def download_archive():
+            """
+            Download some of the files and folders as an archive, made while it's
+            being downloaded. Each path parameter is a file or folder to put in it,
+            and there's everything if there are none. The format parameter is one
+            of the archive formats, and it's the share's own one by default.
+            """
+            return self.download_selection(
+                request.values.getlist("path"),
+                request.values.get("format", self.archive_format()),
+            )
 
-            read_size = min(chunk_size, bytes_left)
-            chunk = fp.read(read_size)
-            if chunk == b"":
-                self.web.done = True
-            else:
-                try:
-                    yield chunk
-
-                    # tell GUI the progress
-                    downloaded_bytes = fp.tell()
-                    percent = (1.0 * downloaded_bytes / filesize) * 100
-                    bytes_left -= read_size
-
-                    # only output to stdout if running onionshare in CLI mode, or if using Linux (#203, #304)
-                    if (
-                        not self.web.is_gui
-                        or self.common.platform == "Linux"
-                        or self.common.platform == "BSD"
-                    ):
-                        if self.web.settings.get("share", "log_filenames"):
-                            # Decode and sanitize the path to remove newlines
-                            decoded_path = unquote(path)
-                            decoded_path = decoded_path.replace("\r", "").replace(
-                                "\n", ""
-                            )
-                            filename_str = f"{decoded_path} - "
-                        else:
-                            filename_str = ""
-
-                        sys.stdout.write(
-                            "\r{0}{1:s}, {2:.2f}%          ".format(
-                                filename_str,
-                                self.common.human_readable_filesize(downloaded_bytes),
-                                percent,
-                            )
-                        )
-                        sys.stdout.flush()
+        @self.web.app.route(
+            "/.onionshare/manifest.json",
+            methods=["GET"],
+            provide_automatic_options=False,
+        )
+        def manifest_json():
+            """
+            The manifest of everything being shared, so programs can get the whole
+            tree in one request instead of going through the listings folder by
+            folder
+            """
+            return self.manifest(ndjson=False)
 
-                    self.web.add_request(
-                        self.web.REQUEST_PROGRESS,
-                        path,
-                        {
-                            "id": history_id,
-                            "bytes": downloaded_bytes,
-                            "total_bytes": filesize,
-                        },
-                    )
-                    self.web.done = False
-                except Exception:
-                    # looks like the download was canceled
-                    self.web.done = True
-                    canceled = True
+        @self.web.app.route(
+            "/.onionshare/manifest.ndjson",
+            methods=["GET"],
+            provide_automatic_options=False,
+        )
+        def manifest_ndjson():
+            return self.manifest(ndjson=True)
 
-                    # tell the GUI the download has canceled
-                    self.web.add_request(
-                        self.web.REQUEST_CANCELED, path, {"id": history_id}
-                    )
+    def manifest(self, ndjson=False):
+        """
+        Stream the manifest, as a JSON object with a list of files, or as
+        newline-delimited JSON with one file on each line. Since it leads to the
+        files getting hashed, it's only there when individual files can be
+        downloaded.
+        """
+        deny_download = (
+            self.web.settings.get("share", "autostop_sharing")
+            and self.transfers.exclusive_in_progress()
+        )
+        if deny_download:
+            return render_template("denied.html")
+
+        history_id = self.transfers.new_history_id()
+        if not self.download_individual_files:
+            return self.web.error404(history_id)
+
+        self.web.add_request(
+            self.web.REQUEST_INDIVIDUAL_FILE_STARTED,
+            request.path,
+            {"id": history_id, "method": request.method, "status_code": 200},
+        )
+
+        entries = self.manifest_entries()
+        if ndjson:
+            chunks = (json.dumps(entry) + "\n" for entry in entries)
+            return Response(chunks, mimetype="application/x-ndjson")
+
+        def generate():
+            yield '{"files": ['
+            for i, entry in enumerate(entries):
+                yield ("" if i == 0 else ", ") + json.dumps(entry)
+            yield "]}\n"
+
+        return Response(generate(), mimetype="application/json")
+
+    def manifest_entries(self):
+        """
+        Yield a dict for each file and directory being shared, with its path and
+        type. Files also have their size, mtime and SHA-256. Files that haven't
+        been hashed yet get hashed in the background, and their SHA-256 is None
+        until they are.
+        """
+        for path, filesystem_path in self.files.items():
+            try:
+                st = os.stat(filesystem_path)
+            except OSError:
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                yield {"path": path, "type": "dir"}
+            else:
+                yield {
+                    "path": path,
+                    "type": "file",
+                    "size": st.st_size,
+                    "mtime": st.st_mtime,
+                    "sha256": self.hash_cache.get(filesystem_path, st),
+                }
+
+    def download_stream(self, request_path):
+        """
+        Stream the zip file, compressing the files while they're being downloaded.
+        """
+        # If autostop_sharing, only allow one download at a time
+        transfer = self.start_download(request_path, self.download_filesize)
+        if transfer is None:
+            return render_template("denied.html")
+
+        # Tell GUI the download started
+        self.web.add_request(
+            self.web.REQUEST_STARTED,
+            request_path,
+            {"id": transfer.history_id, "use_gzip": False},
+        )
 
-        fp.close()
+        r = Response(self.generate_stream(transfer))
+        basename = self.download_name
+        filename_dict = {
+            "filename": unidecode(basename),
+            "filename*": "UTF-8''%s" % quote(basename),
+        }
+        r.headers.set("Content-Disposition", "attachment", **filename_dict)
+        r.headers.set("Content-Type", self.zip_stream.content_type)
+        r.headers.set("Accept-Ranges", "none")
+        r.headers.set("Last-Modified", http_date(self.last_modified))
+        return r
+
+    def open_download(self, file_to_download):
+        """
+        Open the file to download. An uncompressed zip stream can be read just like
+        a file.
+        """
+        if self.zip_stream:
+            return self.zip_stream.open()
+        return open(file_to_download, "rb")
+
+    def start_download(self, path, filesize):
+        """
+        Start keeping track of a download. If "Stop sharing after files have been
+        sent" is checked, only one download can happen at a time, so this returns
+        None if there's already one in progress.
+        """
+        return self.transfers.start(
+            path,
+            filesize,
+            exclusive=self.web.settings.get("share", "autostop_sharing"),
+        )
 
-        sys.stdout.write("\n")
+    def finish_download(self, transfer, complete):
+        """
+        The download is over, either because it's complete or because it was
+        canceled.
+        """
+        if not transfer.finish(complete):
+            return
 
-        # Download is finished
-        if self.web.settings.get("share", "autostop_sharing"):
-            self.download_in_progress = False
+        if not complete:
+            # looks like the download was canceled
+            self.web.add_request(
+                self.web.REQUEST_CANCELED, transfer.path, {"id": transfer.history_id}
+            )
 
         # Close the server, if necessary
-        if self.web.settings.get("share", "autostop_sharing") and not canceled:
+        if self.web.settings.get("share", "autostop_sharing") and complete:
             print("Stopped because transfer is complete")
             self.web.running = False
             try:
@@ -400,27 +444,230 @@ class ShareModeWeb(SendBaseModeWeb):
             except Exception:
                 pass
 
+    def report_progress(self, transfer, downloaded_bytes):
+        """
+        Tell the GUI the progress of a download, a few times a second at most
+        """
+        if not transfer.update(downloaded_bytes):
+            return
+        self.web.add_request(
+            self.web.REQUEST_PROGRESS,
+            transfer.path,
+            {
+                "id": transfer.history_id,
+                "bytes": downloaded_bytes,
+                "total_bytes": transfer.total_bytes,
+            },
+        )
+
+    def send_file(self, fp, start, length, transfer):
+        """
+        Hand length bytes of the open file fp, starting at start, off to the WSGI
+        server to send, and keep track of its progress.
+        """
+
+        def progress_callback(sent_bytes):
+            self.report_progress(transfer, start + sent_bytes)
+
+        def done_callback(complete):
+            self.finish_download(transfer, complete)
+
+        return self.wrap_progress_file(
+            ProgressFile(
+                fp,
+                start,
+                length,
+                progress_callback,
+                done_callback,
+                transfer.is_canceled,
+            ),
+            transfer,
+        )
+
+    def generate_stream(self, transfer):
+        """
+        Like send_file(), but the chunks come from the zip stream rather than from
+        a file. Progress is measured in bytes of the original files, since the size
+        of the compressed zip isn't known until it's done.
+        """
+        processed = {"bytes": 0}
+
+        def processed_size_callback(processed_size):
+            processed["bytes"] = processed_size
+
+        complete = False
+        chunker = transfer.chunker(self.chunk_size)
+        chunks = self.zip_stream.generate(processed_size_callback, chunker)
+        try:
+            for chunk in chunks:
+                # The user has canceled the download, so stop serving the file
+                if transfer.is_canceled():
+                    break
+
+                yield chunk
+                self.report_progress(transfer, processed["bytes"])
+            else:
+                complete = True
+        finally:
+            # If the download was canceled, or the client went away, this runs
+            # when the WSGI server closes the generator
+            chunks.close()
+            chunker.close()
+            self.finish_download(transfer, complete)
+
+    def download_selection(self, paths, archive_format):
+        """
+        Stream an archive of some of the files and folders being shared, given
+        their paths in URLs. Like individual files, this is only allowed if they
+        can be downloaded one by one.
+        """
+        selection = None
+        if (
+            self.download_individual_files
+            and archive_format in available_archive_formats()
+        ):
+            selection = self.selection_files(paths)
+        if selection is None:
+            history_id = self.transfers.new_history_id()
+            return self.web.error404(history_id)
+        name, files = selection
+
+        archive = self.new_archive_stream(archive_format)
+        archive.add_files(files)
+        basename = f"{name}.{archive_format}"
+
+        # Tell GUI the download started. Like with streaming zip files, progress is
+        # measured in bytes of the original files.
+        path = request.path
+        transfer = self.transfers.start(path, archive.total_size)
+        self.web.add_request(
+            self.web.REQUEST_INDIVIDUAL_FILE_STARTED,
+            path,
+            {"id": transfer.history_id, "filesize": archive.total_size},
+        )
+
+        r = Response(self.generate_selection(archive, transfer))
+        filename_dict = {
+            "filename": unidecode(basename),
+            "filename*": "UTF-8''%s" % quote(basename),
+        }
+        r.headers.set("Content-Disposition", "attachment", **filename_dict)
+        r.headers.set("Content-Type", archive.content_type)
+        r.headers.set("Accept-Ranges", "none")
+        return r
+
+    def selection_files(self, paths):
+        """
+        Find the files that go in an archive of some paths, as a name for the
+        archive and a list of (filename, arcname, st) tuples, or None if one of the
+        paths isn't being shared. The arcnames are relative to the folder the paths
+        have in common, and paths inside of other selected folders are left out,
+        since they're already in the archive.
+        """
+        paths = sorted(set(path.strip("/") for path in paths))
+        if not paths or "" in paths:
+            # Everything being shared
+            prefixes = {filename: "" for filename in self.root_files.values()}
+            name = "onionshare"
+        else:
+            selected = []
+            for path in paths:
+                if path not in self.files:
+                    return None
+                if not any(path.startswith(parent + "/") for parent in selected):
+                    selected.append(path)
+
+            common = posixpath.commonpath(
+                [posixpath.dirname(path) for path in selected]
+            )
+            prefixes = {}
+            for path in selected:
+                prefixes[self.files[path]] = posixpath.relpath(
+                    posixpath.dirname(path) or ".", common or "."
+                )
+            if len(selected) == 1:
+                name = posixpath.basename(selected[0])
+            else:
+                name = posixpath.basename(common) or "onionshare"
+
+        file_scan = FileScan(sorted(prefixes), self._is_path_contained)
+        files = []
+        for root in file_scan.roots:
+            prefix = prefixes[root["filename"]]
+            for filename, arcname, st in root["files"]:
+                if prefix not in ("", "."):
+                    arcname = posixpath.join(prefix, arcname)
+                files.append((filename, arcname, st))
+        return name, files
+
+    def generate_selection(self, archive, transfer):
+        """
+        Like generate_stream(), for an archive of some of the files
+        """
+        path = transfer.path
+        processed = {"bytes": 0}
+
+        def processed_size_callback(processed_size):
+            processed["bytes"] = processed_size
+
+        complete = False
+        chunker = transfer.chunker(self.chunk_size)
+        chunks = archive.generate(processed_size_callback, chunker)
+        try:
+            for chunk in chunks:
+                # The user has canceled the download, so stop serving the file
+                if transfer.is_canceled():
+                    break
+
+                yield chunk
+
+                # Tell GUI the progress, a few times a second at most
+                if transfer.update(processed["bytes"]):
+                    self.web.add_request(
+                        self.web.REQUEST_INDIVIDUAL_FILE_PROGRESS,
+                        path,
+                        {
+                            "id": transfer.history_id,
+                            "bytes": processed["bytes"],
+                            "filesize": archive.total_size,
+                        },
+                    )
+            else:
+                complete = True
+        finally:
+            chunks.close()
+            chunker.close()
+            transfer.finish(complete)
+            if not complete:
+                self.web.add_request(
+                    self.web.REQUEST_INDIVIDUAL_FILE_CANCELED,
+                    path,
+                    {"id": transfer.history_id},
+                )
+
     def directory_listing_template(
-        self, path, files, dirs, breadcrumbs, breadcrumbs_leaf
+        self, path, files, dirs, breadcrumbs, breadcrumbs_leaf, next_page=None
     ):
-        return make_response(
-            render_template(
-                "send.html",
-                file_info=self.file_info,
-                files=files,
-                dirs=dirs,
-                breadcrumbs=breadcrumbs,
-                breadcrumbs_leaf=breadcrumbs_leaf,
-                filename=os.path.basename(self.download_filename),
-                filesize=self.filesize,
-                filesize_human=self.common.human_readable_filesize(
-                    self.download_filesize
-                ),
-                is_zipped=self.is_zipped,
-                static_url_path=self.web.static_url_path,
-                download_individual_files=self.download_individual_files,
-                title=self.web.settings.get("general", "title"),
-            )
+        if self.should_use_gzip() and self.gzip_filename:
+            filesize = self.gzip_filesize
+        else:
+            filesize = self.download_filesize
+
+        return stream_template(
+            "send.html",
+            files=files,
+            dirs=dirs,
+            breadcrumbs=breadcrumbs,
+            breadcrumbs_leaf=breadcrumbs_leaf,
+            next_page=next_page,
+            filename=self.download_name,
+            filesize=filesize,
+            filesize_human=self.common.human_readable_filesize(self.download_filesize),
+            is_zipped=self.is_zipped,
+            compression_ratio=self.compression_ratio,
+            static_url_path=self.web.static_url_path,
+            download_individual_files=self.download_individual_files,
+            title=self.web.settings.get("general", "title"),
         )
 
     def set_file_info_custom(self, filenames, processed_size_callback):
@@ -435,25 +682,19 @@ class ShareModeWeb(SendBaseModeWeb):
             # If it's a directory
             if os.path.isdir(filesystem_path):
                 # Render directory listing
-                filenames = []
-                for filename in os.listdir(filesystem_path):
-                    filenames.append(filename)
-                filenames.sort()
-                return self.directory_listing(filenames, path, filesystem_path)
+                return self.directory_listing(None, path, filesystem_path)
 
             # If it's a file
             elif os.path.isfile(filesystem_path):
                 if self.download_individual_files:
                     return self.stream_individual_file(filesystem_path)
                 else:
-                    history_id = self.cur_history_id
-                    self.cur_history_id += 1
+                    history_id = self.transfers.new_history_id()
                     return self.web.error404(history_id)
 
             # If it's not a directory or file, throw a 404
             else:
-                history_id = self.cur_history_id
-                self.cur_history_id += 1
+                history_id = self.transfers.new_history_id()
                 return self.web.error404(history_id)
         else:
             # Special case loading /
@@ -466,92 +707,360 @@ class ShareModeWeb(SendBaseModeWeb):
 
             else:
                 # If the path isn't found, throw a 404
-                history_id = self.cur_history_id
-                self.cur_history_id += 1
+                history_id = self.transfers.new_history_id()
                 return self.web.error404(history_id)
 
     def build_zipfile_list(self, filenames, processed_size_callback=None):
         self.common.log("ShareModeWeb", "build_zipfile_list", f"filenames={filenames}")
-        for filename in filenames:
+        file_scan = self.get_file_scan(filenames)
+        for root in file_scan.roots:
             info = {
-                "filename": filename,
-                "basename": os.path.basename(filename.rstrip("/")),
+                "filename": root["filename"],
+                "basename": root["basename"],
+                "size": root["size"],
+                "size_human": self.common.human_readable_filesize(root["size"]),
             }
-            if os.path.isfile(filename):
-                info["size"] = os.path.getsize(filename)
-                info["size_human"] = self.common.human_readable_filesize(info["size"])
-                self.file_info["files"].append(info)
-            if os.path.isdir(filename):
-                info["size"] = self.common.dir_size(filename)
-                info["size_human"] = self.common.human_readable_filesize(info["size"])
+            if root["is_dir"]:
                 self.file_info["dirs"].append(info)
+            else:
+                self.file_info["files"].append(info)
         self.file_info["files"].sort(key=lambda k: k["basename"])
         self.file_info["dirs"].sort(key=lambda k: k["basename"])
 
         # Check if there's only 1 file and no folders
         if len(self.file_info["files"]) == 1 and len(self.file_info["dirs"]) == 0:
             self.download_filename = self.file_info["files"][0]["filename"]
+            self.download_name = os.path.basename(self.download_filename)
             self.download_filesize = self.file_info["files"][0]["size"]
-            with open(self.download_filename, "rb") as f:
-                self.download_etag = make_etag(f)
 
             # Compress the file with gzip now, so we don't have to do it on each request
             self.gzip_tmp_dir = tempfile.TemporaryDirectory(
                 dir=self.common.build_tmp_dir()
             )
             self.gzip_filename = os.path.join(self.gzip_tmp_dir.name, "file.gz")
-            self._gzip_compress(
-                self.download_filename, self.gzip_filename, 6, processed_size_callback
-            )
-            self.gzip_filesize = os.path.getsize(self.gzip_filename)
-            with open(self.gzip_filename, "rb") as f:
-                self.gzip_etag = make_etag(f)
+            if self.web.settings.get("share", "streaming_archive"):
+                # Don't compress it now, and send it as it is until it has been
+                self.gzip_filename = None
+                self.gzip_pending = True
+                self.download_etag = self.file_etag(os.stat(self.download_filename))
+                self.gzip_filesize = None
+            elif should_compress(self.download_filename):
+                # This is the only time the file gets read
+                self.download_etag, self.gzip_etag = self._gzip_compress(
+                    self.download_filename,
+                    self.gzip_filename,
+                    6,
+                    processed_size_callback,
+                )
+                self.gzip_filesize = os.path.getsize(self.gzip_filename)
+            else:
+                with open(self.download_filename, "rb") as f:
+                    self.download_etag = make_etag(f)
+                self.gzip_filesize = None
+
+            if self.gzip_pending:
+                if processed_size_callback is not None:
+                    processed_size_callback(self.download_filesize)
+            elif self.gzip_filesize is not None and (
+                self.gzip_filesize < self.download_filesize
+            ):
+                self.compression_ratio = self.gzip_filesize / self.download_filesize
+            else:
+                # It's already compressed, so serve it as is
+                self.common.log(
+                    "ShareModeWeb",
+                    "build_zipfile_list",
+                    f"not compressing {self.download_filename}",
+                )
+                self.gzip_filename = None
+                if processed_size_callback is not None:
+                    processed_size_callback(self.download_filesize)
 
             self.is_zipped = False
 
             # Cleanup this tempfile
             self.web.cleanup_tempdirs.append(self.gzip_tmp_dir)
 
+        elif (
+            self.web.settings.get("share", "streaming_archive")
+            or self.archive_format() != "zip"
+        ):
+            # Don't compress anything now, the archive gets built while it's
+            # being downloaded. Tar files are always built this way.
+            archive_format = self.archive_format()
+            self.zip_stream = self.new_archive_stream(archive_format)
+            self.zip_stream.add_files(zip_members(file_scan))
+
+            if archive_format == "zip":
+                self.download_filename = self.zip_stream.zip_filename
+            else:
+                self.download_filename = self.zip_stream.tar_filename
+            self.download_name = self.download_filename
+            if self.zip_stream.supports_ranges:
+                # Without compression, the zip file's exact size is known now
+                self.zip_stream.build_layout()
+                self.zip_stream.start_crcs()
+                self.download_filesize = self.zip_stream.size
+                self.download_etag = self.zip_stream.etag
+            else:
+                self.download_filesize = self.zip_stream.total_size
+            self.is_zipped = True
+
         else:
             # Zip up the files and folders
+            members = list(zip_members(file_scan))
+
+            # Persistent shares keep their zip file around between restarts. It's
+            # named after the settings file, so downloaders see a name of its own.
+            zip_filename = None
+            if self.web.settings.get("persistent", "enabled"):
+                self.download_name = f"onionshare_{self.common.random_string(4, 6)}.zip"
+                self.archive_cache = ArchiveCache(
+                    self.common, self.web.settings.filename
+                )
+                manifest = self.archive_cache.get_archive(
+                    members, self.zip_compress_type(), 6
+                )
+                if manifest:
+                    self.download_filename = self.archive_cache.archive_filename()
+                    self.download_filesize = manifest["size"]
+                    self.download_etag = manifest["etag"]
+                    if manifest["total_size"] > 0:
+                        self.compression_ratio = (
+                            manifest["size"] / manifest["total_size"]
+                        )
+                    if processed_size_callback is not None:
+                        processed_size_callback(manifest["total_size"])
+                    self.is_zipped = True
+                    return True
+
+                zip_filename = self.archive_cache.new_archive_filename()
+
             self.zip_writer = ZipWriter(
-                self.common, self.web, processed_size_callback=processed_size_callback
+                self.common,
+                self.web,
+                zip_filename=zip_filename,
+                processed_size_callback=processed_size_callback,
+                compress_type=self.zip_compress_type(),
+                archive_cache=self.archive_cache,
             )
             self.download_filename = self.zip_writer.zip_filename
-            for info in self.file_info["files"]:
-                self.zip_writer.add_file(info["filename"])
-                # Canceling early?
-                if self.web.cancel_compression:
-                    self.zip_writer.close()
-                    return False
-
-            for info in self.file_info["dirs"]:
-                if not self.zip_writer.add_dir(info["filename"]):
-                    return False
+            if not self.archive_cache:
+                self.download_name = os.path.basename(self.download_filename)
+            if not self.zip_writer.write_files(members):
+                # Canceling early
+                self.zip_writer.close()
+                if self.archive_cache:
+                    self.archive_cache.discard(self.zip_writer.zip_filename)
+                return False
 
             self.zip_writer.close()
-            self.download_filesize = os.path.getsize(self.download_filename)
-            with open(self.download_filename, "rb") as f:
-                self.download_etag = make_etag(f)
+            self.download_filesize = self.zip_writer.size
+            self.download_etag = self.zip_writer.etag()
+
+            if self.zip_writer._size > 0:
+                self.compression_ratio = self.download_filesize / self.zip_writer._size
+            self.common.log(
+                "ShareModeWeb",
+                "build_zipfile_list",
+                f"stored {self.zip_writer.stored_files} files without compression",
+            )
+
+            if self.archive_cache:
+                self.archive_cache.save(
+                    self.zip_writer, self.download_filesize, self.download_etag
+                )
 
             self.is_zipped = True
 
         return True
 
+    def start_gzip(self):
+        """
+        Start compressing a single file share in a background thread. Until it's
+        done, the file is sent as it is.
+        """
+        with self.gzip_lock:
+            if not self.gzip_pending:
+                return
+            self.gzip_pending = False
+
+        self.gzip_thread = threading.Thread(
+            target=self.build_gzip,
+            args=(self.download_filename, self.gzip_tmp_dir),
+            daemon=True,
+        )
+        self.gzip_thread.start()
+
+    def build_gzip(self, filename, gzip_tmp_dir):
+        """
+        Compress a single file share with gzip, and start sending the compressed
+        copy if it's smaller than the file.
+        """
+        # Write it under another name, so it can't be sent while it's incomplete
+        gzip_filename = os.path.join(gzip_tmp_dir.name, "file.gz")
+        partial_filename = gzip_filename + ".partial"
+        try:
+            if not should_compress(filename):
+                self.common.log(
+                    "ShareModeWeb", "build_gzip", f"not compressing {filename}"
+                )
+                return
+
+            _, gzip_etag = self._gzip_compress(filename, partial_filename, 6)
+            gzip_filesize = os.path.getsize(partial_filename)
+            if gzip_filesize >= self.download_filesize:
+                # It's already compressed, so keep sending it as it is
+                self.common.log(
+                    "ShareModeWeb", "build_gzip", f"not compressing {filename}"
+                )
+                os.remove(partial_filename)
+                return
+            os.replace(partial_filename, gzip_filename)
+        except OSError as e:
+            # The share was stopped, and its temporary files cleaned up
+            self.common.log("ShareModeWeb", "build_gzip", f"failed: {e}")
+            return
+
+        if gzip_tmp_dir is not self.gzip_tmp_dir:
+            # Something else is being shared now
+            return
+
+        self.gzip_filesize = gzip_filesize
+        self.gzip_etag = gzip_etag
+        self.compression_ratio = gzip_filesize / self.download_filesize
+
+        # Requests only use the other gzip attributes once this is set
+        self.gzip_filename = gzip_filename
+
+    def zip_compress_type(self):
+        """
+        The compression to use for files in the zip archive.
+        """
+        if self.web.settings.get("share", "archive_compression"):
+            return zipfile.ZIP_DEFLATED
+        return zipfile.ZIP_STORED
+
+    def archive_format(self):
+        """
+        The format of the archive that the files get downloaded in. If zstd isn't
+        available, tar.zst archives are compressed with gzip instead.
+        """
+        archive_format = self.web.settings.get("share", "archive_format")
+        if archive_format not in available_archive_formats():
+            self.common.log(
+                "ShareModeWeb",
+                "archive_format",
+                f"{archive_format} isn't available, using tar.gz",
+            )
+            archive_format = "tar.gz"
+        return archive_format
+
+    def new_archive_stream(self, archive_format):
+        """
+        Make an archive stream in one of the archive formats
+        """
+        if archive_format == "zip":
+            return ZipStream(
+                self.common, self.web, compress_type=self.zip_compress_type()
+            )
+        compression = archive_format.partition(".")[2] or None
+        return TarStream(self.common, self.web, compression=compression)
+
+
+def zip_members(file_scan):
+    """
+    Yield (filename, arcname, st) tuples for all of the files that go in a zip
+    archive of a FileScan, the files at the top level first and then the
+    directories, each sorted by name.
+    """
+    for root in sorted(
+        file_scan.roots, key=lambda root: (root["is_dir"], root["basename"])
+    ):
+        yield from root["files"]
+
+
+def zip_arcname(arcname):
+    """
+    Normalize the name of a file in a zip archive the way zipfile.ZipInfo does
+    """
+    arcname = os.path.normpath(os.path.splitdrive(arcname)[1])
+    while arcname[0] in (os.sep, os.altsep):
+        arcname = arcname[1:]
+    return arcname.replace(os.sep, "/")
+
+
+def deflate_chunk(data, zdict, level):
+    """
+    Compress one chunk of a file as part of a raw deflate stream. The chunk ends
+    with a sync flush so that independently compressed chunks can be concatenated,
+    and the last 32kB of the previous chunk is used as the dictionary so the
+    compression ratio is as good as compressing the whole file at once.
+    """
+    if zdict:
+        compressor = zlib.compressobj(
+            level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=zdict
+        )
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
 
 class ZipWriter(object):
     """
     ZipWriter accepts files and directories and compresses them into a zip file
     with. If a zip_filename is not passed in, it will use the default onionshare
     filename.
+
+    Files are split into chunks that get deflated in parallel by a pool of worker
+    threads, while the calling thread reads the files and writes the compressed
+    chunks to the zip file in order.
     """
 
+    # Files are read and compressed this many bytes at a time
+    chunk_size = 1 << 20  # 1mb
+
+    # The size of the deflate window, which is used as the dictionary for the next chunk
+    window_size = 1 << 15  # 32kb
+
     def __init__(
-        self, common, web=None, zip_filename=None, processed_size_callback=None
+        self,
+        common,
+        web=None,
+        zip_filename=None,
+        processed_size_callback=None,
+        compress_type=zipfile.ZIP_DEFLATED,
+        compresslevel=6,
+        workers=None,
+        archive_cache=None,
     ):
         self.common = common
         self.web = web
+        self.archive_cache = archive_cache
         self.cancel_compression = False
+        self.compress_type = compress_type
+        self.compresslevel = compresslevel
+
+        # Use all of the cores by default
+        if workers:
+            self.workers = workers
+        else:
+            self.workers = os.cpu_count() or 1
+        self.pool = None
+        self._in_flight = 0
+        self._entry = None
+        self._current_compress_size = 0
+
+        # The number of files that were stored without compression, and that were
+        # copied from the archive cache
+        self.stored_files = 0
+        self.reused_files = 0
+
+        # Where each file ended up in the zip archive, for the archive cache
+        self.members = []
+
+        # Everything that goes in the central directory, once the zip is closed
+        self.entries = []
 
         if zip_filename:
             self.zip_filename = zip_filename
@@ -565,7 +1074,9 @@ class ZipWriter(object):
             if self.web:
                 self.web.cleanup_tempdirs.append(self.zip_temp_dir)
 
-        self.z = zipfile.ZipFile(self.zip_filename, "w", allowZip64=True)
+        # The ETag of the zip file gets computed while it's being written
+        self.zip_file = open(self.zip_filename, "wb")
+        self.hashing_writer = HashingWriter(self.zip_file)
         self.processed_size_callback = processed_size_callback
         if self.processed_size_callback is None:
             self.processed_size_callback = lambda _: None
@@ -576,43 +1087,229 @@ class ZipWriter(object):
         """
         Add a file to the zip archive.
         """
-        # Skip symlinks
-        if os.path.islink(filename):
-            return
-        # Verify the file is within selected roots (symlink safety check)
-        if self.web and not self.web.share_mode._is_path_contained(filename):
-            return
-        self.z.write(filename, os.path.basename(filename), zipfile.ZIP_DEFLATED)
-        self._size += os.path.getsize(filename)
-        self.processed_size_callback(self._size)
+        return self.write_files(zip_members(self._scan([filename])))
 
     def add_dir(self, filename):
         """
         Add a directory, and all of its children, to the zip archive.
         """
-        dir_to_strip = os.path.dirname(filename.rstrip("/")) + "/"
-        for dirpath, dirnames, filenames in os.walk(filename, followlinks=False):
-            for f in filenames:
-                # Canceling early?
-                if self.cancel_compression:
+        return self.write_files(zip_members(self._scan([filename])))
+
+    def _scan(self, filenames):
+        # Only add files that are within the selected roots (symlink safety check)
+        if self.web:
+            return FileScan(filenames, self.web.share_mode._is_path_contained)
+        return FileScan(filenames)
+
+    def is_canceled(self):
+        """
+        Has compression been canceled, either directly or through the Web object?
+        """
+        return self.cancel_compression or (
+            self.web is not None and getattr(self.web, "cancel_compression", False)
+        )
+
+    def write_files(self, files):
+        """
+        Compress (filename, arcname, st) tuples from a FileScan into the zip archive.
+        Returns False if compression was canceled.
+        """
+        if self.compress_type == zipfile.ZIP_DEFLATED and self.pool is None:
+            self.pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.workers
+            )
+
+        # Everything waiting to be written to the zip file, in order
+        pending = collections.deque()
+        self._in_flight = 0
+
+        for filename, arcname, st in files:
+            member = {
+                "filename": os.path.abspath(filename),
+                "arcname": zip_arcname(arcname),
+                "size": st.st_size,
+                "mtime": st.st_mtime,
+                "mtime_ns": st.st_mtime_ns,
+                "inode": st.st_ino,
+                "mode": st.st_mode,
+            }
+
+            # If the file hasn't changed since it went into the cached archive, copy
+            # its compressed data from there
+            cached = None
+            if self.archive_cache:
+                cached = self.archive_cache.lookup(
+                    filename, st, self.compress_type, self.compresslevel
+                )
+            if cached:
+                pending.append(("start", member, cached["compress_type"]))
+                for chunk in self.archive_cache.read_raw(cached, self.chunk_size):
+                    if not self._queue_chunk(pending, chunk, 0):
+                        return False
+                if not self._queue_chunk(pending, b"", cached["size"]):
                     return False
+                pending.append(("end", cached["crc"], cached["size"], False))
+                self.reused_files += 1
+                continue
 
-                full_filename = os.path.join(dirpath, f)
-                # Skip symlinks
-                if os.path.islink(full_filename):
-                    continue
-                # Verify the file is within selected roots
-                if self.web and not self.web.share_mode._is_path_contained(full_filename):
-                    continue
-                arc_filename = full_filename[len(dir_to_strip) :]
-                self.z.write(full_filename, arc_filename, zipfile.ZIP_DEFLATED)
-                self._size += os.path.getsize(full_filename)
-                self.processed_size_callback(self._size)
+            compress_type = self.compress_type
+            if self.compress_type == zipfile.ZIP_DEFLATED and not should_compress(
+                filename
+            ):
+                # Don't waste time compressing files that won't get any smaller
+                compress_type = zipfile.ZIP_STORED
+                self.stored_files += 1
+            pending.append(("start", member, compress_type))
+
+            crc = 0
+            file_size = 0
+            zdict = None
+            with open(filename, "rb") as f:
+                while True:
+                    chunk = f.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    crc = zlib.crc32(chunk, crc)
+                    file_size += len(chunk)
+
+                    if compress_type == zipfile.ZIP_DEFLATED:
+                        future = self.pool.submit(
+                            deflate_chunk, chunk, zdict, self.compresslevel
+                        )
+                        zdict = chunk[-self.window_size :]
+                    else:
+                        future = None
+                    if not self._queue_chunk(pending, chunk, len(chunk), future):
+                        return False
+
+            pending.append(("end", crc, file_size, True))
 
+        self._write_pending(pending, 0)
+        return True
+
+    def _queue_chunk(self, pending, data, size, future=None):
+        """
+        Queue up a chunk of a member to get written, once it's compressed if future
+        is set. Returns False if compression was canceled.
+        """
+        # Canceling early?
+        if self.is_canceled():
+            if future:
+                future.cancel()
+            for item in pending:
+                if item[0] == "chunk":
+                    item[1].cancel()
+            return False
+
+        if future is None:
+            future = concurrent.futures.Future()
+            future.set_result(data)
+        pending.append(("chunk", future, size))
+        self._in_flight += 1
+
+        # Don't let too many chunks pile up in memory
+        self._write_pending(pending, 2 * self.workers)
         return True
 
+    def _write_pending(self, pending, max_in_flight):
+        """
+        Write items from the front of the queue to the zip file, waiting for chunks
+        to finish compressing, until at most max_in_flight chunks are left.
+        """
+        while pending:
+            item = pending[0]
+            if item[0] == "chunk":
+                if self._in_flight <= max_in_flight:
+                    return
+                self._write_chunk(item[1].result(), item[2])
+                self._in_flight -= 1
+            elif item[0] == "start":
+                self._start_member(item[1], item[2])
+            else:
+                self._end_member(*item[1:])
+            pending.popleft()
+
+    def _start_member(self, member, compress_type):
+        # The CRC and sizes get written in a data descriptor after the file data
+        flags = member_flags(member)
+        zip64 = member["size"] * 1.05 > ZIP64_LIMIT
+        self._entry = {
+            "member": member,
+            "flags": flags,
+            "compress_type": compress_type,
+            "zip64": zip64,
+            "header_offset": self.hashing_writer.size,
+        }
+        self.hashing_writer.write(
+            local_file_header(member, flags, zip64, compress_type)
+        )
+
+        member["data_offset"] = self.hashing_writer.size
+        self.members.append(member)
+
+    def _write_chunk(self, data, size):
+        self.hashing_writer.write(data)
+        self._current_compress_size += len(data)
+        self._size += size
+        self.processed_size_callback(self._size)
+
+    def _end_member(self, crc, file_size, finish):
+        entry = self._entry
+        if finish and entry["compress_type"] == zipfile.ZIP_DEFLATED:
+            # Finish the deflate stream with an empty final block
+            data = zlib.compressobj(
+                self.compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS
+            ).flush()
+            self.hashing_writer.write(data)
+            self._current_compress_size += len(data)
+
+        entry["crc"] = crc
+        entry["file_size"] = file_size
+        entry["compress_size"] = self._current_compress_size
+        self._current_compress_size = 0
+
+        self.hashing_writer.write(
+            data_descriptor(crc, entry["compress_size"], file_size, entry["zip64"])
+        )
+        self.entries.append(entry)
+
+        entry["member"].update(
+            {
+                "compress_type": entry["compress_type"],
+                "compress_size": entry["compress_size"],
+                "crc": crc,
+            }
+        )
+
     def close(self):
         """
         Close the zip archive.
         """
-        self.z.close()
+        if self.pool:
+            self.pool.shutdown(cancel_futures=True)
+            self.pool = None
+        if self.zip_file.closed:
+            return
+
+        cd_offset = self.hashing_writer.size
+        for entry in self.entries:
+            self.hashing_writer.write(central_directory_header(entry))
+        self.hashing_writer.write(
+            end_of_central_directory(
+                len(self.entries), cd_offset, self.hashing_writer.size - cd_offset
+            )
+        )
+        self.zip_file.close()
+
+    @property
+    def size(self):
+        """
+        The size of the zip file written so far.
+        """
+        return self.hashing_writer.size
+
+    def etag(self):
+        """
+        The ETag of the zip file. Only call this after closing the zip archive.
+        """
+        return self.hashing_writer.etag()
@@ -0,0 +1,470 @@
+# -*- coding: utf-8 -*-
+"""
+OnionShare | https://onionshare.org/
+
+Copyright (C) 2014-2022 Micah Lee, et al. <micah@micahflee.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import bisect
+import os
+import threading
+import time
+
+from .events import Event, REQUEST_TRANSFER_FINISHED
+
+
+class ProgressFile(object):
+    """
+    A read-only file object for a byte range of a file, to hand off to the WSGI
+    server's wsgi.file_wrapper. The server then sends the file itself, rather than
+    OnionShare reading it and yielding it a chunk at a time.
+
+    The server tells us how much it has sent by where it leaves the file position:
+    waitress reads ahead, seeks back and then skips forward by the number of bytes
+    that made it to the socket, and plain file wrappers just read the file in order.
+    So whenever the server reads or closes the file, everything before the
+    current position has been sent.
+    """
+
+    def __init__(self, fp, start, length, progress_callback, done_callback, is_canceled):
+        self.fp = fp
+        self.start = start
+        self.length = length
+        self.progress_callback = progress_callback
+        self.done_callback = done_callback
+        self.is_canceled = is_canceled
+
+        self.pos = 0
+        self.reported = 0
+        self.done = False
+        self.closed = False
+        self.fp.seek(self.start)
+
+    def _report_progress(self):
+        if self.pos != self.reported:
+            self.reported = self.pos
+            self.progress_callback(self.pos)
+
+    def _finish(self):
+        if not self.done:
+            self.done = True
+            self.done_callback(self.pos == self.length)
+
+    def read(self, size=-1):
+        self._report_progress()
+        if self.done:
+            return b""
+        if self.is_canceled():
+            # Stopping a download is normal, so don't raise an error that the WSGI
+            # server would log. It closes the connection when the server stops.
+            self.close()
+            return b""
+
+        if size is None or size < 0 or size > self.length - self.pos:
+            size = self.length - self.pos
+        if size == 0:
+            # Everything has been sent
+            if self.pos == self.length:
+                self._finish()
+            return b""
+
+        data = self.fp.read(size)
+        self.pos += len(data)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += self.length
+        self.pos = max(0, min(offset, self.length))
+        if not self.closed:
+            self.fp.seek(self.start + self.pos)
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def seekable(self):
+        return True
+
+    def readable(self):
+        return True
+
+    def close(self):
+        self._report_progress()
+        self._finish()
+        self.fp.close()
+        self.closed = True
+
+
+class MultipartRangesFile(object):
+    """
+    A read-only, seekable file object for the body of a multipart/byteranges
+    response, made up of byte ranges of another file with part headers between
+    them. Nothing gets buffered, the ranges are read from the file as needed.
+    """
+
+    def __init__(self, fp, ranges, size, content_type, boundary):
+        self.fp = fp
+
+        # Each segment is (offset, length, data), where data is either the bytes of
+        # a part header, or the offset in fp to read the range from
+        self.segments = []
+        offset = 0
+        for start, end in ranges:
+            header = (
+                f"--{boundary}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Range: bytes {start}-{end}/{size}\r\n"
+                "\r\n"
+            ).encode("utf-8")
+            if offset > 0:
+                header = b"\r\n" + header
+            self.segments.append((offset, len(header), header))
+            offset += len(header)
+            self.segments.append((offset, end - start + 1, start))
+            offset += end - start + 1
+
+        footer = f"\r\n--{boundary}--\r\n".encode("utf-8")
+        self.segments.append((offset, len(footer), footer))
+        self.length = offset + len(footer)
+        self.segment_offsets = [segment[0] for segment in self.segments]
+
+        self.pos = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.length - self.pos:
+            size = self.length - self.pos
+
+        chunks = []
+        index = bisect.bisect_right(self.segment_offsets, self.pos) - 1
+        while size > 0:
+            offset, length, data = self.segments[index]
+            index += 1
+
+            n = min(size, offset + length - self.pos)
+            if isinstance(data, bytes):
+                chunk = data[self.pos - offset : self.pos - offset + n]
+            else:
+                self.fp.seek(data + self.pos - offset)
+                chunk = self.fp.read(n)
+                if len(chunk) < n:
+                    raise IOError("The file got shorter while it was being sent")
+            chunks.append(chunk)
+            self.pos += n
+            size -= n
+
+        return b"".join(chunks)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += self.length
+        self.pos = max(0, min(offset, self.length))
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def seekable(self):
+        return True
+
+    def readable(self):
+        return True
+
+    def close(self):
+        self.fp.close()
+
+
+class ChunkBudget(object):
+    """
+    The memory that the chunks of all of the transfers in progress can use
+    together. When there are lots of transfers, each one gets smaller chunks.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.sizes = {}
+
+    def reserve(self, chunker, wanted):
+        """
+        Return how big the next chunk of chunker can be, at most wanted bytes
+        """
+        with self.lock:
+            others = sum(size for c, size in self.sizes.items() if c is not chunker)
+            size = max(chunker.min_size, min(wanted, self.size - others))
+            self.sizes[chunker] = size
+            return size
+
+    def release(self, chunker):
+        with self.lock:
+            self.sizes.pop(chunker, None)
+
+
+class AdaptiveChunker(object):
+    """
+    Decides how much of a file to read at a time, for transfers that get sent a
+    chunk at a time. The time between one chunk being asked for and the next is
+    how long the server took to send it, so the chunk size grows while chunks
+    drain quickly, like over a LAN, and shrinks when they drain slowly, like
+    over Tor. It stays between min_size and max_size, and within the budget
+    shared with the other transfers.
+    """
+
+    min_size = 16 * 1024  # 16kb
+    max_size = 1024 * 1024  # 1mb
+
+    # Aim for chunks that take about this many seconds to send
+    target_interval = 0.05
+
+    def __init__(self, size=102400, budget=None):
+        self.size = size
+        self.budget = budget
+        self.last_time = None
+
+        # The biggest chunk that's been asked for
+        self.peak_size = 0
+
+    def next_size(self):
+        """
+        The size of the next chunk to read
+        """
+        now = time.monotonic()
+        if self.last_time is not None:
+            interval = now - self.last_time
+            if interval < self.target_interval / 2:
+                self.size *= 2
+            elif interval > self.target_interval * 2:
+                self.size //= 2
+            self.size = max(self.min_size, min(self.size, self.max_size))
+        self.last_time = now
+
+        size = self.size
+        if self.budget is not None:
+            size = self.budget.reserve(self, size)
+        self.peak_size = max(self.peak_size, size)
+        return size
+
+    def close(self):
+        if self.budget is not None:
+            self.budget.release(self)
+
+
+class ChunkIterator(object):
+    """
+    Iterate over a file in chunks sized by an AdaptiveChunker, for WSGI servers
+    that don't have a wsgi.file_wrapper. Closing the iterator closes the file.
+    """
+
+    def __init__(self, fp, chunker):
+        self.fp = fp
+        self.chunker = chunker
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        data = self.fp.read(self.chunker.next_size())
+        if not data:
+            raise StopIteration()
+        return data
+
+    def close(self):
+        self.chunker.close()
+        self.fp.close()
+
+
+class Transfer(object):
+    """
+    The state of a single download or upload. Each request gets its own, so
+    concurrent transfers don't step on each other.
+    """
+
+    # Report the progress of a transfer at most this many times per second
+    progress_rate = 10
+
+    def __init__(self, registry, history_id, path, total_bytes=None, exclusive=False):
+        self.registry = registry
+        self.history_id = history_id
+        self.path = path
+        self.total_bytes = total_bytes
+        self.exclusive = exclusive
+        self.started = time.time()
+
+        self.transferred_bytes = 0
+        self.reported_bytes = None
+        self.reported_at = None
+        self.canceled = False
+        self.done = False
+        self.complete = False
+
+    def update(self, transferred_bytes):
+        """
+        Record the progress of the transfer, and return True if it's time to report
+        it: the first time, when it reaches total_bytes, and otherwise at most
+        progress_rate times per second.
+        """
+        self.transferred_bytes = transferred_bytes
+        now = time.monotonic()
+        if (
+            self.reported_at is None
+            or transferred_bytes == self.total_bytes
+            or now - self.reported_at >= 1 / self.progress_rate
+        ):
+            self.reported_at = now
+            self.reported_bytes = transferred_bytes
+            return True
+        return False
+
+    def unreported(self):
+        """
+        Has there been progress since it was last reported?
+        """
+        return self.transferred_bytes != self.reported_bytes
+
+    def mark_reported(self):
+        self.reported_at = time.monotonic()
+        self.reported_bytes = self.transferred_bytes
+
+    def cancel(self):
+        """
+        Stop this transfer, but not the others
+        """
+        self.canceled = True
+
+    def is_canceled(self):
+        """
+        Has this transfer been canceled, or has the user stopped the server?
+        """
+        return self.canceled or not self.registry.stop_q.empty()
+
+    def finish(self, complete):
+        """
+        The transfer is over, whether or not it completed. Returns False if it
+        had already finished.
+        """
+        return self.registry.finish(self, complete)
+
+    def chunker(self, size):
+        """
+        Make an AdaptiveChunker for this transfer, starting with chunks of size
+        bytes
+        """
+        return AdaptiveChunker(size, self.registry.chunk_budget)
+
+
+class TransferRegistry(object):
+    """
+    Keeps track of the history ids and the transfers in progress of a mode.
+    waitress handles requests in several threads at once, so everything in here
+    is protected by a lock.
+    """
+
+    # How much memory the chunks of all of the transfers can use together
+    chunk_budget_size = 64 * 1024 * 1024  # 64mb
+
+    def __init__(self, stop_q, events=None):
+        self.stop_q = stop_q
+
+        # If there's an event bus, it hears about each transfer that's over
+        self.events = events
+        self.lock = threading.Lock()
+        self.chunk_budget = ChunkBudget(self.chunk_budget_size)
+
+        # The number of history ids handed out, so also the next history id
+        self.history_count = 0
+        self.transfers = []
+
+    def new_history_id(self):
+        """
+        Get the history id for a new request
+        """
+        with self.lock:
+            history_id = self.history_count
+            self.history_count += 1
+            return history_id
+
+    def reset_history(self):
+        """
+        Start counting history ids from 0 again, when the GUI clears its history
+        """
+        with self.lock:
+            self.history_count = 0
+
+    def start(self, path, total_bytes=None, history_id=None, exclusive=False):
+        """
+        Start a transfer, with a new history id unless it's given one. Only one
+        exclusive transfer can run at a time: if one is already in progress, this
+        returns None instead.
+        """
+        with self.lock:
+            if exclusive and any(t.exclusive for t in self.transfers):
+                return None
+            if history_id is None:
+                history_id = self.history_count
+                self.history_count += 1
+            transfer = Transfer(self, history_id, path, total_bytes, exclusive)
+            self.transfers.append(transfer)
+            return transfer
+
+    def finish(self, transfer, complete):
+        """
+        Stop keeping track of a transfer that's over
+        """
+        with self.lock:
+            if transfer.done:
+                return False
+            transfer.done = True
+            transfer.complete = complete
+            self.transfers.remove(transfer)
+        if self.events is not None:
+            self.events.publish(
+                Event(
+                    REQUEST_TRANSFER_FINISHED,
+                    transfer.path,
+                    {"id": transfer.history_id, "complete": complete},
+                )
+            )
+        return True
+
+    def in_progress(self):
+        """
+        Return a list of the transfers in progress
+        """
+        with self.lock:
+            return list(self.transfers)
+
+    def exclusive_in_progress(self):
+        """
+        Is an exclusive transfer in progress?
+        """
+        with self.lock:
+            return any(t.exclusive for t in self.transfers)
+
+    def cancel(self, history_id):
+        """
+        Cancel the transfer with this history id. Returns False if it's not in
+        progress.
+        """
+        with self.lock:
+            for transfer in self.transfers:
+                if transfer.history_id == history_id:
+                    transfer.cancel()
+                    return True
+            return False
@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+"""
+OnionShare | https://onionshare.org/
+
+Copyright (C) 2014-2022 Micah Lee, et al. <micah@micahflee.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import collections
+import itertools
+import os
+import queue
+import threading
+
+from .compression import should_compress
+
+
+class VariantCache(object):
+    """
+    The compressed copies of individual files, one for each content-encoding
+    that's asked for, so each file only gets compressed once per encoding. They're
+    kept in a temporary directory, and when they take up more than budget bytes,
+    the least recently used ones get deleted.
+
+    Small files get compressed in the request that first asks for them. Bigger
+    ones get compressed in a background thread, and are sent as they are until
+    they're ready. HTML, CSS and JavaScript are likely to be asked for, so
+    precompress() compresses them ahead of time.
+    """
+
+    budget = 256 * 1024 * 1024  # 256mb
+
+    # Files up to this size get compressed in the request that asks for them
+    sync_size = 1024 * 1024  # 1mb
+
+    precompress_extensions = {".css", ".htm", ".html", ".js", ".json", ".mjs", ".svg"}
+
+    # Requests go ahead of precompressing
+    PRIORITY_REQUEST = 0
+    PRIORITY_PRECOMPRESS = 1
+
+    def __init__(self, common, tmp_dir, compress, budget=None):
+        """
+        compress(input_filename, output_filename, encoding) compresses a file, and
+        returns the ETag of the compressed copy.
+        """
+        self.common = common
+        self.tmp_dir = tmp_dir
+        self.compress = compress
+        if budget is not None:
+            self.budget = budget
+
+        self.lock = threading.Lock()
+        self.counter = itertools.count()
+
+        # Entries are dicts keyed by (filename, encoding), with the key of the file
+        # they were made from, whether they're ready, and their variant: the tuple
+        # (variant_filename, variant_filesize, variant_etag), or None if the file
+        # isn't worth compressing. The most recently used ones are at the end.
+        self.entries = collections.OrderedDict()
+
+        # The size of all of the compressed copies
+        self.size = 0
+
+        # Clearing the cache starts a new generation, so the background thread
+        # forgets about files of the old one
+        self.generation = 0
+        self.queue = queue.PriorityQueue()
+        self.thread = None
+
+    @staticmethod
+    def file_key(st):
+        return (st.st_size, st.st_mtime_ns, st.st_ino)
+
+    def open(self, filename, st, encoding):
+        """
+        Open the copy of a file compressed with encoding, given the result of
+        os.stat(). Returns the tuple (fp, variant_filesize, variant_etag), or None
+        if the file isn't worth compressing or hasn't been compressed yet.
+        """
+        cache_key = (filename, encoding)
+        key = self.file_key(st)
+        with self.lock:
+            entry = self.entries.get(cache_key)
+            if entry is not None and entry["key"] != key:
+                # The file changed since it was compressed
+                self._remove(cache_key)
+                entry = None
+            if entry is None:
+                entry = self._add(filename, encoding, key)
+            else:
+                self.entries.move_to_end(cache_key)
+
+            if entry["ready"].is_set():
+                return self._open(entry)
+
+            if st.st_size > self.sync_size:
+                # Send it as it is until the background thread has compressed it
+                enqueue = not entry["building"] and not entry["queued"]
+                entry["queued"] = True
+            else:
+                enqueue = False
+                build = not entry["building"]
+                entry["building"] = True
+
+        if st.st_size > self.sync_size:
+            if enqueue:
+                self._enqueue(self.PRIORITY_REQUEST, filename, encoding)
+            return None
+
+        if build:
+            self._build(entry)
+        else:
+            # Another request or the background thread is compressing it
+            entry["ready"].wait()
+        with self.lock:
+            return self._open(entry)
+
+    def precompress(self, filenames, encodings):
+        """
+        Compress the files that are likely to be asked for in the background, with
+        each of the encodings
+        """
+        for filename in filenames:
+            extension = os.path.splitext(filename)[1].lower()
+            if extension in self.precompress_extensions:
+                for encoding in encodings:
+                    self._enqueue(self.PRIORITY_PRECOMPRESS, filename, encoding)
+
+    def clear(self):
+        """
+        Delete all of the compressed copies, when the files being shared change
+        """
+        with self.lock:
+            self.generation += 1
+            for cache_key in list(self.entries):
+                self._remove(cache_key)
+
+    def _add(self, filename, encoding, key):
+        entry = {
+            "filename": filename,
+            "encoding": encoding,
+            "key": key,
+            "queued": False,
+            "building": False,
+            "ready": threading.Event(),
+            "variant": None,
+        }
+        self.entries[(filename, encoding)] = entry
+        return entry
+
+    def _open(self, entry):
+        if entry["variant"] is None:
+            return None
+        if self.entries.get((entry["filename"], entry["encoding"])) is not entry:
+            # It got evicted or cleared
+            return None
+        variant_filename, variant_filesize, variant_etag = entry["variant"]
+        return open(variant_filename, "rb"), variant_filesize, variant_etag
+
+    def _remove(self, cache_key):
+        """
+        Forget a compressed copy, and delete it. Call with the lock held.
+        """
+        entry = self.entries.pop(cache_key)
+        if entry["variant"] is not None:
+            self.size -= entry["variant"][1]
+            try:
+                os.remove(entry["variant"][0])
+            except OSError:
+                # On Windows, a copy that's being sent can't be deleted yet. It
+                # gets deleted with the temporary directory.
+                pass
+            entry["variant"] = None
+
+    def _evict(self):
+        """
+        Delete the least recently used copies until they fit in the budget. Call
+        with the lock held.
+        """
+        for cache_key in list(self.entries):
+            if self.size <= self.budget:
+                break
+            entry = self.entries[cache_key]
+            if entry["ready"].is_set() and entry["variant"] is not None:
+                self._remove(cache_key)
+
+    def _build(self, entry):
+        """
+        Compress a file, and only keep the copy if it's smaller
+        """
+        filename = entry["filename"]
+        variant = None
+        variant_filename = os.path.join(
+            self.tmp_dir, f"{next(self.counter)}.{entry['encoding']}"
+        )
+        try:
+            try:
+                if should_compress(filename):
+                    variant_etag = self.compress(
+                        filename, variant_filename, entry["encoding"]
+                    )
+                    variant_filesize = os.path.getsize(variant_filename)
+                    if variant_filesize < entry["key"][0]:
+                        variant = (variant_filename, variant_filesize, variant_etag)
+                    else:
+                        os.remove(variant_filename)
+            except Exception as e:
+                # Compressors raise their own errors too, like zlib.error, and the
+                # file just gets sent as it is
+                self.common.log("VariantCache", "_build", f"failed to compress: {e}")
+                if os.path.exists(variant_filename):
+                    os.remove(variant_filename)
+
+            with self.lock:
+                if self.entries.get((filename, entry["encoding"])) is entry:
+                    entry["variant"] = variant
+                    if variant is not None:
+                        self.size += variant[1]
+                        self._evict()
+                elif variant is not None:
+                    # It got removed while it was being compressed
+                    os.remove(variant[0])
+        finally:
+            # Other requests wait for this, so it always has to be set
+            entry["ready"].set()
+
+    def _enqueue(self, priority, filename, encoding):
+        with self.lock:
+            self.queue.put(
+                (priority, next(self.counter), self.generation, filename, encoding)
+            )
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._worker, daemon=True)
+                self.thread.start()
+
+    def _worker(self):
+        while True:
+            priority, _, generation, filename, encoding = self.queue.get()
+            try:
+                self._compress_queued(priority, generation, filename, encoding)
+            finally:
+                self.queue.task_done()
+
+    def _compress_queued(self, priority, generation, filename, encoding):
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return
+
+        cache_key = (filename, encoding)
+        key = self.file_key(st)
+        with self.lock:
+            if generation != self.generation:
+                return
+            if priority == self.PRIORITY_PRECOMPRESS and self.size >= self.budget:
+                # Don't push out copies that have been asked for, to make room for
+                # ones that might not be
+                return
+            entry = self.entries.get(cache_key)
+            if entry is not None and entry["key"] != key:
+                self._remove(cache_key)
+                entry = None
+            if entry is None:
+                entry = self._add(filename, encoding, key)
+            if entry["ready"].is_set() or entry["building"]:
+                return
+            entry["building"] = True
+
+        self._build(entry)
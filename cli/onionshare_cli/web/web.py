@@ -38,6 +38,7 @@ from flask import (
 from flask_compress import Compress
 from flask_socketio import SocketIO
 
+from . import events
 from .share_mode import ShareModeWeb
 from .receive_mode import ReceiveModeWeb, ReceiveModeWSGIMiddleware, ReceiveModeRequest
 from .website_mode import WebsiteModeWeb
@@ -67,20 +68,21 @@ class Web:
     The Web object is the OnionShare web server, powered by flask
     """
 
-    REQUEST_LOAD = 0
-    REQUEST_STARTED = 1
-    REQUEST_PROGRESS = 2
-    REQUEST_CANCELED = 3
-    REQUEST_UPLOAD_INCLUDES_MESSAGE = 4
-    REQUEST_UPLOAD_FILE_RENAMED = 5
-    REQUEST_UPLOAD_SET_DIR = 6
-    REQUEST_UPLOAD_FINISHED = 7
-    REQUEST_UPLOAD_CANCELED = 8
-    REQUEST_INDIVIDUAL_FILE_STARTED = 9
-    REQUEST_INDIVIDUAL_FILE_PROGRESS = 10
-    REQUEST_INDIVIDUAL_FILE_CANCELED = 11
-    REQUEST_ERROR_DATA_DIR_CANNOT_CREATE = 12
-    REQUEST_OTHER = 13
+    REQUEST_LOAD = events.REQUEST_LOAD
+    REQUEST_STARTED = events.REQUEST_STARTED
+    REQUEST_PROGRESS = events.REQUEST_PROGRESS
+    REQUEST_CANCELED = events.REQUEST_CANCELED
+    REQUEST_UPLOAD_INCLUDES_MESSAGE = events.REQUEST_UPLOAD_INCLUDES_MESSAGE
+    REQUEST_UPLOAD_FILE_RENAMED = events.REQUEST_UPLOAD_FILE_RENAMED
+    REQUEST_UPLOAD_SET_DIR = events.REQUEST_UPLOAD_SET_DIR
+    REQUEST_UPLOAD_FINISHED = events.REQUEST_UPLOAD_FINISHED
+    REQUEST_UPLOAD_CANCELED = events.REQUEST_UPLOAD_CANCELED
+    REQUEST_INDIVIDUAL_FILE_STARTED = events.REQUEST_INDIVIDUAL_FILE_STARTED
+    REQUEST_INDIVIDUAL_FILE_PROGRESS = events.REQUEST_INDIVIDUAL_FILE_PROGRESS
+    REQUEST_INDIVIDUAL_FILE_CANCELED = events.REQUEST_INDIVIDUAL_FILE_CANCELED
+    REQUEST_ERROR_DATA_DIR_CANNOT_CREATE = events.REQUEST_ERROR_DATA_DIR_CANNOT_CREATE
+    REQUEST_OTHER = events.REQUEST_OTHER
+    REQUEST_TRANSFER_FINISHED = events.REQUEST_TRANSFER_FINISHED
 
     def __init__(self, common, is_gui, mode_settings, mode="share"):
         self.common = common
@@ -141,9 +143,20 @@ class Web:
             ("Server", "OnionShare"),
         ]
 
-        self.q = queue.Queue()
-
-        self.done = False
+        # Events about requests go to the consumers subscribed to the event bus. The
+        # GUI reads them from a queue, and the CLI prints the progress of downloads
+        self.events = events.EventBus()
+        self.q = None
+        if self.is_gui:
+            self.q = self.events.subscribe(events.EventQueue())
+        if self.mode in ("share", "website") and (
+            not self.is_gui
+            or self.common.platform == "Linux"
+            or self.common.platform == "BSD"
+        ):
+            self.events.subscribe(
+                events.ProgressPrinter(self.common, self.settings, self.mode)
+            )
 
         # shutting down the server only works within the context of flask, so the easiest way to do it is over http
         self.shutdown_password = self.common.random_string(16)
@@ -243,22 +256,19 @@ class Web:
         @self.app.errorhandler(404)
         def not_found(e):
             mode = self.get_mode()
-            history_id = mode.cur_history_id
-            mode.cur_history_id += 1
+            history_id = mode.transfers.new_history_id()
             return self.error404(history_id)
 
         @self.app.errorhandler(405)
         def method_not_allowed(e):
             mode = self.get_mode()
-            history_id = mode.cur_history_id
-            mode.cur_history_id += 1
+            history_id = mode.transfers.new_history_id()
             return self.error405(history_id)
 
         @self.app.errorhandler(500)
         def method_not_allowed(e):
             mode = self.get_mode()
-            history_id = mode.cur_history_id
-            mode.cur_history_id += 1
+            history_id = mode.transfers.new_history_id()
             return self.error500(history_id)
 
         if self.mode != "website":
@@ -318,7 +328,7 @@ class Web:
         """
         Add a request to the queue, to communicate with the GUI.
         """
-        self.q.put({"type": request_type, "path": path, "data": data})
+        self.events.publish(events.Event(request_type, path, data))
 
     def verbose_mode(self):
         """
@@ -393,6 +403,10 @@ class Web:
 
         self.cleanup_tempdirs = []
 
+        # Delete old archives of persistent shares
+        if self.share_mode and self.share_mode.archive_cache:
+            self.share_mode.archive_cache.cleanup()
+
     def waitress_custom_shutdown(self):
         """Shutdown the Waitress server immediately"""
         # Code borrowed from https://github.com/Pylons/webtest/blob/4b8a3ebf984185ff4fefb31b4d0cf82682e1fcf7/webtest/http.py#L93-L104
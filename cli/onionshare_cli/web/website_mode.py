@@ -19,8 +19,9 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 import os
-from flask import render_template, make_response
+from flask import stream_template
 
+from .hot_cache import HotFileCache
 from .send_base_mode import SendBaseModeWeb
 
 
@@ -29,8 +30,13 @@ class WebsiteModeWeb(SendBaseModeWeb):
     All of the web logic for website mode
     """
 
+    # Listings only depend on what's in the directory, so keep the rendered pages
+    cache_listing_html = True
+
     def init(self):
-        pass
+        # The stylesheets, scripts and icons of a website get asked for on every
+        # page, so keep them in memory
+        self.hot_cache = HotFileCache(self.variant_cache, self.file_etag)
 
     def define_routes(self):
         """
@@ -49,25 +55,27 @@ class WebsiteModeWeb(SendBaseModeWeb):
             return self.render_logic(path)
 
     def directory_listing_template(
-        self, path, files, dirs, breadcrumbs, breadcrumbs_leaf
+        self, path, files, dirs, breadcrumbs, breadcrumbs_leaf, next_page=None
     ):
-        return make_response(
-            render_template(
-                "listing.html",
-                path=path,
-                files=files,
-                dirs=dirs,
-                breadcrumbs=breadcrumbs,
-                breadcrumbs_leaf=breadcrumbs_leaf,
-                static_url_path=self.web.static_url_path,
-                title=self.web.settings.get("general", "title"),
-            )
+        return stream_template(
+            "listing.html",
+            path=path,
+            files=files,
+            dirs=dirs,
+            breadcrumbs=breadcrumbs,
+            breadcrumbs_leaf=breadcrumbs_leaf,
+            next_page=next_page,
+            static_url_path=self.web.static_url_path,
+            title=self.web.settings.get("general", "title"),
         )
 
     def set_file_info_custom(self, filenames, processed_size_callback):
         self.common.log("WebsiteModeWeb", "set_file_info_custom")
         self.web.cancel_compression = True
 
+        # Compress the HTML, CSS and JavaScript before anyone asks for it
+        self.variant_cache.precompress(self.files.values(), self.encodings)
+
     def render_logic(self, path=""):
         # Strip trailing slash
         path = path.rstrip("/")
@@ -86,11 +94,7 @@ class WebsiteModeWeb(SendBaseModeWeb):
                 else:
                     # Otherwise, render directory listing, and enforce trailing slash
                     # which can help with relative asset links in sub-directories.
-                    filenames = []
-                    for filename in os.listdir(filesystem_path):
-                        filenames.append(filename)
-                    filenames.sort()
-                    return self.directory_listing(filenames, path, filesystem_path, True)
+                    return self.directory_listing(None, path, filesystem_path, True)
 
             # If it's a file
             elif os.path.isfile(filesystem_path):
@@ -98,8 +102,7 @@ class WebsiteModeWeb(SendBaseModeWeb):
 
             # If it's not a directory or file, throw a 404
             else:
-                history_id = self.cur_history_id
-                self.cur_history_id += 1
+                history_id = self.transfers.new_history_id()
                 return self.web.error404(history_id)
         else:
             # Special case loading /
@@ -117,6 +120,5 @@ class WebsiteModeWeb(SendBaseModeWeb):
 
             else:
                 # If the path isn't found, throw a 404
-                history_id = self.cur_history_id
-                self.cur_history_id += 1
+                history_id = self.transfers.new_history_id()
                 return self.web.error404(history_id)
@@ -1,9 +1,17 @@
+import gzip
+import hashlib
+import json
+import logging
 import os
+import queue
 import random
 import re
+import socket
 import subprocess
+import tarfile
 import time
 import zipfile
+import zlib
 import tempfile
 import base64
 import shutil
@@ -17,10 +25,29 @@ from urllib.request import urlopen, Request
 from werkzeug.datastructures import Headers
 from werkzeug.exceptions import RequestedRangeNotSatisfiable
 from werkzeug.serving import make_server
+from waitress.buffers import ReadOnlyFileBasedBuffer
+from waitress.server import create_server
 
 from onionshare_cli.common import Common
+from onionshare_cli.file_scan import FileScan
 from onionshare_cli.web import Web
-from onionshare_cli.web.share_mode import parse_range_header
+from onionshare_cli.web.send_base_mode import parse_range_header
+from onionshare_cli.web.share_mode import make_etag, ZipWriter
+from onionshare_cli.web.archive_stream import TarStream, ZipStream
+from onionshare_cli.web.containment import ContainmentCache
+from onionshare_cli.web.compression import negotiate_encoding, should_compress, zstd
+from onionshare_cli.web.events import Event, EventMetrics, EventQueue
+from onionshare_cli.web.hot_cache import HotFileCache
+from onionshare_cli.web.listing_cache import ListingCache
+from onionshare_cli.web.path_index import PathIndex
+from onionshare_cli.web.variant_cache import VariantCache
+from onionshare_cli.web.transfers import (
+    AdaptiveChunker,
+    ChunkBudget,
+    ChunkIterator,
+    ProgressFile,
+    TransferRegistry,
+)
 from onionshare_cli.settings import Settings
 from onionshare_cli.mode_settings import ModeSettings
 import onionshare_cli.web.receive_mode
@@ -127,6 +154,41 @@ class TestWeb:
             )
             assert web.running is True
 
+    def test_share_mode_streaming_archive(self, temp_dir, common_obj):
+        common_obj.settings = Settings(common_obj)
+        mode_settings = ModeSettings(common_obj)
+        mode_settings.set("share", "streaming_archive", True)
+        web = Web(common_obj, False, mode_settings, "share")
+        web.app.testing = True
+
+        share_dir = tempfile.mkdtemp(dir=temp_dir.name)
+        os.makedirs(os.path.join(share_dir, "nested"))
+        with open(os.path.join(share_dir, "text.txt"), "wb") as f:
+            f.write(b"onionshare " * 10000)
+        with open(os.path.join(share_dir, "nested", "random.bin"), "wb") as f:
+            f.write(os.urandom(300000))
+        web.share_mode.set_file_info([share_dir])
+
+        # Nothing gets compressed ahead of time
+        assert web.share_mode.zip_writer is None
+        assert web.share_mode.download_filesize == 410000
+
+        with web.app.test_client() as c:
+            res = c.get("/download")
+            data = res.get_data()
+            assert res.status_code == 200
+            assert res.mimetype == "application/zip"
+            assert res.headers["Accept-Ranges"] == "none"
+            assert "Content-Length" not in res.headers
+
+        with zipfile.ZipFile(BytesIO(data)) as z:
+            assert z.testzip() is None
+            assert sorted(z.namelist()) == ["nested/random.bin", "text.txt"]
+            assert z.read("text.txt") == b"onionshare " * 10000
+            # Random data doesn't compress, so it's stored as is
+            assert z.getinfo("text.txt").compress_type == zipfile.ZIP_DEFLATED
+            assert z.getinfo("nested/random.bin").compress_type == zipfile.ZIP_STORED
+
     def test_receive_mode(self, temp_dir, common_obj):
         web = web_obj(temp_dir, common_obj, "receive")
         assert web.mode == "receive"
@@ -351,25 +413,40 @@ class TestZipWriterDefault:
         assert bool(DEFAULT_ZW_FILENAME_REGEX.match(zw_filename))
 
     def test_zipfile_filename_matches_zipwriter_filename(self, default_zw):
-        assert default_zw.z.filename == default_zw.zip_filename
-
-    def test_zipfile_allow_zip64(self, default_zw):
-        assert default_zw.z._allowZip64 is True
+        assert default_zw.zip_file.name == default_zw.zip_filename
+
+    def test_zipfile_allow_zip64(self, monkeypatch, tmp_path):
+        # Pretend that 2 files are more than a zip can count without Zip64
+        monkeypatch.setattr("onionshare_cli.web.archive_stream.ZIP_FILECOUNT_LIMIT", 2)
+        os.mkdir(os.path.join(tmp_path, "files"))
+        for i in range(3):
+            with open(os.path.join(tmp_path, "files", f"file{i}.txt"), "wb") as f:
+                f.write(b"onionshare " * i)
+        zw = ZipWriter(Common(), zip_filename=os.path.join(tmp_path, "zip64.zip"))
+        zw.add_dir(os.path.join(tmp_path, "files"))
+        zw.close()
+
+        with open(zw.zip_filename, "rb") as f:
+            assert b"PK\x06\x06" in f.read()
+        with zipfile.ZipFile(zw.zip_filename) as z:
+            assert z.testzip() is None
+            assert len(z.namelist()) == 3
 
     def test_zipfile_mode(self, default_zw):
-        assert default_zw.z.mode == "w"
+        assert default_zw.zip_file.mode == "wb"
 
     def test_callback(self, default_zw):
         assert default_zw.processed_size_callback(None) is None
 
     def test_add_file(self, default_zw, temp_file_1024_delete):
         default_zw.add_file(temp_file_1024_delete.name)
-        zipfile_info = default_zw.z.getinfo(
-            os.path.basename(temp_file_1024_delete.name)
-        )
+        entry = default_zw.entries[-1]
 
-        assert zipfile_info.compress_type == zipfile.ZIP_DEFLATED
-        assert zipfile_info.file_size == 1024
+        assert entry["member"]["arcname"] == os.path.basename(
+            temp_file_1024_delete.name
+        )
+        assert entry["compress_type"] == zipfile.ZIP_DEFLATED
+        assert entry["file_size"] == 1024
 
     def test_add_directory(self, temp_dir_1024_delete, default_zw):
         previous_size = default_zw._size  # size before adding directory
@@ -397,6 +474,1353 @@ class TestZipWriterCustom:
         assert custom_zw.processed_size_callback(None) == "custom_callback"
 
 
+class TestZipWriterParallel:
+    def test_multi_chunk_files(self, tmp_path):
+        filename = os.path.join(tmp_path, "multi_chunk.bin")
+        with open(filename, "wb") as f:
+            f.write(b"onionshare " * 300000)
+            f.write(os.urandom(1500000))
+        zip_filename = os.path.join(tmp_path, "parallel.zip")
+
+        sizes = []
+        zw = ZipWriter(
+            Common(),
+            zip_filename=zip_filename,
+            processed_size_callback=sizes.append,
+            workers=4,
+        )
+        zw.add_file(filename)
+        zw.close()
+
+        with zipfile.ZipFile(zip_filename) as z:
+            assert z.testzip() is None
+            with open(filename, "rb") as f:
+                assert z.read("multi_chunk.bin") == f.read()
+        assert sizes[-1] == os.path.getsize(filename)
+        assert len(sizes) > 2
+
+    def test_cancel_compression(self, tmp_path):
+        dirname = os.path.join(tmp_path, "cancel")
+        os.makedirs(dirname)
+        for i in range(3):
+            with open(os.path.join(dirname, f"file{i}"), "wb") as f:
+                f.write(os.urandom(1024))
+
+        zw = ZipWriter(
+            Common(), zip_filename=os.path.join(tmp_path, "cancel.zip")
+        )
+        zw.cancel_compression = True
+        assert zw.add_dir(dirname) is False
+        assert zw.add_file(os.path.join(dirname, "file0")) is False
+        zw.close()
+
+
+class TestCompression:
+    def test_compressed_types(self):
+        assert should_compress("notes.txt") is True
+        assert should_compress("index.html") is True
+        assert should_compress("photo.jpg") is False
+        assert should_compress("video.mp4") is False
+        assert should_compress("archive.zip") is False
+        assert should_compress("archive.tar.gz") is False
+        assert should_compress("message.gpg") is False
+        assert should_compress("drawing.svg") is True
+
+    def test_trial_compression(self, tmp_path):
+        compressible = os.path.join(tmp_path, "compressible")
+        with open(compressible, "wb") as f:
+            f.write(b"onionshare " * 10000)
+        random_data = os.path.join(tmp_path, "random")
+        with open(random_data, "wb") as f:
+            f.write(os.urandom(100000))
+
+        assert should_compress(compressible) is True
+        assert should_compress(random_data) is False
+
+    def test_negotiate_encoding(self):
+        encodings = ["br", "zstd", "gzip"]
+        assert negotiate_encoding("gzip, deflate, br, zstd", encodings) == "br"
+        assert negotiate_encoding("gzip, zstd", encodings) == "zstd"
+        assert negotiate_encoding("br;q=0.5, gzip", encodings) == "gzip"
+        assert negotiate_encoding("br;q=0, *", encodings) == "zstd"
+        assert negotiate_encoding("identity", encodings) is None
+        assert negotiate_encoding("", encodings) is None
+        assert negotiate_encoding(None, encodings) is None
+        assert negotiate_encoding("GZIP;Q=0", encodings) is None
+
+    def test_individual_file_encodings(self, tmp_path, common_obj):
+        brotli = pytest.importorskip("brotli")
+        zstd = pytest.importorskip("backports.zstd")
+        common_obj.settings = Settings(common_obj)
+        web = Web(common_obj, False, ModeSettings(common_obj), "website")
+        web.app.testing = True
+        site_dir = tmp_path / "site"
+        site_dir.mkdir()
+        contents = b"<p>hello</p>\n" * 1000
+        (site_dir / "page.html").write_bytes(contents)
+        web.website_mode.set_file_info([str(site_dir)])
+
+        with web.app.test_client() as c:
+            etags = set()
+            for accept_encoding, encoding, decompress in (
+                ("gzip, deflate, br, zstd", "br", brotli.decompress),
+                ("gzip, zstd", "zstd", zstd.decompress),
+                ("gzip", "gzip", gzip.decompress),
+                ("identity", None, lambda data: data),
+            ):
+                res = c.get("/page.html", headers={"Accept-Encoding": accept_encoding})
+                assert res.headers.get("Content-Encoding") == encoding
+                assert res.headers["Vary"] == "Accept-Encoding"
+                assert decompress(res.get_data()) == contents
+                etags.add(res.headers["ETag"])
+
+            # Each encoding has its own ETag
+            assert len(etags) == 4
+
+    def test_zip_writer_stores_compressed_files(self, tmp_path):
+        filename = os.path.join(tmp_path, "random.bin")
+        with open(filename, "wb") as f:
+            f.write(os.urandom(100000))
+
+        zw = ZipWriter(Common(), zip_filename=os.path.join(tmp_path, "stored.zip"))
+        zw.add_file(filename)
+        zw.close()
+
+        assert zw.stored_files == 1
+        with zipfile.ZipFile(zw.zip_filename) as z:
+            assert z.getinfo("random.bin").compress_type == zipfile.ZIP_STORED
+            assert z.testzip() is None
+
+    def test_single_file_skips_gzip(self, temp_dir, common_obj):
+        web = web_obj(temp_dir, common_obj, "share", 0)
+        filename = os.path.join(temp_dir.name, "photo.jpg")
+        with open(filename, "wb") as f:
+            f.write(os.urandom(1024))
+        web.share_mode.set_file_info([filename])
+
+        assert web.share_mode.gzip_filename is None
+        assert web.share_mode.compression_ratio is None
+
+        with web.app.test_client() as c:
+            res = c.get("/download", headers={"Accept-Encoding": "gzip"})
+            assert res.status_code == 200
+            assert "Content-Encoding" not in res.headers
+            with open(filename, "rb") as f:
+                assert res.get_data() == f.read()
+
+    def test_single_file_gzip_ratio(self, temp_dir, common_obj):
+        web = web_obj(temp_dir, common_obj, "share", 0)
+        filename = os.path.join(temp_dir.name, "notes.txt")
+        with open(filename, "wb") as f:
+            f.write(b"onionshare " * 10000)
+        web.share_mode.set_file_info([filename])
+
+        assert web.share_mode.compression_ratio < 0.1
+        with web.app.test_client() as c:
+            res = c.get("/")
+            assert b"compressed to" in res.get_data()
+
+            res = c.get("/download", headers={"Accept-Encoding": "gzip"})
+            assert res.headers["Content-Encoding"] == "gzip"
+
+    def test_single_file_lazy_gzip(self, temp_dir, common_obj):
+        common_obj.settings = Settings(common_obj)
+        mode_settings = ModeSettings(common_obj)
+        mode_settings.set("share", "autostop_sharing", False)
+        mode_settings.set("share", "streaming_archive", True)
+        web = Web(common_obj, False, mode_settings, "share")
+        web.app.testing = True
+        filename = os.path.join(temp_dir.name, "notes.txt")
+        with open(filename, "wb") as f:
+            f.write(b"onionshare " * 10000)
+        web.share_mode.set_file_info([filename])
+
+        # Nothing gets compressed until a client asks for gzip
+        assert web.share_mode.gzip_filename is None
+        assert os.listdir(web.share_mode.gzip_tmp_dir.name) == []
+
+        with web.app.test_client() as c:
+            res = c.get("/download")
+            assert "Content-Encoding" not in res.headers
+            assert web.share_mode.gzip_thread is None
+
+            # The first gzip request gets the file as it is while it's compressed
+            res = c.get("/download", headers={"Accept-Encoding": "gzip"})
+            assert res.get_data() == b"onionshare " * 10000
+            web.share_mode.gzip_thread.join()
+            assert web.share_mode.compression_ratio < 0.1
+
+            res = c.get("/download", headers={"Accept-Encoding": "gzip"})
+            assert res.headers["Content-Encoding"] == "gzip"
+            assert res.headers["ETag"] == web.share_mode.gzip_etag
+            assert gzip.decompress(res.get_data()) == b"onionshare " * 10000
+
+    def test_single_file_lazy_gzip_skips_compressed(self, temp_dir, common_obj):
+        common_obj.settings = Settings(common_obj)
+        mode_settings = ModeSettings(common_obj)
+        mode_settings.set("share", "autostop_sharing", False)
+        mode_settings.set("share", "streaming_archive", True)
+        web = Web(common_obj, False, mode_settings, "share")
+        web.app.testing = True
+        filename = os.path.join(temp_dir.name, "photo.jpg")
+        with open(filename, "wb") as f:
+            f.write(os.urandom(100000))
+        web.share_mode.set_file_info([filename])
+
+        with web.app.test_client() as c:
+            c.get("/download", headers={"Accept-Encoding": "gzip"})
+            web.share_mode.gzip_thread.join()
+
+            # It didn't get smaller, so nothing is kept
+            assert web.share_mode.gzip_filename is None
+            assert os.listdir(web.share_mode.gzip_tmp_dir.name) == []
+            res = c.get("/download", headers={"Accept-Encoding": "gzip"})
+            assert "Content-Encoding" not in res.headers
+
+
+class TestETags:
+    def test_zip_etag(self, temp_dir, common_obj):
+        web = web_obj(temp_dir, common_obj, "share", 3)
+        with open(web.share_mode.download_filename, "rb") as f:
+            assert web.share_mode.download_etag == make_etag(f)
+        assert web.share_mode.download_filesize == os.path.getsize(
+            web.share_mode.download_filename
+        )
+
+    def test_single_file_etags(self, temp_dir, common_obj):
+        web = web_obj(temp_dir, common_obj, "share", 1)
+        with open(web.share_mode.download_filename, "rb") as f:
+            assert web.share_mode.download_etag == make_etag(f)
+        with open(web.share_mode.gzip_filename, "rb") as f:
+            assert web.share_mode.gzip_etag == make_etag(f)
+
+
+class TestProgressFile:
+    def waitress_buffer(self, is_canceled=lambda: False):
+        progress = []
+        done = []
+        fp = BytesIO(bytes(range(256)) * 1000)
+        progress_file = ProgressFile(
+            fp, 1000, 100000, progress.append, done.append, is_canceled
+        )
+        buf = ReadOnlyFileBasedBuffer(progress_file)
+        buf.prepare(100000)
+        return buf, progress, done
+
+    def test_waitress_progress(self):
+        buf, progress, done = self.waitress_buffer()
+
+        # Send the file the way waitress does: peek, send some of it, then skip
+        data = b""
+        while len(buf):
+            chunk = buf.get(30000)
+            data += chunk[:25000]
+            buf.skip(min(25000, len(chunk)), True)
+        buf.close()
+
+        assert data == (bytes(range(256)) * 1000)[1000:101000]
+        assert progress == [25000, 50000, 75000, 100000]
+        assert done == [True]
+
+    def test_waitress_canceled(self):
+        canceled = {"canceled": False}
+        buf, progress, done = self.waitress_buffer(lambda: canceled["canceled"])
+
+        buf.get(30000)
+        buf.skip(30000, True)
+        canceled["canceled"] = True
+        assert buf.get(30000) == b""
+        buf.close()
+
+        assert progress == [30000]
+        assert done == [False]
+
+    def test_waitress_canceled_quietly(self, temp_dir, common_obj, caplog):
+        web = web_obj(temp_dir, common_obj, "share")
+        web.settings.set("share", "autostop_sharing", False)
+        filename = os.path.join(temp_dir.name, "large.bin")
+        with open(filename, "wb") as f:
+            # Less than waitress's outbuf_high_watermark, so that waitress takes
+            # the whole file at once and its task is over
+            f.write(os.urandom(8 * 1024 * 1024))
+        web.share_mode.set_file_info([filename])
+
+        web.waitress = create_server(web.app, host="127.0.0.1", port=0)
+        thread = Thread(target=web.waitress.run, daemon=True)
+        thread.start()
+
+        with caplog.at_level(logging.INFO, logger="waitress"):
+            # Keep the socket buffers small, so that most of the file is still
+            # waiting to be sent when the server stops
+            sock = socket.socket()
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 65536)
+            sock.connect(("127.0.0.1", int(web.waitress.effective_port)))
+            sock.sendall(b"GET /download HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n")
+            received = sock.recv(65536)
+            assert received.startswith(b"HTTP/1.1 200")
+            while len(received) < 1024 * 1024:
+                received += sock.recv(65536)
+
+            # Stop the server, and read whatever waitress still sends
+            web.stop_q.put(True)
+            sock.settimeout(0.5)
+            try:
+                while True:
+                    data = sock.recv(65536)
+                    if not data:
+                        break
+                    received += data
+            except socket.timeout:
+                pass
+            web.waitress_custom_shutdown()
+            thread.join(5)
+            sock.close()
+
+        assert len(received) < 8 * 1024 * 1024
+        assert [r for r in caplog.records if r.levelno >= logging.ERROR] == []
+
+
+class TestArchiveCache:
+    def persistent_web(self, common_obj, settings_filename, share_dir):
+        common_obj.settings = Settings(common_obj)
+        mode_settings = ModeSettings(common_obj, settings_filename)
+        mode_settings.set("persistent", "enabled", True)
+        web = Web(common_obj, False, mode_settings, "share")
+        web.share_mode.set_file_info([share_dir])
+        return web
+
+    def test_reuse_archive(self, tmp_path, common_obj):
+        share_dir = os.path.join(tmp_path, "share")
+        os.makedirs(share_dir)
+        for i in range(3):
+            with open(os.path.join(share_dir, f"file{i}.txt"), "wb") as f:
+                f.write(f"onionshare {i} ".encode() * 10000)
+        settings_filename = os.path.join(tmp_path, "persistent.json")
+
+        # The first time, everything gets compressed
+        web = self.persistent_web(common_obj, settings_filename, share_dir)
+        assert web.share_mode.zip_writer.reused_files == 0
+        archive_filename = web.share_mode.download_filename
+        etag = web.share_mode.download_etag
+        web.cleanup()
+
+        # If nothing changed, the archive gets reused as is
+        web = self.persistent_web(common_obj, settings_filename, share_dir)
+        assert web.share_mode.zip_writer is None
+        assert web.share_mode.download_filename == archive_filename
+        assert web.share_mode.download_etag == etag
+        web.cleanup()
+
+        # If one file changed, only that one gets compressed again
+        with open(os.path.join(share_dir, "file1.txt"), "wb") as f:
+            f.write(b"changed " * 10000)
+        web = self.persistent_web(common_obj, settings_filename, share_dir)
+        assert web.share_mode.zip_writer.reused_files == 2
+        assert web.share_mode.download_etag != etag
+        assert not os.path.exists(archive_filename)
+
+        with zipfile.ZipFile(web.share_mode.download_filename) as z:
+            assert z.testzip() is None
+            assert z.read("file0.txt") == b"onionshare 0 " * 10000
+            assert z.read("file1.txt") == b"changed " * 10000
+        web.cleanup()
+
+    def test_download_name(self, tmp_path, common_obj):
+        share_dir = os.path.join(tmp_path, "share")
+        os.makedirs(share_dir)
+        for i in range(2):
+            with open(os.path.join(share_dir, f"file{i}.txt"), "wb") as f:
+                f.write(b"onionshare " * 10000)
+        settings_filename = os.path.join(tmp_path, "persistent.json")
+
+        # Downloaders don't see the name of the cached archive, which is derived
+        # from the path of the settings file
+        for _ in range(2):
+            web = self.persistent_web(common_obj, settings_filename, share_dir)
+            web.app.testing = True
+            with web.app.test_client() as c:
+                res = c.get("/download")
+                assert res.status_code == 200
+            disposition = res.headers["Content-Disposition"]
+            filename = re.search(r"filename=([^;]+);", disposition).group(1)
+            assert DEFAULT_ZW_FILENAME_REGEX.match(filename)
+            assert os.path.basename(web.share_mode.download_filename) not in (
+                disposition
+            )
+            web.cleanup()
+
+    def test_eviction(self, tmp_path, common_obj):
+        share_dir = os.path.join(tmp_path, "share")
+        os.makedirs(share_dir)
+        for i in range(2):
+            with open(os.path.join(share_dir, f"file{i}.txt"), "wb") as f:
+                f.write(b"onionshare " * 10000)
+
+        web1 = self.persistent_web(
+            common_obj, os.path.join(tmp_path, "persistent1.json"), share_dir
+        )
+        web2 = self.persistent_web(
+            common_obj, os.path.join(tmp_path, "persistent2.json"), share_dir
+        )
+
+        # With no budget, the archives of other shares get evicted
+        web2.share_mode.archive_cache.budget = 0
+        web2.cleanup()
+        assert not os.path.exists(web1.share_mode.download_filename)
+        assert os.path.exists(web2.share_mode.download_filename)
+
+        # Archives of shares that were deleted get cleaned up
+        web2.settings.delete()
+        web1.cleanup()
+        assert not os.path.exists(web2.share_mode.download_filename)
+
+
+class TestVariantCache:
+    def variant_cache(self, tmp_path, budget=None):
+        cache_dir = tmp_path / "cache"
+        cache_dir.mkdir()
+
+        def compress(input_filename, output_filename, encoding):
+            with open(input_filename, "rb") as f, open(output_filename, "wb") as out:
+                out.write(gzip.compress(f.read()))
+            return '"etag"'
+
+        return VariantCache(Common(), str(cache_dir), compress, budget)
+
+    def make_file(self, tmp_path, name, data):
+        filename = str(tmp_path / name)
+        with open(filename, "wb") as f:
+            f.write(data)
+        return filename
+
+    def open(self, cache, filename):
+        variant_info = cache.open(filename, os.stat(filename), "gzip")
+        if variant_info is None:
+            return None
+        fp, variant_filesize, variant_etag = variant_info
+        with fp:
+            return gzip.decompress(fp.read())
+
+    def test_compressor_error(self, tmp_path):
+        filename = self.make_file(tmp_path, "file.txt", b"onionshare" * 1000)
+
+        def compress(input_filename, output_filename, encoding):
+            with open(output_filename, "wb") as out:
+                out.write(b"partial")
+            raise zlib.error("broken")
+
+        cache_dir = tmp_path / "cache"
+        cache_dir.mkdir()
+        cache = VariantCache(Common(), str(cache_dir), compress)
+
+        # The file gets sent as it is, and later requests don't wait forever
+        for _ in range(2):
+            assert cache.open(filename, os.stat(filename), "gzip") is None
+        assert os.listdir(cache_dir) == []
+
+    def test_lru_eviction(self, tmp_path):
+        filenames = [
+            self.make_file(tmp_path, f"{i}.txt", str(i).encode() * 100000)
+            for i in range(3)
+        ]
+        gzip_filesize = len(gzip.compress(b"0" * 100000))
+        cache = self.variant_cache(tmp_path, budget=gzip_filesize * 2)
+
+        assert self.open(cache, filenames[0]) == b"0" * 100000
+        assert self.open(cache, filenames[1]) == b"1" * 100000
+        assert self.open(cache, filenames[0]) == b"0" * 100000
+
+        # 1.txt is the least recently used, so it makes room for 2.txt
+        assert self.open(cache, filenames[2]) == b"2" * 100000
+        assert list(cache.entries) == [(filenames[0], "gzip"), (filenames[2], "gzip")]
+        assert cache.size == gzip_filesize * 2
+        assert len(os.listdir(cache.tmp_dir)) == 2
+
+    def test_skips_compressed_files(self, tmp_path):
+        filename = self.make_file(tmp_path, "random.bin", os.urandom(100000))
+        cache = self.variant_cache(tmp_path)
+
+        assert self.open(cache, filename) is None
+        assert cache.entries[(filename, "gzip")]["ready"].is_set()
+        assert os.listdir(cache.tmp_dir) == []
+
+    def test_big_files_compress_in_background(self, tmp_path):
+        filename = self.make_file(tmp_path, "big.txt", b"onionshare " * 10000)
+        cache = self.variant_cache(tmp_path)
+        cache.sync_size = 1024
+
+        # It gets sent as it is until it's ready
+        assert self.open(cache, filename) is None
+        assert cache.entries[(filename, "gzip")]["ready"].wait(10)
+        assert self.open(cache, filename) == b"onionshare " * 10000
+
+    def test_precompress(self, tmp_path):
+        page = self.make_file(tmp_path, "index.html", b"<p>hello</p>\n" * 1000)
+        notes = self.make_file(tmp_path, "notes.txt", b"onionshare " * 10000)
+        cache = self.variant_cache(tmp_path)
+
+        cache.precompress([page, notes], ["gzip"])
+        cache.queue.join()
+        assert cache.entries[(page, "gzip")]["ready"].is_set()
+        assert (notes, "gzip") not in cache.entries
+
+        # Clearing the cache deletes the compressed copies
+        cache.clear()
+        assert cache.entries == {}
+        assert cache.size == 0
+        assert os.listdir(cache.tmp_dir) == []
+
+
+class TestHotFileCache:
+    def test_website_hot_files(self, tmp_path, common_obj):
+        common_obj.settings = Settings(common_obj)
+        web = Web(common_obj, False, ModeSettings(common_obj), "website")
+        web.app.testing = True
+        site_dir = tmp_path / "site"
+        site_dir.mkdir()
+        (site_dir / "style.css").write_bytes(b"body { color: black; }\n" * 100)
+        web.website_mode.set_file_info([str(site_dir)])
+        hot_cache = web.website_mode.hot_cache
+
+        with web.app.test_client() as c:
+            for _ in range(3):
+                res = c.get("/style.css", headers={"Accept-Encoding": "gzip"})
+                assert res.headers["Content-Type"].startswith("text/css")
+                assert gzip.decompress(res.get_data()) == (
+                    b"body { color: black; }\n" * 100
+                )
+            res = c.get("/style.css", headers={"Range": "bytes=0-3"})
+            assert res.get_data() == b"body"
+            assert hot_cache.misses == 1
+            assert hot_cache.hits == 3
+
+            # Changing the file reads it again
+            (site_dir / "style.css").write_bytes(b"body { color: white; }\n")
+            res = c.get("/style.css")
+            assert res.get_data() == b"body { color: white; }\n"
+            assert hot_cache.misses == 2
+
+    def test_budget(self, tmp_path):
+        filenames = []
+        for i in range(3):
+            filename = str(tmp_path / f"{i}.txt")
+            with open(filename, "wb") as f:
+                f.write(os.urandom(1000))
+            filenames.append(filename)
+        hot_cache = HotFileCache(None, lambda st: '"etag"', budget=2000)
+
+        for filename in filenames:
+            entry = hot_cache.get(filename, os.stat(filename))
+            with open(filename, "rb") as f:
+                assert hot_cache.open(entry).read() == f.read()
+
+        # The least recently used file made room for the last one
+        assert list(hot_cache.entries) == filenames[1:]
+        assert hot_cache.size == 2000
+
+        # Big files aren't kept in memory
+        hot_cache.max_size = 500
+        assert hot_cache.get(filenames[0], os.stat(filenames[0])) is None
+
+
+class TestListingCache:
+    def test_website_listing(self, tmp_path, common_obj):
+        common_obj.settings = Settings(common_obj)
+        web = Web(common_obj, False, ModeSettings(common_obj), "website")
+        web.app.testing = True
+        site_dir = tmp_path / "site"
+        photos_dir = site_dir / "photos"
+        photos_dir.mkdir(parents=True)
+        (site_dir / "about.txt").write_bytes(b"about")
+        for i in range(10):
+            (photos_dir / f"{i}.jpg").write_bytes(b"*" * i)
+        os.utime(photos_dir, (time.time() - 60, time.time() - 60))
+        web.website_mode.set_file_info([str(site_dir)])
+        listing_cache = web.website_mode.listing_cache
+
+        with web.app.test_client() as c:
+            res = c.get("/photos/")
+            assert res.status_code == 200
+            assert b"9.jpg" in res.get_data()
+            for _ in range(2):
+                assert c.get("/photos/").get_data() == res.get_data()
+            assert listing_cache.misses == 1
+            assert listing_cache.hits == 2
+            assert listing_cache.entries[(str(photos_dir), "photos")]["html"] == (
+                res.get_data()
+            )
+
+            # Adding a file changes the directory's mtime
+            (photos_dir / "new.jpg").write_bytes(b"new")
+            os.utime(photos_dir, (time.time() - 30, time.time() - 30))
+            assert b"new.jpg" in c.get("/photos/").get_data()
+            assert listing_cache.misses == 2
+
+            # Directories that just changed don't get kept
+            (photos_dir / "newer.jpg").write_bytes(b"newer")
+            assert b"newer.jpg" in c.get("/photos/").get_data()
+            assert (str(photos_dir), "photos") not in listing_cache.entries
+
+    def test_share_listing(self, temp_dir, common_obj, tmp_path):
+        web = web_obj(temp_dir, common_obj, "share")
+        share_dir = tmp_path / "share"
+        (share_dir / "docs").mkdir(parents=True)
+        (share_dir / "docs" / "a.txt").write_bytes(b"a")
+        (share_dir / "b.txt").write_bytes(b"b")
+        os.utime(share_dir / "docs", (time.time() - 60, time.time() - 60))
+        web.share_mode.set_file_info([str(share_dir)])
+        listing_cache = web.share_mode.listing_cache
+
+        with web.app.test_client() as c:
+            for _ in range(2):
+                res = c.get("/docs")
+                assert res.status_code == 200
+                assert b"a.txt" in res.get_data()
+            assert listing_cache.hits == 1
+
+            # The page shows the state of the download, so only the listing is kept
+            assert listing_cache.entries[(str(share_dir / "docs"), "docs")][
+                "html"
+            ] is None
+
+    def test_pages(self, tmp_path, common_obj):
+        common_obj.settings = Settings(common_obj)
+        web = Web(common_obj, False, ModeSettings(common_obj), "website")
+        web.app.testing = True
+        web.website_mode.listing_page_size = 4
+        site_dir = tmp_path / "site"
+        photos_dir = site_dir / "photos"
+        for i in range(3):
+            (photos_dir / f"album{i}").mkdir(parents=True)
+        for i in range(6):
+            (photos_dir / f"{i}.jpg").write_bytes(b"*")
+        web.website_mode.set_file_info([str(site_dir)])
+
+        def names(html):
+            return re.findall(r"<span>([^<]+)</span>", html)
+
+        with web.app.test_client() as c:
+            html = c.get("/photos/").get_data(as_text=True)
+            assert names(html) == ["album0", "album1", "album2", "0.jpg"]
+            assert 'href="?after=file%3A0.jpg"' in html
+
+            # Pages carry on from the last thing on the one before, even if
+            # something got added before it
+            (photos_dir / "00.jpg").write_bytes(b"*")
+            html = c.get("/photos/?after=file%3A0.jpg").get_data(as_text=True)
+            assert names(html) == ["00.jpg", "1.jpg", "2.jpg", "3.jpg"]
+            html = c.get("/photos/?after=file%3A3.jpg").get_data(as_text=True)
+            assert names(html) == ["4.jpg", "5.jpg"]
+            assert "?after=" not in html
+
+            html = c.get("/photos/?after=dir%3Aalbum1").get_data(as_text=True)
+            assert names(html) == ["album2", "0.jpg", "00.jpg", "1.jpg"]
+
+    def test_budget(self, tmp_path):
+        listing_cache = ListingCache(budget=2 * ListingCache.item_size)
+        os.utime(tmp_path, (time.time() - 60, time.time() - 60))
+        st = os.stat(tmp_path)
+        for i in range(3):
+            listing_cache.put(str(tmp_path), f"dir{i}", st, [{}], [])
+
+        # The least recently used listing made room for the last one
+        assert list(listing_cache.entries) == [
+            (str(tmp_path), "dir1"),
+            (str(tmp_path), "dir2"),
+        ]
+        assert listing_cache.get(str(tmp_path), "dir1", st) is not None
+        listing_cache.set_html(listing_cache.entries[(str(tmp_path), "dir1")], b"x")
+        assert list(listing_cache.entries) == [(str(tmp_path), "dir1")]
+
+
+class TestManifest:
+    def test_manifest(self, temp_dir, common_obj, tmp_path):
+        web = web_obj(temp_dir, common_obj, "share")
+        web.settings.set("share", "autostop_sharing", False)
+        root = TestPathIndex().make_tree(tmp_path)
+        (tmp_path / "share" / "d" / "4.txt").write_bytes(b"*" * 1024)
+        web.share_mode.set_file_info([root])
+
+        with web.app.test_client() as c:
+            res = c.get("/.onionshare/manifest.ndjson")
+            assert res.status_code == 200
+            assert res.mimetype == "application/x-ndjson"
+            entries = [json.loads(line) for line in res.get_data().splitlines()]
+            assert [entry["path"] for entry in entries] == [
+                "a",
+                "a/1.txt",
+                "a/b",
+                "a/b/2.txt",
+                "a/b/c",
+                "a/b/c/3.txt",
+                "d",
+                "d/4.txt",
+                "empty",
+                "top.txt",
+            ]
+            assert entries[0] == {"path": "a", "type": "dir"}
+            assert entries[7]["type"] == "file"
+            assert entries[7]["size"] == 1024
+            st = os.stat(os.path.join(root, "d", "4.txt"))
+            assert entries[7]["mtime"] == st.st_mtime
+
+            # Files get hashed in the background
+            web.share_mode.hash_cache.queue.join()
+            res = c.get("/.onionshare/manifest.json")
+            assert res.mimetype == "application/json"
+            files = {
+                entry["path"]: entry["sha256"]
+                for entry in res.get_json()["files"]
+                if entry["type"] == "file"
+            }
+            assert files["d/4.txt"] == hashlib.sha256(b"*" * 1024).hexdigest()
+            assert files["a/1.txt"] == hashlib.sha256(b"onionshare").hexdigest()
+
+            # Changed files get hashed again
+            (tmp_path / "share" / "d" / "4.txt").write_bytes(b"changed")
+            res = c.get("/.onionshare/manifest.json")
+            assert res.get_json()["files"][7]["sha256"] is None
+            web.share_mode.hash_cache.queue.join()
+            res = c.get("/.onionshare/manifest.json")
+            assert res.get_json()["files"][7]["sha256"] == (
+                hashlib.sha256(b"changed").hexdigest()
+            )
+
+    def test_no_individual_files(self, temp_dir, common_obj, tmp_path):
+        # Shares that stop after the files have been sent don't have a manifest
+        web = web_obj(temp_dir, common_obj, "share")
+        root = TestPathIndex().make_tree(tmp_path)
+        web.share_mode.set_file_info([root])
+
+        with web.app.test_client() as c:
+            assert c.get("/.onionshare/manifest.json").status_code == 404
+            assert c.get("/.onionshare/manifest.ndjson").status_code == 404
+        assert web.share_mode.hash_cache.pending == set()
+
+    def test_website_mode(self, common_obj, tmp_path):
+        # Websites don't list what's in them
+        common_obj.settings = Settings(common_obj)
+        web = Web(common_obj, False, ModeSettings(common_obj), "website")
+        web.app.testing = True
+        root = TestPathIndex().make_tree(tmp_path)
+        web.website_mode.set_file_info([root])
+
+        with web.app.test_client() as c:
+            res = c.get("/.onionshare/manifest.json")
+            assert res.status_code == 404
+
+
+class TestArchiveDownload:
+    def zip_names(self, res):
+        with zipfile.ZipFile(BytesIO(res.get_data())) as z:
+            assert z.testzip() is None
+            return z.namelist()
+
+    def tar_contents(self, res):
+        with tarfile.open(fileobj=BytesIO(res.get_data())) as t:
+            return {
+                member.name: t.extractfile(member).read() for member in t.getmembers()
+            }
+
+    def test_subfolder(self, temp_dir, common_obj, tmp_path):
+        web = web_obj(temp_dir, common_obj, "share")
+        web.settings.set("share", "autostop_sharing", False)
+        root = TestPathIndex().make_tree(tmp_path)
+        web.share_mode.set_file_info([root])
+
+        with web.app.test_client() as c:
+            res = c.get("/.onionshare/archive?path=a")
+            assert res.status_code == 200
+            assert res.mimetype == "application/zip"
+            assert res.headers["Content-Disposition"] == (
+                "attachment; filename=a.zip; filename*=UTF-8''a.zip"
+            )
+            # Symlinks are left out
+            assert self.zip_names(res) == ["a/1.txt", "a/b/2.txt", "a/b/c/3.txt"]
+
+            res = c.get("/.onionshare/archive?path=a/b/c&format=tar")
+            assert res.mimetype == "application/x-tar"
+            assert len(res.get_data()) % tarfile.RECORDSIZE == 0
+            assert self.tar_contents(res) == {"c/3.txt": b"onionshare"}
+
+    def test_selection(self, temp_dir, common_obj, tmp_path):
+        web = web_obj(temp_dir, common_obj, "share")
+        web.settings.set("share", "autostop_sharing", False)
+        root = TestPathIndex().make_tree(tmp_path)
+        web.share_mode.set_file_info([root])
+
+        with web.app.test_client() as c:
+            # Paths are relative to the folder they have in common
+            res = c.post(
+                "/.onionshare/archive",
+                data={"path": ["a/b/c", "a/1.txt"], "format": "tar"},
+            )
+            assert res.status_code == 200
+            assert list(self.tar_contents(res)) == ["1.txt", "b/c/3.txt"]
+
+            # Paths inside of other selected folders are only added once
+            res = c.post(
+                "/.onionshare/archive", data={"path": ["d", "a/b/2.txt", "d/4.txt"]}
+            )
+            assert self.zip_names(res) == ["a/b/2.txt", "d/4.txt"]
+
+            # No paths means everything
+            res = c.get("/.onionshare/archive?format=tar")
+            assert sorted(self.tar_contents(res)) == [
+                "a/1.txt",
+                "a/b/2.txt",
+                "a/b/c/3.txt",
+                "d/4.txt",
+                "top.txt",
+            ]
+
+    def test_not_found(self, temp_dir, common_obj, tmp_path):
+        web = web_obj(temp_dir, common_obj, "share")
+        web.settings.set("share", "autostop_sharing", False)
+        root = TestPathIndex().make_tree(tmp_path)
+        web.share_mode.set_file_info([root])
+
+        with web.app.test_client() as c:
+            assert c.get("/.onionshare/archive?path=missing").status_code == 404
+            assert c.get("/.onionshare/archive?path=a/link-dir").status_code == 404
+            assert c.get("/.onionshare/archive?path=a&format=rar").status_code == 404
+
+            # Only shares that allow downloading individual files allow this
+            web.share_mode.download_individual_files = False
+            assert c.get("/.onionshare/archive?path=a").status_code == 404
+
+    def test_long_names(self, common_obj, tmp_path):
+        name = "x" * 150
+        (tmp_path / name).write_bytes(b"a" * 1000)
+        tar_stream = TarStream(common_obj)
+        tar_stream.add_file(str(tmp_path / name))
+        data = b"".join(tar_stream.generate())
+        with tarfile.open(fileobj=BytesIO(data)) as t:
+            member = t.getmember(name)
+            assert member.size == 1000
+            assert member.uname == ""
+            assert t.extractfile(member).read() == b"a" * 1000
+
+    def test_compressed_tar(self, common_obj, tmp_path):
+        for i in range(100):
+            (tmp_path / f"{i}.txt").write_bytes(b"onionshare %d\n" % i * 100)
+        contents = {
+            f"{tmp_path.name}/{i}.txt": b"onionshare %d\n" % i * 100 for i in range(100)
+        }
+
+        tar_stream = TarStream(common_obj)
+        tar_stream.add_dir(str(tmp_path))
+        tar_data = b"".join(tar_stream.generate())
+
+        tar_stream = TarStream(common_obj, compression="gz")
+        tar_stream.add_dir(str(tmp_path))
+        assert tar_stream.tar_filename.endswith(".tar.gz")
+        assert tar_stream.content_type == "application/gzip"
+        data = b"".join(tar_stream.generate())
+        assert gzip.decompress(data) == tar_data
+        assert len(data) < len(tar_data) / 10
+        with tarfile.open(fileobj=BytesIO(data), mode="r:gz") as t:
+            for name, content in contents.items():
+                assert t.extractfile(name).read() == content
+
+        if zstd is not None:
+            tar_stream = TarStream(common_obj, compression="zst")
+            tar_stream.add_dir(str(tmp_path))
+            data = b"".join(tar_stream.generate())
+            assert zstd.decompress(data) == tar_data
+
+    def test_share_archive_format(self, temp_dir, common_obj, tmp_path):
+        common_obj.settings = Settings(common_obj)
+        mode_settings = ModeSettings(common_obj)
+        mode_settings.set("share", "autostop_sharing", False)
+        mode_settings.set("share", "archive_format", "tar.gz")
+        web = Web(common_obj, False, mode_settings, "share")
+        web.app.testing = True
+        root = TestPathIndex().make_tree(tmp_path)
+        web.share_mode.set_file_info([root])
+
+        # tar files are always built while they're being downloaded
+        assert web.share_mode.download_filename.endswith(".tar.gz")
+        assert web.share_mode.download_filesize == 5 * len(b"onionshare")
+
+        with web.app.test_client() as c:
+            res = c.get("/download")
+            assert res.status_code == 200
+            assert res.mimetype == "application/gzip"
+            with tarfile.open(fileobj=BytesIO(res.get_data()), mode="r:gz") as t:
+                assert t.getnames() == [
+                    "top.txt",
+                    "a/1.txt",
+                    "a/b/2.txt",
+                    "a/b/c/3.txt",
+                    "d/4.txt",
+                ]
+
+            # Archives of some of the files are in the same format by default
+            res = c.get("/.onionshare/archive?path=d")
+            assert res.headers["Content-Disposition"] == (
+                "attachment; filename=d.tar.gz; filename*=UTF-8''d.tar.gz"
+            )
+            with tarfile.open(fileobj=BytesIO(res.get_data()), mode="r:gz") as t:
+                assert t.getnames() == ["d/4.txt"]
+
+            res = c.get("/.onionshare/archive?path=d&format=zip")
+            assert self.zip_names(res) == ["d/4.txt"]
+
+
+class TestPathIndex:
+    def make_tree(self, tmp_path):
+        root = tmp_path / "share"
+        for dirname in ("a", "a/b", "a/b/c", "d", "empty"):
+            (root / dirname).mkdir(parents=True)
+        for filename in ("top.txt", "a/1.txt", "a/b/2.txt", "a/b/c/3.txt", "d/4.txt"):
+            (root / filename).write_bytes(b"onionshare")
+        os.symlink(root / "top.txt", root / "a" / "link.txt")
+        os.symlink(root / "d", root / "a" / "link-dir")
+        return str(root)
+
+    @pytest.mark.parametrize("lazy", [False, True])
+    def test_paths(self, tmp_path, lazy):
+        root = self.make_tree(tmp_path)
+        index = PathIndex(lazy=lazy)
+        index.add_dir("share", root)
+        index.add_file("extra.txt", os.path.join(root, "top.txt"))
+
+        assert dict(index) == {
+            "share": root,
+            "share/a": os.path.join(root, "a"),
+            "share/a/1.txt": os.path.join(root, "a", "1.txt"),
+            "share/a/b": os.path.join(root, "a", "b"),
+            "share/a/b/2.txt": os.path.join(root, "a", "b", "2.txt"),
+            "share/a/b/c": os.path.join(root, "a", "b", "c"),
+            "share/a/b/c/3.txt": os.path.join(root, "a", "b", "c", "3.txt"),
+            "share/d": os.path.join(root, "d"),
+            "share/d/4.txt": os.path.join(root, "d", "4.txt"),
+            "share/empty": os.path.join(root, "empty"),
+            "share/top.txt": os.path.join(root, "top.txt"),
+            "extra.txt": os.path.join(root, "top.txt"),
+        }
+        for path in (
+            "",
+            "share/",
+            "share//a",
+            "share/a/link.txt",
+            "share/a/link-dir",
+            "share/top.txt/a",
+            "share/missing",
+            "extra.txt/a",
+        ):
+            assert path not in index
+            with pytest.raises(KeyError):
+                index[path]
+
+    def test_lazy(self, tmp_path):
+        root = self.make_tree(tmp_path)
+        index = PathIndex(lazy=True)
+        index.add_dir("share", root)
+
+        # Only the directories on the way to a path get scanned
+        assert index.children == {}
+        assert index["share/a/1.txt"] == os.path.join(root, "a", "1.txt")
+        assert len(index.children) == 2
+        assert "share/d/4.txt" in index
+        assert len(index.children) == 3
+
+    def test_is_contained(self, tmp_path):
+        root = self.make_tree(tmp_path)
+        asked = []
+
+        def is_contained(path):
+            asked.append(path)
+            return not path.endswith("b")
+
+        index = PathIndex(is_contained)
+        index.add_dir("share", root)
+        assert "share/a/1.txt" in index
+        assert "share/a/b" in index
+        assert "share/a/b/2.txt" not in index
+        assert "share/a/b/c" not in index
+
+        # Only directories get checked
+        assert sorted(asked) == [
+            root,
+            os.path.join(root, "a"),
+            os.path.join(root, "a", "b"),
+            os.path.join(root, "d"),
+            os.path.join(root, "empty"),
+        ]
+
+
+class TestFileScan:
+    def test_files(self, tmp_path):
+        root = TestPathIndex().make_tree(tmp_path)
+        extra = tmp_path / "extra.txt"
+        extra.write_bytes(b"*" * 1024)
+        os.symlink(extra, tmp_path / "link.txt")
+
+        file_scan = FileScan(
+            [root, str(extra), str(tmp_path / "link.txt"), str(tmp_path / "missing")]
+        )
+        assert [root["basename"] for root in file_scan.roots] == [
+            "share",
+            "extra.txt",
+        ]
+        assert [root["size"] for root in file_scan.roots] == [50, 1024]
+        assert file_scan.size == 1074
+
+        # Files come before the directories next to them, and symlinks are skipped
+        assert [arcname for _, arcname, _ in file_scan.files()] == [
+            "share/top.txt",
+            "share/a/1.txt",
+            "share/a/b/2.txt",
+            "share/a/b/c/3.txt",
+            "share/d/4.txt",
+            "extra.txt",
+        ]
+        for filename, _, st in file_scan.files():
+            assert st.st_size == os.path.getsize(filename)
+
+        file_scan = FileScan([root], lambda path: not path.endswith("b"))
+        assert [arcname for _, arcname, _ in file_scan.files()] == [
+            "share/top.txt",
+            "share/a/1.txt",
+            "share/d/4.txt",
+        ]
+        assert file_scan.size == 30
+
+    def test_scan_files(self, temp_dir, common_obj, tmp_path, monkeypatch):
+        web = web_obj(temp_dir, common_obj, "share")
+        root = TestPathIndex().make_tree(tmp_path)
+        file_scan = web.share_mode.scan_files([root])
+
+        scandir = os.scandir
+        scanned = []
+
+        def counting_scandir(path):
+            # Temporary directories getting cleaned up scan too
+            if isinstance(path, str) and path.startswith(root):
+                scanned.append(path)
+            return scandir(path)
+
+        # Sharing the files reuses the snapshot, instead of scanning again
+        monkeypatch.setattr(os, "scandir", counting_scandir)
+        web.share_mode.set_file_info([root])
+        assert scanned == []
+        assert web.share_mode.file_scan is None
+        dirs = web.share_mode.file_info["dirs"]
+        assert sorted(info["basename"] for info in dirs) == ["a", "d", "empty"]
+        with zipfile.ZipFile(web.share_mode.download_filename) as z:
+            assert len(z.namelist()) == len(list(file_scan.files()))
+
+        # It only gets used once
+        web.share_mode.set_file_info([root])
+        assert scanned != []
+
+
+class TestContainmentCache:
+    def test_is_contained(self, tmp_path, monkeypatch):
+        root = TestPathIndex().make_tree(tmp_path)
+        outside = tmp_path / "outside"
+        outside.mkdir()
+        (outside / "secret.txt").write_bytes(b"secret")
+        os.symlink(outside / "secret.txt", os.path.join(root, "secret.txt"))
+
+        containment = ContainmentCache([os.path.realpath(root)])
+        assert containment.is_contained(root)
+        assert containment.is_contained(os.path.join(root, "a", "b", "2.txt"))
+        assert containment.is_contained(os.path.join(root, "a", "link.txt"))
+        assert not containment.is_contained(os.path.join(root, "secret.txt"))
+        assert not containment.is_contained(str(outside / "secret.txt"))
+
+        # Files in the same directory don't resolve it again
+        resolved = []
+        resolve = containment._resolve
+
+        def counting_resolve(path):
+            resolved.append(path)
+            return resolve(path)
+
+        monkeypatch.setattr(containment, "_resolve", counting_resolve)
+        assert containment.is_contained(os.path.join(root, "a", "b", "2.txt"))
+        assert containment.is_contained(os.path.join(root, "a", "b"))
+        assert resolved == []
+
+        assert ContainmentCache([]).is_contained(str(outside / "secret.txt"))
+
+    def test_replaced_with_symlink(self, tmp_path):
+        root = TestPathIndex().make_tree(tmp_path)
+        outside = tmp_path / "outside"
+        outside.mkdir()
+        (outside / "1.txt").write_bytes(b"secret")
+
+        containment = ContainmentCache([os.path.realpath(root)])
+        filename = os.path.join(root, "a", "1.txt")
+        assert containment.is_contained(filename)
+
+        # A directory gets replaced by a symlink to outside of the share
+        shutil.rmtree(os.path.join(root, "a"))
+        os.symlink(outside, os.path.join(root, "a"))
+        assert not containment.is_contained(filename)
+
+
+class TestTransfers:
+    def test_history_ids(self):
+        registry = TransferRegistry(queue.Queue())
+
+        def new_history_ids():
+            for _ in range(1000):
+                registry.new_history_id()
+
+        threads = [Thread(target=new_history_ids) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert registry.history_count == 10000
+
+        registry.reset_history()
+        assert registry.new_history_id() == 0
+
+    def test_transfer_state(self):
+        stop_q = queue.Queue()
+        registry = TransferRegistry(stop_q)
+        first = registry.start("/download", 100, exclusive=True)
+        assert registry.start("/download", 100, exclusive=True) is None
+        second = registry.start("/file.txt", 10)
+        assert second.history_id == first.history_id + 1
+        assert registry.in_progress() == [first, second]
+
+        # Canceling one transfer doesn't cancel the others
+        assert registry.cancel(second.history_id)
+        assert second.is_canceled()
+        assert not first.is_canceled()
+        assert second.finish(False)
+        assert not second.finish(True)
+        assert registry.in_progress() == [first]
+
+        # Stopping the server cancels all of them
+        stop_q.put(True)
+        assert first.is_canceled()
+        first.finish(True)
+        assert registry.in_progress() == []
+        assert registry.start("/download", 100, exclusive=True) is not None
+
+    def test_progress_rate(self, monkeypatch):
+        now = [100.0]
+        monkeypatch.setattr(time, "monotonic", lambda: now[0])
+        registry = TransferRegistry(queue.Queue())
+        transfer = registry.start("/download", 1000)
+
+        # The first update is always reported, then at most 10 per second
+        assert transfer.update(1)
+        reported = [transfer.update(i) for i in range(2, 500)]
+        assert not any(reported)
+        assert transfer.unreported()
+        now[0] += 0.25
+        assert transfer.update(500)
+        assert not transfer.unreported()
+
+        # And so is reaching the end
+        assert transfer.update(1000)
+
+    def test_adaptive_chunker(self, monkeypatch):
+        now = [100.0]
+        monkeypatch.setattr(time, "monotonic", lambda: now[0])
+        chunker = AdaptiveChunker(102400)
+        assert chunker.next_size() == 102400
+
+        # Chunks that drain quickly grow, up to max_size
+        for _ in range(20):
+            now[0] += 0.001
+            chunker.next_size()
+        assert chunker.next_size() == AdaptiveChunker.max_size
+        assert chunker.peak_size == AdaptiveChunker.max_size
+
+        # Chunks that drain slowly shrink, down to min_size
+        for _ in range(20):
+            now[0] += 1
+            chunker.next_size()
+        now[0] += 1
+        assert chunker.next_size() == AdaptiveChunker.min_size
+
+        # In between, they stay the same size
+        now[0] += 0.05
+        assert chunker.next_size() == AdaptiveChunker.min_size
+
+    def test_chunk_budget(self, monkeypatch):
+        monkeypatch.setattr(time, "monotonic", lambda: 100.0)
+        budget = ChunkBudget(1024 * 1024)
+        chunkers = [AdaptiveChunker(768 * 1024, budget) for _ in range(3)]
+
+        # The first chunker gets what it asks for, and the others share the rest
+        assert chunkers[0].next_size() == 768 * 1024
+        assert chunkers[1].next_size() == 256 * 1024
+        assert chunkers[2].next_size() == AdaptiveChunker.min_size
+
+        # When one finishes, the others can have what it was using
+        chunkers[0].close()
+        assert chunkers[2].next_size() == 768 * 1024
+
+    def test_chunk_iterator(self, temp_file_1024):
+        registry = TransferRegistry(queue.Queue())
+        transfer = registry.start("/download", 1024)
+        chunker = transfer.chunker(100)
+        chunker.min_size = 100
+        with open(temp_file_1024, "rb") as f:
+            contents = f.read()
+        chunks = ChunkIterator(open(temp_file_1024, "rb"), chunker)
+        assert b"".join(chunks) == contents
+        chunks.close()
+        assert chunks.fp.closed
+        assert registry.chunk_budget.sizes == {}
+
+    def test_event_queue(self):
+        q = EventQueue(maxsize=5)
+        q.put(Event(Web.REQUEST_STARTED, "/download", {"id": 0}))
+        for downloaded_bytes in range(100):
+            data = {"id": 0, "bytes": downloaded_bytes}
+            q.put(Event(Web.REQUEST_PROGRESS, "/download", data))
+        q.put(Event(Web.REQUEST_STARTED, "/download", {"id": 1}))
+        q.put(Event(Web.REQUEST_PROGRESS, "/download", {"id": 1, "bytes": 5}))
+
+        # Progress events of the same transfer get coalesced
+        assert q.qsize() == 4
+        assert q.get(False)["type"] == Web.REQUEST_STARTED
+        event = q.get(False)
+        assert event["data"] == {"id": 0, "bytes": 99}
+
+        # Once it's been read, there's a new progress event
+        q.put(Event(Web.REQUEST_PROGRESS, "/download", {"id": 0, "bytes": 100}))
+        assert q.qsize() == 3
+
+        # When it's full, the oldest events get dropped
+        for i in range(5):
+            q.put(Event(Web.REQUEST_LOAD, "/"))
+        assert q.qsize() == 5
+        assert q.dropped == 3
+        while not q.empty():
+            assert q.get(False)["type"] == Web.REQUEST_LOAD
+        with pytest.raises(queue.Empty):
+            q.get(False)
+
+    def test_headless_events(self, temp_dir, common_obj):
+        """
+        Without a GUI, events don't pile up anywhere
+        """
+        web = web_obj(temp_dir, common_obj, "share", 3)
+        web.settings.set("share", "autostop_sharing", False)
+        assert web.q is None
+        metrics = web.events.subscribe(EventMetrics())
+
+        with web.app.test_client() as client:
+            for _ in range(3):
+                resp = client.get("/download")
+                assert len(resp.data) == web.share_mode.download_filesize
+                resp.close()
+
+        assert metrics.counts[Web.REQUEST_STARTED] == 3
+        assert metrics.bytes_sent == 3 * web.share_mode.download_filesize
+        assert metrics.progress == {}
+
+    def test_metrics_forget_ranges(self, temp_dir, common_obj):
+        """
+        Ranges never reach the end of the file, and they're forgotten once
+        they're over
+        """
+        web = web_obj(temp_dir, common_obj, "share", 3)
+        web.settings.set("share", "autostop_sharing", False)
+        web.share_mode.set_file_info(list(web.share_mode.root_files.values()))
+        metrics = web.events.subscribe(EventMetrics())
+        path = "/" + sorted(web.share_mode.root_files)[0]
+
+        with web.app.test_client() as client:
+            for url in ("/download", path):
+                resp = client.get(url, headers={"Range": "bytes=0-99"})
+                assert resp.status_code == 206
+                assert len(resp.data) == 100
+                resp.close()
+
+        assert metrics.counts[Web.REQUEST_TRANSFER_FINISHED] == 2
+        assert metrics.progress == {}
+
+    def test_parallel_downloads(self, temp_dir, common_obj):
+        """
+        Download the share 50 times at once from a local-only server, like
+        --local-only runs, and make sure the transfers don't get mixed up
+        """
+        common_obj.settings = Settings(common_obj)
+        mode_settings = ModeSettings(common_obj)
+        mode_settings.set("share", "autostop_sharing", False)
+        web = Web(common_obj, False, mode_settings, "share")
+
+        files = []
+        for _ in range(3):
+            with tempfile.NamedTemporaryFile(delete=False, dir=temp_dir.name) as f:
+                f.write(os.urandom(300000))
+                files.append(f.name)
+        web.share_mode.set_file_info(files)
+        with open(web.share_mode.download_filename, "rb") as f:
+            contents = f.read()
+
+        q = web.events.subscribe(EventQueue())
+
+        port = common_obj.get_available_port(17600, 17650)
+        server = Thread(target=web.start, args=(port,), daemon=True)
+        server.start()
+        url = f"http://127.0.0.1:{port}/download"
+        for _ in range(50):
+            try:
+                urlopen(f"http://127.0.0.1:{port}/").read()
+                break
+            except Exception:
+                time.sleep(0.1)
+
+        results = [None] * 50
+
+        def download(i):
+            # Half of them ask for a range, which takes a different path
+            if i % 2:
+                req = Request(url, headers={"Range": "bytes=1000-"})
+            else:
+                req = Request(url)
+            results[i] = urlopen(req).read()
+
+        try:
+            threads = [Thread(target=download, args=(i,)) for i in range(50)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(timeout=60)
+
+            # The server finishes each transfer when it closes the file
+            for _ in range(50):
+                if not web.share_mode.transfers.in_progress():
+                    break
+                time.sleep(0.1)
+            assert web.share_mode.transfers.in_progress() == []
+        finally:
+            web.stop(port)
+            server.join(timeout=5)
+
+        for i, data in enumerate(results):
+            assert data == (contents[1000:] if i % 2 else contents)
+
+        events = []
+        while not q.empty():
+            events.append(q.get())
+        started = [e for e in events if e["type"] == Web.REQUEST_STARTED]
+        assert len({e["data"]["id"] for e in started}) == 50
+        assert not [e for e in events if e["type"] == Web.REQUEST_CANCELED]
+
+        # Every download reached the end of the file
+        last_progress = {}
+        for e in events:
+            if e["type"] == Web.REQUEST_PROGRESS:
+                last_progress[e["data"]["id"]] = e["data"]["bytes"]
+        assert len(last_progress) == 50
+        assert set(last_progress.values()) == {len(contents)}
+
+
 def check_unsupported(cmd: str, args: list):
     cmd_args = [cmd]
     cmd_args.extend(args)
@@ -455,11 +1879,15 @@ class TestRangeRequests:
         ("bytes=0-99,101-199", 500, [(0, 99), (101, 199)]),
         ("bytes=0-199,100-299", 500, [(0, 299)]),
         ("bytes=0-99,200-299", 500, [(0, 99), (200, 299)]),
+        ("bytes=-1000", 500, [(0, 499)]),
+        ("bytes=0-99,600-699", 500, [(0, 99)]),
     ]
 
     INVALID_RANGES = [
         "bytes=200-100",
         "bytes=0-100,300-200",
+        "bytes=500-",
+        "bytes=600-699,700-799",
     ]
 
     def test_parse_ranges(self):
@@ -528,6 +1956,52 @@ class TestRangeRequests:
 
             assert bytes_out == contents
 
+    def test_multipart_byteranges(self, temp_dir, common_obj):
+        web = web_obj(temp_dir, common_obj, "share", 3)
+        web.settings.set("share", "autostop_sharing", False)
+        url = "/download"
+        filesize = web.share_mode.download_filesize
+        with open(web.share_mode.download_filename, "rb") as f:
+            contents = f.read()
+
+        with web.app.test_client() as client:
+            headers = Headers()
+            headers.extend({"Range": "bytes=0-9,100-199,-50"})
+            resp = client.get(url, headers=headers)
+            assert resp.status_code == 206
+            assert "Content-Range" not in resp.headers
+            content_type = resp.headers["Content-Type"]
+            assert content_type.startswith("multipart/byteranges; boundary=")
+            boundary = content_type.split("boundary=")[1].encode()
+            body = resp.data
+            assert int(resp.headers["Content-Length"]) == len(body)
+
+        assert body.startswith(b"--" + boundary + b"\r\n")
+        assert body.endswith(b"\r\n--" + boundary + b"--\r\n")
+        parts = body[: -len(boundary) - 6].split(b"--" + boundary + b"\r\n")[1:]
+        expected = [(0, 9), (100, 199), (filesize - 50, filesize - 1)]
+        assert len(parts) == len(expected)
+        for part, (start, end) in zip(parts, expected):
+            part_headers, data = part.split(b"\r\n\r\n", 1)
+            if data.endswith(b"\r\n"):
+                data = data[:-2]
+            assert (
+                f"Content-Range: bytes {start}-{end}/{filesize}".encode()
+                in part_headers
+            )
+            assert data == contents[start : end + 1]
+
+    def test_too_many_ranges(self, temp_dir, common_obj):
+        web = web_obj(temp_dir, common_obj, "share", 3)
+        web.settings.set("share", "autostop_sharing", False)
+        url = "/download"
+
+        ranges = ",".join(f"{i * 2}-{i * 2}" for i in range(200))
+        with web.app.test_client() as client:
+            resp = client.get(url, headers={"Range": f"bytes={ranges}"})
+            assert resp.status_code == 200
+            assert len(resp.data) == web.share_mode.download_filesize
+
     def test_mismatched_etags(self, temp_dir, common_obj):
         """RFC 7233 Section 3.2
         The "If-Range" header field allows a client to "short-circuit" the second request.
@@ -590,6 +2064,210 @@ class TestRangeRequests:
             resp = client.get(url, headers=headers)
             assert resp.status_code == 206
 
+    def website_obj(self, tmp_path, common_obj):
+        common_obj.settings = Settings(common_obj)
+        web = Web(common_obj, False, ModeSettings(common_obj), "website")
+        web.app.testing = True
+
+        site_dir = tmp_path / "site"
+        site_dir.mkdir()
+        (site_dir / "page.html").write_bytes(b"<p>hello</p>\n" * 1000)
+        (site_dir / "video.mp4").write_bytes(os.urandom(5000))
+        web.website_mode.set_file_info([str(site_dir)])
+        return web, site_dir
+
+    def test_individual_file_ranges(self, tmp_path, common_obj):
+        web, site_dir = self.website_obj(tmp_path, common_obj)
+        contents = (site_dir / "video.mp4").read_bytes()
+
+        with web.app.test_client() as client:
+            resp = client.get("/video.mp4", headers={"Range": "bytes=100-199"})
+            assert resp.status_code == 206
+            assert resp.headers["Content-Range"] == "bytes 100-199/5000"
+            assert resp.headers["Accept-Ranges"] == "bytes"
+            assert resp.data == contents[100:200]
+
+            resp = client.get("/video.mp4", headers={"Range": "bytes=0-9,-10"})
+            assert resp.status_code == 206
+            assert resp.headers["Content-Type"].startswith("multipart/byteranges")
+            assert contents[:10] in resp.data
+            assert contents[-10:] in resp.data
+
+            # Ranges of the gzip variant
+            headers = {"Accept-Encoding": "gzip"}
+            resp = client.get("/page.html", headers=headers)
+            assert resp.headers["Content-Encoding"] == "gzip"
+            compressed = resp.data
+            headers["Range"] = "bytes=10-"
+            resp = client.get("/page.html", headers=headers)
+            assert resp.status_code == 206
+            assert resp.headers["Content-Encoding"] == "gzip"
+            assert resp.data == compressed[10:]
+
+            # Several ranges are sent from the original file
+            headers["Range"] = "bytes=0-9,20-29"
+            resp = client.get("/page.html", headers=headers)
+            assert resp.status_code == 206
+            assert "Content-Encoding" not in resp.headers
+
+    def test_individual_file_not_modified(self, tmp_path, common_obj):
+        web, site_dir = self.website_obj(tmp_path, common_obj)
+
+        with web.app.test_client() as client:
+            headers = {"Accept-Encoding": "gzip"}
+            resp = client.get("/page.html", headers=headers)
+            assert resp.status_code == 200
+            etag = resp.headers["ETag"]
+            last_modified = resp.headers["Last-Modified"]
+            gzip_filename = web.website_mode.variant_cache.entries[
+                (str(site_dir / "page.html"), "gzip")
+            ]["variant"][0]
+
+            resp = client.get("/page.html", headers={**headers, "If-None-Match": etag})
+            assert resp.status_code == 304
+            assert resp.data == b""
+            resp = client.get(
+                "/page.html", headers={**headers, "If-Modified-Since": last_modified}
+            )
+            assert resp.status_code == 304
+
+            # The ETag of the gzip variant is different from the original file's
+            resp = client.get("/page.html", headers={"If-None-Match": etag})
+            assert resp.status_code == 200
+            assert resp.headers["ETag"] != etag
+
+            # If the file changes, it gets compressed again
+            (site_dir / "page.html").write_bytes(b"<p>changed</p>\n" * 1000)
+            resp = client.get("/page.html", headers={**headers, "If-None-Match": etag})
+            assert resp.status_code == 200
+            assert resp.headers["ETag"] != etag
+            assert gzip.decompress(resp.data) == b"<p>changed</p>\n" * 1000
+            assert not os.path.exists(gzip_filename)
+
+    def test_streaming_archive_etag(self, common_obj, tmp_path):
+        def etag():
+            zip_stream = ZipStream(common_obj, compress_type=zipfile.ZIP_STORED)
+            zip_stream.add_dir(str(tmp_path))
+            zip_stream.build_layout()
+            return zip_stream.etag
+
+        filename = tmp_path / "file.txt"
+        filename.write_bytes(b"before")
+        st = os.stat(filename)
+        before = etag()
+        assert etag() == before
+
+        # A file replaced by another one of the same size with the same mtime
+        # changes the ETag
+        (tmp_path / "new.txt").write_bytes(b"after!")
+        os.utime(tmp_path / "new.txt", ns=(st.st_atime_ns, st.st_mtime_ns))
+        os.replace(tmp_path / "new.txt", filename)
+        assert etag() != before
+
+    def test_streaming_archive_partial_sends(self, common_obj, tmp_path):
+        for i, size in enumerate((100000, 250000, 70000)):
+            (tmp_path / f"file{i}.bin").write_bytes(os.urandom(size))
+        zip_stream = ZipStream(common_obj, compress_type=zipfile.ZIP_STORED)
+        zip_stream.add_dir(str(tmp_path))
+        zip_stream.build_layout()
+
+        # Nothing should have to be read again to work out a CRC
+        reread = []
+        member_crc = zip_stream.member_crc
+
+        def checked_member_crc(index):
+            if index not in zip_stream.crcs:
+                reread.append(index)
+            return member_crc(index)
+
+        zip_stream.member_crc = checked_member_crc
+
+        progress_file = ProgressFile(
+            zip_stream.open(),
+            0,
+            zip_stream.size,
+            lambda _: None,
+            lambda _: None,
+            lambda: False,
+        )
+        buf = ReadOnlyFileBasedBuffer(progress_file)
+        buf.prepare(zip_stream.size)
+
+        # Send the archive the way waitress does: peek, send some of it, then skip
+        data = b""
+        while len(buf):
+            chunk = buf.get(30000)
+            data += chunk[:17000]
+            buf.skip(min(17000, len(chunk)), True)
+        buf.close()
+
+        assert reread == []
+        with zipfile.ZipFile(BytesIO(data)) as z:
+            assert z.testzip() is None
+            assert len(z.namelist()) == 3
+
+    def test_streaming_stored_archive(self, temp_dir, common_obj):
+        common_obj.settings = Settings(common_obj)
+        mode_settings = ModeSettings(common_obj)
+        mode_settings.set("share", "autostop_sharing", False)
+        mode_settings.set("share", "streaming_archive", True)
+        mode_settings.set("share", "archive_compression", False)
+        web = Web(common_obj, False, mode_settings, "share")
+        web.app.testing = True
+
+        files = []
+        for size in (0, 1024, 250000):
+            with tempfile.NamedTemporaryFile(
+                delete=False, dir=temp_dir.name
+            ) as tmp_file:
+                tmp_file.write(os.urandom(size))
+                files.append(tmp_file.name)
+        web.share_mode.set_file_info(files)
+        url = "/download"
+
+        zip_stream = web.share_mode.zip_stream
+        filesize = web.share_mode.download_filesize
+
+        with web.app.test_client() as client:
+            # The end of the archive needs every CRC, so until they've been worked
+            # out in the background, ranges get the whole archive
+            zip_stream.crcs_done.clear()
+            headers = Headers()
+            headers.extend({"Range": "bytes=-100"})
+            resp = client.get(url, headers=headers)
+            assert resp.status_code == 200
+            assert resp.headers["Accept-Ranges"] == "none"
+            assert int(resp.headers["Content-Length"]) == filesize
+            assert resp.headers["ETag"] == web.share_mode.download_etag
+            contents = resp.data
+            assert len(contents) == filesize
+
+            zip_stream.compute_crcs()
+            assert zip_stream.crcs_done.is_set()
+            resp = client.get(url, headers=headers)
+            assert resp.status_code == 206
+            assert resp.headers["Accept-Ranges"] == "bytes"
+            assert resp.headers["Content-Range"] == "bytes {}-{}/{}".format(
+                filesize - 100, filesize - 1, filesize
+            )
+            assert resp.data == contents[-100:]
+
+            # Reassemble the archive from ranges
+            bytes_out = b""
+            for start in range(0, filesize, 70000):
+                headers.update({"Range": f"bytes={start}-{start + 69999}"})
+                resp = client.get(url, headers=headers)
+                assert resp.status_code == 206
+                bytes_out += resp.data
+            assert bytes_out == contents
+
+        with zipfile.ZipFile(BytesIO(contents)) as z:
+            assert z.testzip() is None
+            for info, filename in zip(z.infolist(), sorted(files)):
+                assert info.compress_type == zipfile.ZIP_STORED
+                with open(filename, "rb") as f:
+                    assert z.read(info) == f.read()
+
     @pytest.mark.skipif(sys.platform != "linux", reason="requires Linux")
     @check_unsupported("curl", ["--version"])
     def test_curl(self, temp_dir, tmpdir, common_obj):
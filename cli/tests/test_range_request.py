@@ -1,7 +1,7 @@
 import pytest
 from werkzeug.exceptions import RequestedRangeNotSatisfiable
 
-from onionshare_cli.web.share_mode import parse_range_header
+from onionshare_cli.web.send_base_mode import parse_range_header
 
 
 VALID_RANGES = [
@@ -18,12 +18,16 @@ VALID_RANGES = [
     ("bytes=0-99,101-199", 500, [(0, 99), (101, 199)]),
     ("bytes=0-199,100-299", 500, [(0, 299)]),
     ("bytes=0-99,200-299", 500, [(0, 99), (200, 299)]),
+    ("bytes=-1000", 500, [(0, 499)]),
+    ("bytes=0-99,600-699", 500, [(0, 99)]),
 ]
 
 
 INVALID_RANGES = [
     "bytes=200-100",
     "bytes=0-100,300-200",
+    "bytes=500-",
+    "bytes=600-699,700-799",
 ]
 
 
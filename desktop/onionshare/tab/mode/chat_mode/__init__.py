@@ -133,7 +133,7 @@ class ChatMode(Mode):
         Starting the server.
         """
         # Reset web counters
-        self.web.chat_mode.cur_history_id = 0
+        self.web.chat_mode.transfers.reset_history()
 
     def start_server_step2_custom(self):
         """
@@ -284,10 +284,7 @@ class ReceiveMode(Mode):
         The auto-stop timer expired, should we stop the server? Returns a bool
         """
         # If there were no attempts to upload files, or all uploads are done, we can stop
-        if (
-            self.web.receive_mode.cur_history_id == 0
-            or not self.web.receive_mode.uploads_in_progress
-        ):
+        if not self.web.receive_mode.transfers.in_progress():
             self.server_status.stop_server()
             self.server_status_label.setText(strings._("close_on_autostop_timer"))
             return True
@@ -304,7 +301,7 @@ class ReceiveMode(Mode):
         Starting the server.
         """
         # Reset web counters
-        self.web.receive_mode.cur_history_id = 0
+        self.web.receive_mode.transfers.reset_history()
 
         # Hide and reset the uploads if we have previously shared
         self.reset_info_counters()
@@ -18,10 +18,8 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-import os
 from PySide6 import QtCore, QtWidgets, QtGui
 
-from onionshare_cli.common import Common
 from onionshare_cli.web import Web
 
 from .threads import CompressThread
@@ -200,7 +198,10 @@ class ShareMode(Mode):
         The auto-stop timer expired, should we stop the server? Returns a bool
         """
         # If there were no attempts to download the share, or all downloads are done, we can stop
-        if self.history.in_progress_count == 0 or self.web.done:
+        if (
+            self.history.in_progress_count == 0
+            or not self.web.share_mode.transfers.in_progress()
+        ):
             self.server_status.stop_server()
             self.server_status_label.setText(strings._("close_on_autostop_timer"))
             return True
@@ -216,7 +217,7 @@ class ShareMode(Mode):
         Starting the server.
         """
         # Reset web counters
-        self.web.share_mode.cur_history_id = 0
+        self.web.share_mode.transfers.reset_history()
 
         # Hide and reset the downloads if we have previously shared
         self.reset_info_counters()
@@ -231,9 +232,9 @@ class ShareMode(Mode):
         self._zip_progress_bar = ZipProgressBar(self.common, 0)
         self.filenames = self.file_selection.get_filenames()
 
-        self._zip_progress_bar.total_files_size = ShareMode._compute_total_size(
-            self.filenames
-        )
+        # The web server reuses this snapshot of the files when it zips them up
+        file_scan = self.web.share_mode.scan_files(self.filenames)
+        self._zip_progress_bar.total_files_size = file_scan.size
         self.status_bar.insertWidget(0, self._zip_progress_bar)
 
         # prepare the files for sending in a new thread
@@ -254,6 +255,15 @@ class ShareMode(Mode):
             self.status_bar.removeWidget(self._zip_progress_bar)
             self._zip_progress_bar = None
 
+        # Show how much the files got compressed
+        if self.web.share_mode.compression_ratio is not None:
+            self.info_label.setText(
+                strings._("gui_file_info_compressed").format(
+                    self.info_label.text(),
+                    int(self.web.share_mode.compression_ratio * 100),
+                )
+            )
+
         # Warn about sending large files over Tor
         if self.web.share_mode.download_filesize >= 157286400:  # 150mb
             self.filesize_warning.setText(strings._("large_filesize"))
@@ -277,6 +287,7 @@ class ShareMode(Mode):
             self._zip_progress_bar = None
 
         self.filesize_warning.hide()
+        self.update_primary_action()
         self.history.in_progress_count = 0
         self.history.completed_count = 0
         self.history.update_in_progress()
@@ -325,7 +336,7 @@ class ShareMode(Mode):
         self.history.update(event["data"]["id"], event["data"]["bytes"])
 
         # Is the download complete?
-        if event["data"]["bytes"] == self.web.share_mode.filesize:
+        if event["data"]["bytes"] == event["data"]["total_bytes"]:
             self.system_tray.showMessage(
                 strings._("systray_share_completed_title"),
                 strings._("systray_share_completed_message"),
@@ -412,16 +423,6 @@ class ShareMode(Mode):
 
         self.file_selection.file_list.setCurrentItem(None)
 
-    @staticmethod
-    def _compute_total_size(filenames):
-        total_size = 0
-        for filename in filenames:
-            if os.path.isfile(filename):
-                total_size += os.path.getsize(filename)
-            if os.path.isdir(filename):
-                total_size += Common.dir_size(filename)
-        return total_size
-
 
 class ZipProgressBar(QtWidgets.QProgressBar):
     update_processed_size_signal = QtCore.Signal(int)